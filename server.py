@@ -2,12 +2,27 @@ import logging
 import os
 
 from flask import Flask
+from flask import jsonify
 from flask import request
 
+import server_codec
 import server_logic
+import server_mcts
+import server_metrics
+import server_opponents
+import server_ponder
+import server_recorder
+from server_log import logger
+from server_session import SessionStore
 
 app = Flask(__name__)
 
+# Keeps the board of every game we are in between turns, so each /move only applies what changed.
+sessions = SessionStore(
+    ttl=float(os.environ.get("SESSION_TTL", "300")),
+    table_memory=int(os.environ.get("TABLE_MEMORY_MB", "8")) * 1024 * 1024,
+)
+
 @app.get("/")
 def handle_info():
     """
@@ -19,7 +34,7 @@ def handle_info():
 
     TIP: If you open your Battlesnake URL in browser you should see this data.
     """
-    print("INFO")
+    logger.info("info")
     return {
         "apiversion": "1",
         "author": "jryantz", # TODO: Your Battlesnake Username
@@ -35,22 +50,54 @@ def handle_start():
     request.json contains information about the game that's about to be played.
     """
     data = request.get_json()
+    sessions.start(data)
+    server_recorder.recorder.start(data)
 
-    print(f"{data['game']['id']} START")
+    logger.info("start", game=data['game']['id'])
     return "ok"
 
+def get_move(data: dict, timings: server_metrics.RequestTimings) -> str:
+    """
+    This function picks our move for a decoded move request, with the game's session up to date.
+    It is shared with server_asgi.py, so both servers pick moves the same way.
+    """
+    # Nothing is pondered in the background while a move is being picked.
+    with server_ponder.picking():
+        session = sessions.get(data)
+        with session.lock:
+            # The time spent waiting for a thread, or for another request of the same game.
+            timings.lap("queue")
+            session.stop_ponder()
+            session.update(data)
+            timings.lap("model")
+
+            # TODO - look at the server_logic.py file to see how we decide what move to return!
+            move = server_logic.choose_move(data, session, timings)
+            server_recorder.recorder.move(data, move, session.decision, session.move_time)
+
+            return move
+
 @app.post("/move")
 def handle_move():
     """
     This function is called on every turn of a game. It's how your snake decides where to move.
     Valid moves are "up", "down", "left", or "right".
     """
-    data = request.get_json()
+    timings = server_metrics.RequestTimings()
+    data = server_codec.parse_move_request(request.get_data())
+    timings.lap("decode")
 
-    # TODO - look at the server_logic.py file to see how we decide what move to return!
-    move = server_logic.choose_move(data)
+    move = get_move(data, timings)
 
-    return {"move": move}
+    response = jsonify(move=move)
+    timings.lap("encode")
+    server_metrics.record(data, timings)
+
+    # The next turn is only pondered once the response has gone, so it never holds the response up.
+    game_id = data["game"]["id"]
+    response.call_on_close(lambda: sessions.start_ponder(game_id))
+
+    return response
 
 @app.post("/end")
 def end():
@@ -59,13 +106,31 @@ def end():
     It's purely for informational purposes, you don't have to make any decisions here.
     """
     data = request.get_json()
+    sessions.end(data)
+    server_opponents.model.save()
+    server_recorder.recorder.end(data)
 
-    print(f"{data['game']['id']} END")
+    logger.info("end", game=data['game']['id'])
     return "ok"
 
+@app.get("/metrics")
+def metrics():
+    """
+    This function serves the timings of every /move request in the Prometheus text format.
+    See server_metrics.py for what is measured.
+    """
+    return server_metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
 if __name__ == "__main__":
     logging.getLogger("werkzeug").setLevel(logging.ERROR)
 
     print("Starting Battlesnake Server...")
+
+    # The reloader runs this file twice, only the process that serves requests needs the pool and the tables.
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        if "mcts" in server_logic.get_configured_strategies():
+            server_mcts.start_pool(int(os.environ.get("MCTS_WORKERS", "0")) or None)
+        server_logic.warm_up()
+
     port = int(os.environ.get("PORT", "8080"))
     app.run(host="0.0.0.0", port=port, debug=True)
@@ -0,0 +1,144 @@
+import asyncio
+import contextlib
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.routing import Route
+
+from server_codec import dumps, loads
+
+import server
+import server_codec
+import server_logic
+import server_mcts
+import server_metrics
+import server_opponents
+import server_recorder
+from server_log import logger
+
+"""
+This file serves the same routes as server.py for production: an async app run by uvicorn, with
+several worker processes.
+
+Requests are decoded and encoded with orjson when it is installed, and move requests are read with
+server_codec.parse_move_request(). Picking a move runs on a thread pool,
+so a long search never holds up the event loop, and the /start, /end and /move requests of other games
+are answered while it runs.
+
+    python server_asgi.py
+
+WEB_CONCURRENCY sets the number of worker processes (default 1) and MOVE_THREADS the threads each of
+them picks moves on (default 8). server.py stays the development server.
+"""
+
+MOVE_THREADS = int(os.environ.get("MOVE_THREADS", "8"))
+executor = ThreadPoolExecutor(max_workers=MOVE_THREADS)
+
+# How many moves are being picked on the pool. Only the event loop changes it, so it needs no lock.
+picking = 0
+
+def json_response(value, background: BackgroundTask = None) -> Response:
+    return Response(dumps(value), media_type="application/json", background=background)
+
+async def handle_info(request: Request) -> Response:
+    return json_response(server.handle_info())
+
+async def handle_start(request: Request) -> Response:
+    data = loads(await request.body())
+    server.sessions.start(data)
+    server_recorder.recorder.start(data)
+
+    logger.info("start", game=data['game']['id'])
+    return Response("ok")
+
+async def handle_move(request: Request) -> Response:
+    global picking
+
+    timings = server_metrics.RequestTimings()
+    data = server_codec.parse_move_request(await request.body())
+    timings.lap("decode")
+
+    # A move that waited for a thread would use up its timeout waiting, so once every thread is busy it is answered straight away.
+    if picking >= MOVE_THREADS:
+        move = server_logic.get_fallback_move(data)
+        logger.info("move_fallback", game=data['game']['id'], turn=data['turn'], move=move)
+        server_recorder.recorder.move(data, move, None, (time.perf_counter() - timings.started) * 1000)
+        response = json_response({"move": move})
+    else:
+        picking += 1
+        try:
+            move = await asyncio.get_running_loop().run_in_executor(executor, server.get_move, data, timings)
+        finally:
+            picking -= 1
+
+        # The next turn is only pondered once the response has gone, so it never holds the response up.
+        response = json_response({"move": move}, BackgroundTask(start_ponder, data["game"]["id"]))
+    timings.lap("encode")
+    server_metrics.record(data, timings)
+
+    return response
+
+async def start_ponder(game_id: str):
+    # A ponder would take the time other moves still need to be answered in, so none is started while any are being picked.
+    if picking == 0:
+        server.sessions.start_ponder(game_id)
+
+async def handle_end(request: Request) -> Response:
+    data = loads(await request.body())
+    # Ending the session waits for its ponder to stop and saving the opponents writes a file, so both run on the pool.
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(executor, server.sessions.end, data)
+    await loop.run_in_executor(executor, server_opponents.model.save)
+    server_recorder.recorder.end(data)
+
+    logger.info("end", game=data['game']['id'])
+    return Response("ok")
+
+async def handle_metrics(request: Request) -> Response:
+    return Response(server_metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    # Every worker process grows its own trees, so the cores are shared out between the workers.
+    if "mcts" in server_logic.get_configured_strategies():
+        workers = int(os.environ.get("MCTS_WORKERS", "0"))
+        if not workers:
+            workers = max(1, (os.cpu_count() or 1) // int(os.environ.get("WEB_CONCURRENCY", "1")))
+        server_mcts.start_pool(workers)
+
+    server_logic.warm_up()
+
+    yield
+
+    server_mcts.stop_pool()
+
+app = Starlette(
+    routes=[
+        Route("/", handle_info, methods=["GET"]),
+        Route("/start", handle_start, methods=["POST"]),
+        Route("/move", handle_move, methods=["POST"]),
+        Route("/end", handle_end, methods=["POST"]),
+        Route("/metrics", handle_metrics, methods=["GET"]),
+    ],
+    lifespan=lifespan,
+)
+
+if __name__ == "__main__":
+    import uvicorn
+
+    print("Starting Battlesnake Server...")
+
+    uvicorn.run(
+        "server_asgi:app",
+        host="0.0.0.0",
+        port=int(os.environ.get("PORT", "8080")),
+        workers=int(os.environ.get("WEB_CONCURRENCY", "1")),
+        log_level=logging.ERROR,
+        access_log=False,
+    )
@@ -0,0 +1,437 @@
+import argparse
+import contextlib
+import cProfile
+import io
+import json
+import os
+import pstats
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+"""
+This file replays recorded move requests to measure how long we take to answer them.
+
+A recording is a JSON lines file with one move request, exactly as the engine sent it, per line.
+The simulator can make one:
+
+    python server_simulator.py --games 20 --record moves.jsonl
+
+The games the server has recorded with GAME_RECORDS set can be replayed too, a folder of them or one game.
+
+Then replay it through choose_move, and through the whole Flask request path:
+
+    python server_bench.py moves.jsonl --flask --allocations --profile
+
+To catch a regression before deploying, save the results of one revision and compare the next one to them,
+or let the benchmark check the other revision out into a temporary worktree and run it there:
+
+    python server_bench.py moves.jsonl --output before.json
+    python server_bench.py moves.jsonl --compare before.json
+    python server_bench.py moves.jsonl --against HEAD~1
+
+To see how long a fresh server takes to answer its first move, and how that compares to its hundredth:
+
+    python server_bench.py --startup
+"""
+
+# How much slower a percentile can get, as a fraction, before --compare reports a regression.
+THRESHOLD = 0.10
+
+PERCENTILES = (50, 95, 99)
+
+# How many moves of a game the startup benchmark plays.
+STARTUP_MOVES = 100
+
+# Run in a fresh interpreter by measure_startup(), so nothing has been imported or cached yet.
+_STARTUP_SCRIPT = '''
+import json, sys, time
+started = time.perf_counter()
+import server
+imported = time.perf_counter()
+if sys.argv[2] == 'warm':
+    server.server_logic.warm_up()
+booted = time.perf_counter()
+client = server.app.test_client()
+with open(sys.argv[1]) as f:
+    bodies = [x.strip() for x in f if x.strip()]
+client.post('/start', data=bodies[0], content_type='application/json')
+times = []
+for body in bodies:
+    before = time.perf_counter()
+    client.post('/move', data=body, content_type='application/json')
+    times.append(time.perf_counter() - before)
+    if len(times) == 1:
+        responded = time.perf_counter()
+# The moves' log lines go out before the results, which have to be the last line.
+server.logger.flush()
+print(json.dumps({
+    'import': (imported - started) * 1000,
+    'boot': (booted - imported) * 1000,
+    'first_response': (responded - started) * 1000,
+    'moves': [x * 1000 for x in times],
+}))
+'''
+
+def is_game_recording(path: str) -> bool:
+    '''
+    Use this function to tell game recordings of server_recorder.py apart from a JSON lines file.
+
+    return: True if 'path' is a game recording or a folder of them.
+    '''
+
+    return os.path.isdir(path) or path.endswith('.snkrec')
+
+def muted():
+    '''
+    Use this function around code whose logging isn't worth seeing.
+
+    Nothing from the tree being measured is imported until the benchmark runs in it, and revisions from
+    before server_log.py printed instead, so their output is swallowed.
+    '''
+
+    try:
+        from server_log import logger
+    except ImportError:
+        return contextlib.redirect_stdout(io.StringIO())
+
+    return logger.muted()
+
+def read_requests(path: str, limit: int = None):
+    '''
+    Use this function to stream the move requests out of a recording.
+
+    path: A JSON lines file, or a game recording of server_recorder.py or a folder of them.
+
+    return: An iterator of move request dictionaries.
+    '''
+
+    if is_game_recording(path):
+        import server_recorder
+
+        yield from server_recorder.read_requests(path, limit)
+        return
+
+    with open(path) as f:
+        for i, line in enumerate(f):
+            if limit is not None and i >= limit:
+                break
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+def read_timed_requests(path: str, limit: int = None):
+    '''
+    Use this function to stream the move requests of a recording the way they are timed.
+
+    Each request is given no timeout, the way record_game() records them, so the search stops after its shortest
+    budget. Otherwise every move would take the game's whole time budget and the timings would only measure that.
+
+    return: An iterator of move request dictionaries.
+    '''
+
+    for data in read_requests(path, limit):
+        data['game']['timeout'] = 0
+        yield data
+
+def summarize(times: list) -> dict:
+    '''
+    Use this function to get the latency percentiles of a list of timings.
+
+    times: Timings in seconds.
+
+    return: A dictionary of p50, p95, p99 and max, in milliseconds.
+    '''
+
+    if not times:
+        return {}
+
+    times = sorted(times)
+    summary = {}
+    for percentile in PERCENTILES:
+        index = min(len(times) - 1, int(len(times) * percentile / 100))
+        summary[f'p{percentile}'] = times[index] * 1000
+    summary['max'] = times[-1] * 1000
+    summary['count'] = len(times)
+
+    return summary
+
+def time_choose_move(path: str, limit: int = None) -> list:
+    '''
+    Use this function to time choose_move on every request of a recording.
+
+    return: A list of timings in seconds.
+    '''
+
+    import server_logic
+
+    times = []
+    for data in read_timed_requests(path, limit):
+        started = time.perf_counter()
+        server_logic.choose_move(data)
+        times.append(time.perf_counter() - started)
+
+    return times
+
+def time_flask(path: str, limit: int = None) -> list:
+    '''
+    Use this function to time the whole /move request path, from the raw request body to the response body.
+
+    A /start is sent the first time each game is seen, so the game sessions are used the way they are in a real game.
+
+    return: A list of timings in seconds.
+    '''
+
+    import server
+
+    client = server.app.test_client()
+    started_games = set()
+    times = []
+    for data in read_timed_requests(path, limit):
+        body = json.dumps(data)
+        if data['game']['id'] not in started_games:
+            started_games.add(data['game']['id'])
+            client.post('/start', data=body, content_type='application/json')
+
+        started = time.perf_counter()
+        client.post('/move', data=body, content_type='application/json')
+        times.append(time.perf_counter() - started)
+
+    return times
+
+def measure_allocations(path: str, limit: int = None) -> dict:
+    '''
+    Use this function to measure how much memory choose_move allocates for each request.
+
+    return: A dictionary of the mean and max peak bytes allocated per move.
+    '''
+
+    import server_logic
+
+    peaks = []
+    tracemalloc.start()
+    try:
+        for data in read_timed_requests(path, limit):
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            server_logic.choose_move(data)
+            _, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - before)
+    finally:
+        tracemalloc.stop()
+
+    if not peaks:
+        return {}
+
+    return {'mean': sum(peaks) / len(peaks), 'max': max(peaks)}
+
+def profile(path: str, limit: int = None, top: int = 20) -> str:
+    '''
+    Use this function to find which functions choose_move spends its time in.
+
+    return: The profile report, sorted by the time spent in each function itself.
+    '''
+
+    import server_logic
+
+    profiler = cProfile.Profile()
+    for data in read_timed_requests(path, limit):
+        profiler.enable()
+        server_logic.choose_move(data)
+        profiler.disable()
+
+    report = io.StringIO()
+    pstats.Stats(profiler, stream=report).sort_stats('tottime').print_stats(top)
+
+    return report.getvalue()
+
+def record_game(path: str, width: int = 11, height: int = 11, moves: int = STARTUP_MOVES):
+    '''
+    Use this function to record the move requests of one solo game of choose_move, for measure_startup() to replay.
+
+    The requests have no timeout, so every move is searched for as short a time as possible, and what is
+    measured is the work around the search.
+    '''
+
+    import server_logic
+    import server_simulator
+
+    with open(path, 'w') as f:
+        def strategy(data: dict) -> str:
+            data['game']['timeout'] = 0
+            f.write(json.dumps(data) + '\n')
+            return server_logic.choose_move(data)
+
+        with muted():
+            server_simulator.play_game({'you': strategy}, width, height, seed=0, max_turns=moves)
+
+def measure_startup(warm_up: bool = True, width: int = 11, height: int = 11) -> dict:
+    '''
+    Use this function to measure how long a fresh server takes to import, boot and answer its moves.
+
+    The server is imported in a new interpreter and plays a recorded game through the Flask /move route.
+
+    return: A dictionary of the import, boot and first response times, and the time of the first, hundredth
+    and median move, all in milliseconds.
+    '''
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'game.jsonl')
+        record_game(path, width, height)
+        output = subprocess.run(
+            [sys.executable, '-c', _STARTUP_SCRIPT, path, 'warm' if warm_up else 'cold'],
+            cwd=here, check=True, capture_output=True, text=True,
+        ).stdout
+
+    # Anything printed while the moves were picked comes first, the results are the last line.
+    results = json.loads(output.strip().splitlines()[-1])
+    moves = results.pop('moves')
+    results['first_move'] = moves[0]
+    results['last_move'] = moves[-1]
+    results['median_move'] = sorted(moves)[len(moves) // 2]
+    results['moves'] = len(moves)
+
+    return results
+
+def run(args) -> dict:
+    '''
+    Use this function to run every benchmark that was asked for.
+
+    return: The results, keyed by benchmark.
+    '''
+
+    results = {}
+
+    # choose_move logs every move, which isn't worth seeing here.
+    with muted():
+        results['choose_move'] = summarize(time_choose_move(args.recording, args.limit))
+        if args.flask:
+            results['flask'] = summarize(time_flask(args.recording, args.limit))
+        if args.allocations:
+            results['allocations'] = measure_allocations(args.recording, args.limit)
+        if args.profile:
+            results['profile'] = profile(args.recording, args.limit)
+
+    return results
+
+def compare(before: dict, after: dict, threshold: float = THRESHOLD) -> list:
+    '''
+    Use this function to find every latency that got slower between two sets of results.
+
+    return: A list of messages, one for every regression.
+    '''
+
+    regressions = []
+    for name in ('choose_move', 'flask'):
+        for key in [f'p{x}' for x in PERCENTILES]:
+            old = before.get(name, {}).get(key)
+            new = after.get(name, {}).get(key)
+            if old is None or new is None:
+                continue
+            if new > old * (1 + threshold):
+                regressions.append(f'{name} {key} went from {old:.2f}ms to {new:.2f}ms')
+
+    return regressions
+
+def run_revision(revision: str, args) -> dict:
+    '''
+    Use this function to run the benchmark on another revision, checked out into a temporary worktree.
+
+    This file is run from where it is, so revisions from before the benchmark existed can still be measured.
+
+    return: The results from the other revision.
+    '''
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as folder:
+        tree = os.path.join(folder, 'tree')
+        output = os.path.join(folder, 'results.json')
+        subprocess.run(['git', 'worktree', 'add', '--detach', tree, revision], cwd=here, check=True, capture_output=True)
+        try:
+            # Older revisions can't read game recordings, and may time requests with their timeout, so they are given
+            # the requests as JSON lines with no timeout.
+            recording = os.path.join(folder, 'moves.jsonl')
+            with open(recording, 'w') as f:
+                for data in read_timed_requests(args.recording, args.limit):
+                    f.write(json.dumps(data) + '\n')
+            command = [sys.executable, os.path.abspath(__file__), recording, '--tree', tree, '--output', output]
+            if args.limit is not None:
+                command += ['--limit', str(args.limit)]
+            if args.flask:
+                command.append('--flask')
+            subprocess.run(command, check=True)
+            with open(output) as f:
+                return json.load(f)
+        finally:
+            subprocess.run(['git', 'worktree', 'remove', '--force', tree], cwd=here, check=True, capture_output=True)
+
+def print_results(results: dict):
+    for name in ('choose_move', 'flask'):
+        summary = results.get(name)
+        if summary:
+            print(f"{name}: " + ', '.join(f'{k} {v:.2f}ms' for k, v in summary.items() if k != 'count') + f" over {summary['count']} moves")
+    allocations = results.get('allocations')
+    if allocations:
+        print(f"allocated per move: mean {allocations['mean'] / 1024:.1f}KiB, max {allocations['max'] / 1024:.1f}KiB")
+    if results.get('profile'):
+        print(results['profile'])
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay recorded move requests and measure how long they take.')
+    parser.add_argument('recording', nargs='?', help='a JSON lines file of move requests, or game recordings')
+    parser.add_argument('--limit', type=int, help='only replay this many requests')
+    parser.add_argument('--flask', action='store_true', help='also time the whole Flask request path')
+    parser.add_argument('--allocations', action='store_true', help='also measure memory allocated per move')
+    parser.add_argument('--profile', action='store_true', help='also break the time down by function')
+    parser.add_argument('--output', help='save the results as JSON')
+    parser.add_argument('--compare', help='compare against results saved with --output')
+    parser.add_argument('--against', help='compare against another git revision')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD)
+    parser.add_argument('--startup', action='store_true', help='measure how long a fresh server takes to answer its first moves')
+    parser.add_argument('--tree', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.startup:
+        for warm_up in (False, True):
+            results = measure_startup(warm_up)
+            print(
+                f"{'with' if warm_up else 'without'} warm up: import {results['import']:.0f}ms, boot {results['boot']:.0f}ms, "
+                f"first response {results['first_response']:.0f}ms, first move {results['first_move']:.2f}ms, "
+                f"move {results['moves']} {results['last_move']:.2f}ms, median move {results['median_move']:.2f}ms"
+            )
+        return
+    if args.recording is None:
+        parser.error('a recording is needed unless --startup is given')
+
+    # The tree takes the place of this file's folder, so a module the revision doesn't have is never found here instead.
+    if args.tree:
+        sys.path[0] = args.tree
+        os.chdir(args.tree)
+
+    before = None
+    if args.against:
+        before = run_revision(args.against, args)
+    elif args.compare:
+        with open(args.compare) as f:
+            before = json.load(f)
+
+    results = run(args)
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if before is not None:
+        regressions = compare(before, results, args.threshold)
+        for message in regressions:
+            print(f'REGRESSION: {message}')
+        if regressions:
+            sys.exit(1)
+        print('No regressions.')
+
+if __name__ == '__main__':
+    main()
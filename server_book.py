@@ -0,0 +1,267 @@
+import argparse
+import bisect
+import itertools
+import mmap
+import os
+import random
+import struct
+import time
+from array import array
+from functools import lru_cache
+
+from server_models import MOVES, Grid, Move
+from server_rules import Position, SnakeState, advance, get_default_move
+from server_search import find_best_move
+from server_table import TranspositionTable, get_hash
+
+"""
+This file keeps an opening book: the best move of early positions of standard games, searched deeply ahead of time.
+
+Standard games start from a few fixed layouts, so the first turns of most games are positions that have
+been seen before. The book is built once with this file, then choose_move looks each early position up
+in it before searching:
+
+    python server_book.py --output book.bin --sizes 7x7 11x11 19x19 --snakes 2 4
+
+Positions are keyed by a canonical hash, so a position is found whatever the snake ids are, and whichever
+way round the board is: our snake is always the first slot, the opponents are in the order of their
+bodies, and of the 8 ways to turn and flip the board (4 when it isn't square) the one with the lowest
+hash is used. The book stores the move as it is on that board, and it is turned back for the real one.
+
+The file is a header, then the sorted keys, the scores, the moves and the depths, each as an array.
+It is memory mapped and looked up with a binary search in place, so nothing is read until it is used.
+"""
+
+MAGIC = b'SNKBOOK1'
+
+# The magic, the number of positions and the last turn in the book. Padded so the keys are 8 byte aligned.
+HEADER = struct.Struct('<8sIH2x')
+
+# The rulesets the book was searched with.
+BOOK_RULESETS = {'standard', 'duel'}
+
+# Where the book is looked for, unless OPENING_BOOK says otherwise.
+BOOK_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'book.bin')
+
+# How each move steps through x and y.
+_DIRECTIONS = {Move.up: (0, 1), Move.down: (0, -1), Move.left: (-1, 0), Move.right: (1, 0)}
+
+# The ways to turn and flip a board, as the matrix (a, b, c, d) that maps x, y to a*x + b*y, c*x + d*y.
+# The last 4 swap x and y, so only fit square boards.
+_MATRICES = (
+    (1, 0, 0, 1), (-1, 0, 0, 1), (1, 0, 0, -1), (-1, 0, 0, -1),
+    (0, 1, 1, 0), (0, -1, 1, 0), (0, 1, -1, 0), (0, -1, -1, 0),
+)
+
+class Symmetry:
+    def __init__(self, grid: Grid, matrix: tuple):
+        a, b, c, d = matrix
+        width, height = grid.width, grid.height
+
+        def transform(x: int, y: int) -> tuple:
+            # Anything flipped is shifted back onto the board.
+            return (
+                a * x + b * y + (width - 1 if a + b < 0 else 0),
+                c * x + d * y + (height - 1 if c + d < 0 else 0),
+            )
+
+        # The cell every cell is moved to.
+        self.cells: tuple = tuple(grid.index(*transform(*grid.xy(x))) for x in range(grid.size))
+
+        # The move every move turns into, and back.
+        steps = {v: k for k, v in _DIRECTIONS.items()}
+        self.moves: dict = {k: steps[(a * dx + b * dy, c * dx + d * dy)] for k, (dx, dy) in _DIRECTIONS.items()}
+        self.inverse: dict = {v: k for k, v in self.moves.items()}
+
+@lru_cache(maxsize=None)
+def get_symmetries(grid: Grid) -> tuple:
+    '''
+    Use this function to get every way a board can be turned and flipped onto itself.
+
+    return: A tuple of Symmetry, the identity first.
+    '''
+
+    matrices = _MATRICES if grid.width == grid.height else _MATRICES[:4]
+
+    return tuple(Symmetry(grid, x) for x in matrices)
+
+def get_canonical_key(position: Position, you: str) -> tuple:
+    '''
+    Use this function to get the key of a position in the book.
+
+    return: A tuple of the key and the Symmetry it was found with, or None if our snake isn't in the position.
+    '''
+
+    me = position.get_snake(you)
+    if me is None:
+        return None
+
+    grid = position.grid
+    best = None
+    for symmetry in get_symmetries(grid):
+        cells = symmetry.cells
+        snakes = [SnakeState(x.id, tuple(cells[c] for c in x.body), x.health) for x in position.snakes]
+        # We are always the first slot, and the opponents are ordered by where they are, not by id.
+        ordered = [x for x in snakes if x.id == you] + sorted((x for x in snakes if x.id != you), key=lambda x: x.body)
+        slots = {x.id: i for i, x in enumerate(ordered)}
+        food = grid.mask(cells[x] for x in grid.cells(position.food))
+
+        key = get_hash(Position(grid, tuple(ordered), food), slots)
+        if best is None or key < best[0]:
+            best = (key, symmetry)
+
+    return best
+
+class OpeningBook:
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, count, self.max_turn = HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not an opening book')
+
+        # Views straight onto the file, in the byte order of the machine, which like the file is little endian.
+        view = memoryview(self._map)
+        start = HEADER.size
+        self._keys = view[start:start + 8 * count].cast('Q')
+        start += 8 * count
+        self._scores = view[start:start + 4 * count].cast('i')
+        start += 4 * count
+        self._moves = view[start:start + count]
+        start += count
+        self._depths = view[start:start + count]
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def probe(self, position: Position, you: str) -> tuple:
+        '''
+        Use this function to look up our move in a position.
+
+        return: A tuple of the move, its score and the depth it was searched to, or None if the position isn't in the book.
+        '''
+
+        # The book was searched without hazards.
+        if position.turn > self.max_turn or position.hazards:
+            return None
+
+        canonical = get_canonical_key(position, you)
+        if canonical is None:
+            return None
+        key, symmetry = canonical
+
+        index = bisect.bisect_left(self._keys, key)
+        if index == len(self._keys) or self._keys[index] != key:
+            return None
+
+        return (symmetry.inverse[MOVES[self._moves[index]]], self._scores[index], self._depths[index])
+
+def write_book(path: str, entries: dict, max_turn: int):
+    '''
+    Use this function to save an opening book.
+
+    entries: A tuple of the move, score and depth on the canonical board, keyed by canonical key.
+    max_turn: The last turn of the positions in the book.
+    '''
+
+    keys = sorted(entries)
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(keys), max_turn))
+        f.write(array('Q', keys).tobytes())
+        f.write(array('i', (entries[x][1] for x in keys)).tobytes())
+        f.write(bytes(MOVES.index(entries[x][0]) for x in keys))
+        f.write(bytes(min(entries[x][2], 255) for x in keys))
+
+@lru_cache(maxsize=None)
+def open_book(path: str) -> OpeningBook:
+    '''
+    Use this function to open the book at 'path' once, and share it.
+
+    return: The OpeningBook, or None if there isn't one.
+    '''
+
+    if not os.path.exists(path):
+        return None
+
+    return OpeningBook(path)
+
+def get_book(game: dict) -> OpeningBook:
+    '''
+    Use this function to get the opening book for a game.
+
+    return: The OpeningBook, or None if there isn't one or the game isn't played by the rules it was built for.
+    '''
+
+    if (game.get('ruleset') or {}).get('name', 'standard') not in BOOK_RULESETS:
+        return None
+
+    return open_book(os.environ.get('OPENING_BOOK', BOOK_PATH))
+
+def build_book(sizes: list, snake_counts: list, starts: int, turns: int, seconds: float, seed: int = 0, log=None) -> dict:
+    '''
+    Use this function to search every early position of some standard games.
+
+    Games are started the way the engine starts them, then every move of every snake is played out for 'turns'
+    turns. Food that spawns during those turns can't be known ahead, so it isn't.
+
+    starts: How many start positions to play out for each board size and snake count.
+    seconds: How long to search each position for.
+    log: If given, called with a message as the book grows.
+
+    return: The entries for write_book().
+    '''
+
+    import server_simulator
+
+    entries = {}
+    for (width, height), count in itertools.product(sizes, snake_counts):
+        rng = random.Random(seed)
+        ids = [f'snake-{i}' for i in range(count)]
+        for _ in range(starts):
+            table = TranspositionTable(64 * 1024 * 1024)
+            frontier = [server_simulator.get_start_position(width, height, ids, rng)]
+            for turn in range(turns + 1):
+                following = {}
+                for position in frontier:
+                    for snake in position.snakes:
+                        key, symmetry = get_canonical_key(position, snake.id)
+                        if key in entries:
+                            continue
+                        table.new_turn()
+                        result = find_best_move(position, snake.id, time.perf_counter() + seconds, position.get_moves(snake) or [Move.up], table)
+                        if result is not None:
+                            move, score, depth = result
+                            entries[key] = (symmetry.moves[move], max(min(int(score), 2 ** 31 - 1), -2 ** 31), depth)
+
+                    if turn == turns or len(position.snakes) < min(count, 2):
+                        continue
+                    # Every combination of moves, each position kept once.
+                    choices = [position.get_moves(x) or [get_default_move(position, x)] for x in position.snakes]
+                    for replies in itertools.product(*choices):
+                        after = advance(position, {x.id: move for x, move in zip(position.snakes, replies)})
+                        following.setdefault(get_hash(after, {x: i for i, x in enumerate(ids)}), after)
+                frontier = list(following.values())
+            if log is not None:
+                log(f'{width}x{height} with {count} snakes: {len(entries)} positions')
+
+    return entries
+
+def main():
+    parser = argparse.ArgumentParser(description='Search the early positions of standard games into an opening book.')
+    parser.add_argument('--output', default=BOOK_PATH, help='where to save the book')
+    parser.add_argument('--sizes', nargs='+', default=['7x7', '11x11', '19x19'], help='board sizes, as WIDTHxHEIGHT')
+    parser.add_argument('--snakes', nargs='+', type=int, default=[2, 4], help='snake counts')
+    parser.add_argument('--starts', type=int, default=20, help='start positions for each size and snake count')
+    parser.add_argument('--turns', type=int, default=2, help='how many turns of each start to play out')
+    parser.add_argument('--time', type=float, default=0.5, help='seconds to search each position for')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    sizes = [tuple(int(x) for x in size.split('x')) for size in args.sizes]
+    entries = build_book(sizes, args.snakes, args.starts, args.turns, args.time, args.seed, log=print)
+    write_book(args.output, entries, args.turns)
+    print(f'Saved {len(entries)} positions to {args.output}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+import json
+
+"""
+This file decodes and encodes the JSON bodies of requests and responses.
+
+A move request is mostly coordinates, and decoding each of them into its own {'x', 'y'} dict only for
+Board and Snake to turn it into a cell index is a big part of answering a move on a large board.
+parse_move_request() cuts the coordinates out of the request bytes and reads them all at once with NumPy
+instead, and only decodes the rest of the request, which is small, as JSON. The coordinates are handed on
+as tuples of cell indexes with their bitmasks, under keys Board and Snake read before the usual ones:
+
+    board['food']     -> board['food_cells'], board['food_mask']
+    board['hazards']  -> board['hazard_cells'], board['hazard_mask']
+    snake['body']     -> snake['body_cells'], snake['body_mask']
+    snake['head']     -> snake['head_cell']
+
+Anything the fast path doesn't recognise, like whitespace inside a coordinate, is decoded the usual way.
+"""
+
+try:
+    import orjson
+
+    def loads(body: bytes):
+        return orjson.loads(body)
+
+    def dumps(value) -> bytes:
+        return orjson.dumps(value)
+except ImportError:
+    def loads(body: bytes):
+        return json.loads(body)
+
+    def dumps(value) -> bytes:
+        return json.dumps(value, separators=(',', ':')).encode()
+
+# The keys of every list of coordinates, and of every head, with the character that opens their values.
+_COORDINATES = (b'"food":[', b'"hazards":[', b'"body":[', b'"head":{')
+
+_CLOSE = {ord('['): b']', ord('{'): b'}'}
+
+# Everything in a list of coordinates that isn't a number or a comma.
+_PUNCTUATION = b'[]{}"xy:'
+
+# Smaller requests are decoded the usual way, the fast path only pays for itself once there are enough
+# coordinates. It breaks even at about 5KB, a crowded 19x19 board, and is a quarter faster by 8KB.
+MIN_COMPACT_SIZE = 6144
+
+def _find_coordinates(body: bytes) -> list:
+    '''
+    Use this function to find every list of coordinates, and every head, in a request.
+
+    return: A sorted list of the index of the first and last character of each value.
+    '''
+
+    spans = []
+    for key in _COORDINATES:
+        close = _CLOSE[key[-1]]
+        index = body.find(key)
+        while index >= 0:
+            start = index + len(key) - 1
+            end = body.find(close, start)
+            if end < 0:
+                return None
+            spans.append((start, end))
+            index = body.find(key, end)
+    spans.sort()
+
+    return spans
+
+def _parse_compact(body: bytes) -> dict:
+    '''
+    Use this function to decode a move request with its coordinates read as cell indexes.
+
+    return: The move request, or None if it isn't laid out the way the fast path expects.
+    '''
+
+    import numpy as np
+
+    spans = _find_coordinates(body)
+    if spans is None:
+        return None
+
+    # Cut every list of coordinates out of the body, leaving the number of the list in its place.
+    pieces = []
+    values = []
+    counts = []
+    position = 0
+    for start, end in spans:
+        if start < position:
+            return None
+        value = body[start:end + 1]
+        # Every coordinate has to be written x first, or the numbers would be read the wrong way round.
+        count = value.count(b'{"x":')
+        if value.count(b',"y":') != count or value.count(b'{') != count:
+            return None
+        if count:
+            values.append(value)
+        counts.append(count)
+        pieces.append(body[position:start])
+        pieces.append(str(len(counts) - 1).encode())
+        position = end + 1
+    pieces.append(body[position:])
+
+    data = loads(b''.join(pieces))
+    board = data.get('board')
+    if not isinstance(board, dict):
+        return None
+    width = board.get('width')
+    height = board.get('height')
+    if not isinstance(width, int) or not isinstance(height, int):
+        return None
+
+    # Every x and y, in order, is read in one go.
+    total = sum(counts)
+    numbers = np.zeros(0, dtype=np.int64)
+    if total:
+        numbers = np.fromstring(b','.join(values).translate(None, _PUNCTUATION), dtype=np.int64, sep=',')
+    if len(numbers) != total * 2:
+        return None
+    xs = numbers[0::2]
+    ys = numbers[1::2]
+    if total and (xs.min() < 0 or ys.min() < 0 or xs.max() >= width or ys.max() >= height):
+        return None
+    cells = ys * width + xs
+
+    # The bitmask of every list is built at once, by setting its cells in a row of bits and packing the row.
+    groups = np.repeat(np.arange(len(counts)), counts)
+    bits = np.zeros((len(counts), width * height), dtype=bool)
+    bits[groups, cells] = True
+    packed = np.packbits(bits, axis=1, bitorder='little')
+    masks = [int.from_bytes(x.tobytes(), 'little') for x in packed]
+
+    cells = cells.tolist()
+    offsets = [0]
+    for count in counts:
+        offsets.append(offsets[-1] + count)
+
+    def take(container: dict, key: str, cells_key: str, mask_key: str = None) -> bool:
+        index = container.pop(key, None)
+        if index is None:
+            return True
+        if type(index) is not int or index >= len(counts):
+            return False
+        if mask_key is None:
+            if counts[index] != 1:
+                return False
+            container[cells_key] = cells[offsets[index]]
+        else:
+            container[cells_key] = tuple(cells[offsets[index]:offsets[index + 1]])
+            container[mask_key] = masks[index]
+        return True
+
+    if not take(board, 'food', 'food_cells', 'food_mask') or not take(board, 'hazards', 'hazard_cells', 'hazard_mask'):
+        return None
+
+    snakes = list(board.get('snakes', ()))
+    if isinstance(data.get('you'), dict):
+        snakes.append(data['you'])
+    for snake in snakes:
+        if not take(snake, 'body', 'body_cells', 'body_mask') or not take(snake, 'head', 'head_cell'):
+            return None
+
+    return data
+
+def parse_move_request(body: bytes, min_size: int = MIN_COMPACT_SIZE) -> dict:
+    '''
+    Use this function to decode the body of a move request.
+
+    min_size: Only requests of at least this many bytes are read with the fast path.
+
+    return: The move request, with its coordinates as cell indexes when the fast path could read them.
+    '''
+
+    data = None
+    if len(body) >= min_size:
+        try:
+            data = _parse_compact(body)
+        except (ValueError, TypeError, KeyError, IndexError):
+            data = None
+
+    if data is None:
+        return loads(body)
+
+    return data
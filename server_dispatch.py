@@ -0,0 +1,407 @@
+import asyncio
+import contextlib
+import itertools
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.routing import Route
+
+import server
+import server_codec
+import server_logic
+import server_mcts
+import server_metrics
+import server_opponents
+import server_recorder
+from server_log import logger
+from server_codec import dumps, loads
+
+"""
+This file serves the routes of server_asgi.py from several worker processes, with every game pinned to one worker.
+
+With plain uvicorn workers, each request of a game goes to whichever worker accepts it, and the game's
+session (the incremental board and the transposition table) is only on one of them. Here a single front
+process accepts every request and hashes the game id to pick the worker, which gets the raw request body
+over a pipe. The front only reads the game id, everything else is done by the worker that owns the game.
+
+    python server_dispatch.py
+
+GAME_WORKERS sets the number of worker processes (default one per core), and MOVE_THREADS the threads each
+of them picks moves on (default 8).
+"""
+
+# Where the game id is in a request body, so it can be read without decoding the rest.
+_GAME_ID = b'"game":{"id":"'
+
+def get_game_id(body: bytes) -> str:
+    '''
+    Use this function to read the game id of a request body.
+
+    return: The game id, or None if the request doesn't have one.
+    '''
+
+    start = body.find(_GAME_ID)
+    if start >= 0:
+        start += len(_GAME_ID)
+        end = body.find(b'"', start)
+        # An escaped quote means the id needs decoding properly.
+        if end >= 0 and body[end - 1] != ord('\\'):
+            return body[start:end].decode()
+
+    game = loads(body).get('game') or {}
+
+    return game.get('id')
+
+def get_worker_index(game_id: str, workers: int) -> int:
+    '''
+    Use this function to pick the worker that owns a game.
+
+    A CRC rather than hash(), so a game keeps its worker whatever process works it out.
+
+    return: The index of the worker.
+    '''
+
+    if game_id is None:
+        return 0
+
+    return zlib.crc32(game_id.encode()) % workers
+
+def handle(route: str, body: bytes, arrived: float = None, fallback: bool = False) -> tuple:
+    '''
+    Use this function in a worker process to answer one request the front has passed on.
+
+    arrived: The time.perf_counter() at which the front got the request. It is the same clock in every
+    process, so the move's deadline counts the time it spent getting here.
+    fallback: Answer a move straight away with server_logic.get_fallback_move(), rather than searching.
+
+    return: A tuple of the status code and the response body, or for /metrics the series of the worker's histograms.
+    '''
+
+    if route == '/move':
+        timings = server_metrics.RequestTimings(arrived)
+        data = server_codec.parse_move_request(body)
+        timings.lap('decode')
+
+        if fallback:
+            move = server_logic.get_fallback_move(data)
+            logger.info("move_fallback", game=data['game']['id'], turn=data['turn'], move=move)
+            server_recorder.recorder.move(data, move, None, (time.perf_counter() - timings.started) * 1000)
+        else:
+            move = server.get_move(data, timings)
+
+        content = dumps({'move': move})
+        timings.lap('encode')
+        server_metrics.record(data, timings)
+
+        return (200, content)
+
+    if route == '/start':
+        data = loads(body)
+        server.sessions.start(data)
+        server_recorder.recorder.start(data)
+        logger.info("start", game=data['game']['id'])
+        return (200, b'ok')
+
+    if route == '/end':
+        data = loads(body)
+        server.sessions.end(data)
+        server_opponents.model.save()
+        server_recorder.recorder.end(data)
+        logger.info("end", game=data['game']['id'])
+        return (200, b'ok')
+
+    if route == '/metrics':
+        return (200, server_metrics.get_series())
+
+    return (404, b'')
+
+def run_worker(connection, workers: int):
+    '''
+    The main loop of a worker process, which answers the requests the front sends it until the pipe closes.
+
+    Requests are answered on a thread pool, so several games can be picked for at once, and every answer
+    is sent back with the number of its request.
+    '''
+
+    # The cores are shared out between the workers.
+    if "mcts" in server_logic.get_configured_strategies():
+        server_mcts.start_pool(int(os.environ.get("MCTS_WORKERS", "0")) or max(1, (os.cpu_count() or 1) // workers))
+    server_logic.warm_up()
+
+    threads = int(os.environ.get("MOVE_THREADS", "8"))
+    executor = ThreadPoolExecutor(max_workers=threads)
+    lock = threading.Lock()
+    # How many moves are being picked on the pool.
+    picking = 0
+
+    def answer(number: int, route: str, body: bytes, arrived: float, fallback: bool = False):
+        nonlocal picking
+
+        try:
+            status, content = handle(route, body, arrived, fallback)
+        except Exception:
+            logger.error("request_failed", route=route, error=traceback.format_exc())
+            status, content = 500, b''
+        with lock:
+            connection.send((number, status, content))
+            if route == '/move' and not fallback:
+                picking -= 1
+            idle = picking == 0
+        # The next turn is only pondered once the answer has gone, so it never holds the answer up, and only
+        # if no other move is being picked, so it doesn't take the time that move needs.
+        if route == '/move' and status == 200 and not fallback and idle:
+            server.sessions.start_ponder(get_game_id(body))
+
+    # Tell the front the worker is ready.
+    connection.send(None)
+
+    while True:
+        try:
+            message = connection.recv()
+        except (EOFError, OSError):
+            break
+        # The front sends None when it is shutting down.
+        if message is None:
+            break
+        if message[1] == '/move':
+            with lock:
+                busy = picking >= threads
+                if not busy:
+                    picking += 1
+            # A move that waited for a thread would use up its timeout waiting, so once every thread is busy it is answered straight away.
+            if busy:
+                answer(*message, fallback=True)
+                continue
+        executor.submit(answer, *message)
+
+    executor.shutdown()
+    server_mcts.stop_pool()
+    connection.close()
+
+class Worker:
+    def __init__(self, index: int, workers: int):
+        self.index = index
+        self.workers = workers
+        self.numbers = itertools.count()
+
+        # The requests that have been sent and not answered yet, keyed by number, with the loop waiting on each.
+        self.pending: dict = {}
+        self.lock = threading.Lock()
+
+        # Set while the worker is being started again after it died, done once it is ready.
+        self.restarting: asyncio.Future = None
+
+        self.start()
+
+    def start(self):
+        '''
+        Use this function to start the worker process, and the thread that reads its answers.
+        '''
+
+        # Spawned rather than forked, since the front already has threads running.
+        context = multiprocessing.get_context('spawn')
+        self.connection, child = context.Pipe()
+        self.process = context.Process(target=run_worker, args=(child, self.workers), daemon=True)
+        self.process.start()
+        child.close()
+
+        # Wait until the worker has booted, so no request waits on its warm up.
+        self.connection.recv()
+
+        self.reader = threading.Thread(target=self.read, daemon=True)
+        self.reader.start()
+
+    def read(self):
+        '''
+        The reader thread, which hands every answer to the request waiting for it.
+        '''
+
+        connection = self.connection
+        while True:
+            try:
+                number, status, content = connection.recv()
+            except (EOFError, OSError):
+                break
+            with self.lock:
+                waiting = self.pending.pop(number, None)
+            if waiting is not None:
+                loop, future = waiting
+                loop.call_soon_threadsafe(_resolve, future, (status, content))
+
+        # The worker has gone, so nothing that was sent to it will be answered.
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        for loop, future in pending.values():
+            loop.call_soon_threadsafe(_resolve, future, (503, b''))
+
+    async def request(self, route: str, body: bytes, arrived: float = None) -> tuple:
+        '''
+        Use this function to have the worker answer a request.
+
+        arrived: The time.perf_counter() at which the request came in, defaults to now.
+
+        return: A tuple of the status code and the response body.
+        '''
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        number = next(self.numbers)
+        with self.lock:
+            self.pending[number] = (loop, future)
+            self.connection.send((number, route, body, time.perf_counter() if arrived is None else arrived))
+
+        return await future
+
+    def stop(self):
+        '''
+        Use this function to shut the worker down, once it has answered what it was sent.
+        '''
+
+        # Closing the pipe here wouldn't wake the reader thread up, so the worker is asked to close its end instead.
+        with self.lock:
+            try:
+                self.connection.send(None)
+            except OSError:
+                pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.reader.join(timeout=1)
+        self.connection.close()
+
+def _resolve(future: asyncio.Future, result: tuple):
+    if not future.done():
+        future.set_result(result)
+
+class Dispatcher:
+    def __init__(self, workers: int = None):
+        '''
+        workers: How many worker processes to start, defaults to one per core.
+        '''
+
+        count = workers or os.cpu_count() or 1
+        self.workers = [Worker(i, count) for i in range(count)]
+
+    def get_worker(self, body: bytes) -> Worker:
+        '''
+        Use this function to find the worker that owns the game of a request.
+
+        return: The Worker.
+        '''
+
+        return self.workers[get_worker_index(get_game_id(body), len(self.workers))]
+
+    async def request(self, route: str, body: bytes, arrived: float = None) -> tuple:
+        '''
+        Use this function to pass a request on to the worker that owns its game.
+
+        A worker that has died is started again in the background, since it takes a while to boot. Until it is
+        ready its games are answered by another worker, and they start new sessions on it. Once it is back
+        they start new sessions on their own worker again.
+
+        arrived: The time.perf_counter() at which the request came in, defaults to when it is sent on.
+
+        return: A tuple of the status code and the response body.
+        '''
+
+        worker = self.get_worker(body)
+        if worker.restarting is None and not worker.process.is_alive():
+            self.restart(worker)
+
+        if worker.restarting is not None:
+            standby = next((x for x in self.workers if x.restarting is None and x.process.is_alive()), None)
+            if standby is not None:
+                worker = standby
+            else:
+                # Every worker is down, so there is nothing to do but wait.
+                await asyncio.shield(worker.restarting)
+
+        return await worker.request(route, body, arrived)
+
+    def restart(self, worker: Worker):
+        '''
+        Use this function to start a worker that has died again, off the event loop so no other game waits for it.
+        '''
+
+        def restarted(future: asyncio.Future):
+            worker.restarting = None
+            if not future.cancelled() and future.exception() is not None:
+                logger.error("worker_restart_failed", worker=worker.index, error=repr(future.exception()))
+
+        worker.restarting = asyncio.get_running_loop().run_in_executor(None, worker.start)
+        worker.restarting.add_done_callback(restarted)
+
+    async def get_metrics(self) -> str:
+        '''
+        Use this function to get the metrics of every worker, added together.
+
+        return: The metrics in the Prometheus text format.
+        '''
+
+        answers = await asyncio.gather(*(x.request('/metrics', b'') for x in self.workers))
+
+        return server_metrics.render([content for status, content in answers if status == 200])
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+
+dispatcher: Dispatcher = None
+
+async def handle_info(request: Request) -> Response:
+    return Response(dumps(server.handle_info()), media_type="application/json")
+
+async def handle_game(request: Request) -> Response:
+    arrived = time.perf_counter()
+    status, content = await dispatcher.request(request.url.path, await request.body(), arrived)
+    media_type = "application/json" if request.url.path == "/move" else None
+
+    return Response(content, status_code=status, media_type=media_type)
+
+async def handle_metrics(request: Request) -> Response:
+    return Response(await dispatcher.get_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    global dispatcher
+
+    workers = int(os.environ.get("GAME_WORKERS", "0")) or None
+    dispatcher = await asyncio.get_running_loop().run_in_executor(None, Dispatcher, workers)
+
+    yield
+
+    dispatcher.stop()
+    dispatcher = None
+
+app = Starlette(
+    routes=[
+        Route("/", handle_info, methods=["GET"]),
+        Route("/start", handle_game, methods=["POST"]),
+        Route("/move", handle_game, methods=["POST"]),
+        Route("/end", handle_game, methods=["POST"]),
+        Route("/metrics", handle_metrics, methods=["GET"]),
+    ],
+    lifespan=lifespan,
+)
+
+if __name__ == "__main__":
+    import uvicorn
+
+    print("Starting Battlesnake Server...")
+
+    uvicorn.run(
+        "server_dispatch:app",
+        host="0.0.0.0",
+        port=int(os.environ.get("PORT", "8080")),
+        log_level=logging.ERROR,
+        access_log=False,
+    )
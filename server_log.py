@@ -0,0 +1,184 @@
+import atexit
+import contextlib
+import os
+import random
+import sys
+import threading
+import time
+from collections import deque
+
+from server_codec import dumps
+
+"""
+This file writes the server's log as JSON lines, one record per line, from a background thread.
+
+Logging a record only appends it to a queue, the thread wakes up every so often to encode everything
+that is waiting and write it out in one go. So a slow stdout, like a log drain that is pushing back,
+holds up the thread and never a request. Each level has a queue of its own with a limit on how many
+records can wait in it. Once a queue is full new records are dropped and counted, and the count is
+written out as a 'log_dropped' record when there is room again.
+
+Per-move debug records are sampled: only LOG_DEBUG_SAMPLE of them (default 0.01) are kept, and the
+caller checks sampled() before building one, so the moves that aren't sampled don't pay for it.
+"""
+
+LEVELS = ('error', 'info', 'debug')
+
+# How many records of each level can wait to be written, set LOG_QUEUE_SIZE to change it.
+QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', '1024'))
+
+# The share of debug records that are kept.
+DEBUG_SAMPLE = float(os.environ.get('LOG_DEBUG_SAMPLE', '0.01'))
+
+# The most seconds a record waits before it is written.
+FLUSH_INTERVAL = 0.1
+
+class Logger:
+    def __init__(self, stream=None, queue_size: int = QUEUE_SIZE, sample: float = DEBUG_SAMPLE, interval: float = FLUSH_INTERVAL):
+        '''
+        stream: Where the lines are written, defaults to whatever sys.stdout is when they are.
+        queue_size: How many records of each level can wait to be written.
+        sample: The share of debug records that are kept.
+        interval: The most seconds a record waits before it is written.
+        '''
+
+        self.stream = stream
+        self.queue_size = queue_size
+        self.sample = sample
+        self.interval = interval
+
+        self._queues = {x: deque() for x in LEVELS}
+        # How many records of each level have been dropped, and how many of those have been written out as dropped.
+        self.dropped = {x: 0 for x in LEVELS}
+        self._reported = {x: 0 for x in LEVELS}
+
+        self._local = threading.local()
+        self._wake = threading.Event()
+        # Held while records are written, so a flush() never interleaves its lines with the thread's.
+        self._writing = threading.Lock()
+        self._lock = threading.Lock()
+        self._thread: threading.Thread = None
+        self._closed = False
+
+    def log(self, level: str, event: str, **fields) -> bool:
+        '''
+        Use this function to log a record, without waiting for it to be written.
+
+        fields: What else goes in the record, anything that encodes as JSON.
+
+        return: True if the record was queued, False if it was dropped.
+        '''
+
+        if getattr(self._local, 'muted', 0):
+            return False
+
+        queue = self._queues[level]
+        if len(queue) >= self.queue_size:
+            self.dropped[level] += 1
+            return False
+
+        queue.append({'time': time.time(), 'level': level, 'event': event, **fields})
+
+        if self._thread is None:
+            self._start()
+        elif len(queue) >= self.queue_size // 2:
+            # Written early, rather than waiting out the interval with the queue filling up.
+            self._wake.set()
+
+        return True
+
+    def info(self, event: str, **fields) -> bool:
+        return self.log('info', event, **fields)
+
+    def error(self, event: str, **fields) -> bool:
+        return self.log('error', event, **fields)
+
+    def debug(self, event: str, **fields) -> bool:
+        '''
+        Use this function to log a debug record, once sampled() has said to.
+        '''
+
+        return self.log('debug', event, **fields)
+
+    def sampled(self) -> bool:
+        '''
+        Use this function before building a debug record, to check if this one is kept.
+
+        return: True for a share of LOG_DEBUG_SAMPLE of the calls.
+        '''
+
+        return self.sample > 0 and random.random() < self.sample
+
+    @contextlib.contextmanager
+    def muted(self):
+        '''
+        Use this function around code whose records aren't worth keeping, nothing the thread that runs it
+        logs is queued.
+        '''
+
+        self._local.muted = getattr(self._local, 'muted', 0) + 1
+        try:
+            yield
+        finally:
+            self._local.muted -= 1
+
+    def _start(self):
+        # Started on the first record, so nothing is started in a process that never logs.
+        with self._lock:
+            if self._thread is None and not self._closed:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        '''
+        Use this function to write out every record that is waiting, it returns once they are written.
+        '''
+
+        with self._writing:
+            records = []
+            for level, queue in self._queues.items():
+                while queue:
+                    records.append(queue.popleft())
+                dropped = self.dropped[level]
+                if dropped > self._reported[level]:
+                    records.append({'time': time.time(), 'level': 'error', 'event': 'log_dropped', 'dropped_level': level, 'count': dropped - self._reported[level]})
+                    self._reported[level] = dropped
+            if not records:
+                return
+
+            records.sort(key=lambda x: x['time'])
+            lines = []
+            for record in records:
+                try:
+                    lines.append(dumps(record).decode())
+                except TypeError:
+                    lines.append(dumps({'time': record['time'], 'level': record['level'], 'event': record['event'], 'repr': repr(record)}).decode())
+
+            stream = self.stream or sys.stdout
+            try:
+                stream.write('\n'.join(lines) + '\n')
+                stream.flush()
+            except (OSError, ValueError):
+                # The stream has gone, so the records are lost.
+                self.dropped['error'] += len(lines)
+
+    def close(self):
+        '''
+        Use this function to write out what is waiting and stop the thread, when the process exits.
+        '''
+
+        self._closed = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+        self.flush()
+
+# Shared by everything the process logs.
+logger = Logger()
+atexit.register(logger.close)
@@ -1,6 +1,20 @@
+import os
 import random
+import time
 
-from server_models import Move, Board, Snake
+import server_book
+import server_codec
+import server_mcts
+import server_opponents
+import server_search
+import server_tablebase
+from server_log import logger
+from server_ponder import Ponder
+from server_metrics import RequestTimings
+from server_models import MOVES, Move, Board, Snake, get_grid, is_wrapped
+from server_rules import STANDARD, Position, Ruleset
+from server_search import get_deadline
+from server_table import get_keys
 
 """
 This file can be a nice home for your move logic, and to write helper functions.
@@ -11,6 +25,50 @@ from the list of possible moves!
 
 POSSIBLE_MOVES = {Move.up, Move.down, Move.left, Move.right}
 
+# The strategies that can pick between the safe moves.
+STRATEGIES = {'search', 'mcts'}
+DEFAULT_STRATEGY = 'search'
+
+# Set PONDER=0 to stop searching the next turn in the background while we wait for it.
+PONDER = os.environ.get('PONDER', '1') != '0'
+
+# Set OPPONENT_MODEL=0 to search every move of every opponent, however unlikely.
+OPPONENT_MODEL = os.environ.get('OPPONENT_MODEL', '1') != '0'
+
+# The board sizes of the standard game modes, which are got ready when the server boots.
+STANDARD_SIZES = ((7, 7), (11, 11), (19, 19))
+
+def get_strategy(game: dict) -> str:
+    '''
+    Returns the strategy to use for a game.
+
+    Set STRATEGY to pick the strategy for every game, or STRATEGY_<RULESET> (for example STRATEGY_ROYALE)
+    to pick it for the games of one ruleset.
+
+    return: One of STRATEGIES.
+    '''
+
+    ruleset = (game.get('ruleset') or {}).get('name') or 'standard'
+    strategy = os.environ.get(f'STRATEGY_{ruleset.upper()}', os.environ.get('STRATEGY', DEFAULT_STRATEGY))
+    if strategy not in STRATEGIES:
+        return DEFAULT_STRATEGY
+
+    return strategy
+
+def get_configured_strategies() -> set[str]:
+    '''
+    Returns every strategy that some game could be played with, so the server knows what to start at boot.
+
+    return: Set of strategies.
+    '''
+
+    strategies = {DEFAULT_STRATEGY}
+    for key, value in os.environ.items():
+        if (key == 'STRATEGY' or key.startswith('STRATEGY_')) and value in STRATEGIES:
+            strategies.add(value)
+
+    return strategies
+
 def get_deadly_moves(board: Board, snake: Snake) -> set[str]:
     '''
     Returns a set of every move that could kill the snake.
@@ -20,10 +78,7 @@ def get_deadly_moves(board: Board, snake: Snake) -> set[str]:
 
     return {
         # Don't let your Battlesnake move beyond the edges of the board.
-        board.check_top_edge(snake.head),
-        board.check_bottom_edge(snake.head),
-        board.check_left_edge(snake.head),
-        board.check_right_edge(snake.head),
+        *board.grid.edges[snake.head_cell],
 
         # Don't let your Battlesnake pick a move that would go back on itself.
         snake.get_neck_direction(),
@@ -32,39 +87,110 @@ def get_deadly_moves(board: Board, snake: Snake) -> set[str]:
         *snake.get_body_directions(),
     }
 
+def get_hazard_moves(board: Board, snake: Snake, damage: tuple) -> set[str]:
+    '''
+    Returns a set of every move into a hazard that would take the rest of the snake's health.
+
+    damage: The health lost for ending a turn in each cell, see Ruleset.get_damage().
+
+    return: Set representing the starving moves.
+    '''
+
+    directions = board.grid.directions[snake.head_cell]
+
+    return {
+        move for cell, move in directions.items()
+        # Eating in a hazard makes up for its damage.
+        if damage[cell] and snake.health - 1 - damage[cell] <= 0 and not board.has_food(cell)
+    }
+
+def get_turns_left(snake: Snake, damage: tuple) -> int:
+    '''
+    Returns how many more moves the snake can make before it runs out of health.
+
+    A snake in a hazard is counted as staying in it, so it looks for food soon enough to get out and to it.
+
+    return: The number of moves.
+    '''
+
+    return snake.health // (1 + damage[snake.head_cell])
+
 def get_food_moves(board: Board, snake: Snake) -> set[str]:
     '''
-    Returns a dictionary of moves that will navigate the snake to food.
-    
-    If there is no need for the snake to move to food, then every move is returned.
+    Returns a set of moves that will navigate the snake to food.
+
+    The moves follow the shortest path around the snakes on the board, so food behind a body isn't chased head first.
+
+    return: Set representing any move that would get the snake to food.
+    '''
+
+    return board.get_nearest_food_moves(snake.head)
+
+def get_roomy_moves(board: Board, snake: Snake, rules: Ruleset = STANDARD) -> set[str]:
+    '''
+    Returns a set of moves that leave the snake enough room to fit its whole body.
+
+    If no move has enough room, the moves with the most room are returned.
+
+    rules: The rules of the game, in constrictor no tail ever makes room.
+
+    return: Set representing the moves with the most room.
+    '''
+
+    areas = board.get_move_areas(snake, limit=snake.length, constrictor=rules.constrictor)
+    if len(areas) == 0:
+        return set()
+
+    most = max(areas.values())
+    if most >= snake.length:
+        return {move for move, area in areas.items() if area >= snake.length}
+
+    return {move for move, area in areas.items() if area == most}
+
+def get_prepared_move(game: dict, position: Position, you: str, moves: list) -> tuple:
+    '''
+    Use this function to look a position up in what was worked out ahead of time: the opening book, where
+    the first turns of a standard game were searched deeply, and the tablebase, where small 1v1 endgames were solved.
+
+    return: A tuple of where the move was found and a tuple of the move, its score and its depth, or None if it wasn't.
+    '''
 
-    return: Dictionary representing any move that would get the snake to food.
+    sources = (('book', server_book.get_book(game)), ('tablebase', server_tablebase.get_tablebase(game, position.grid)))
+    for name, source in sources:
+        if source is None:
+            continue
+        result = source.probe(position, you)
+        if result is not None and result[0] in moves:
+            return (name, result)
+
+    return None
+
+def get_fallback_move(data: dict) -> str:
     '''
+    Use this function to answer a move straight away, without searching, when there is no thread free to pick it.
+
+    return: A move that doesn't lose the snake on this turn, roomy ones first, or any move if there isn't one.
+    '''
+
+    board = Board(data['board'], is_wrapped(data['game']))
+    snake = Snake(data['you'], board.grid)
+    rules = Ruleset.from_game(data['game'])
+    damage = rules.get_damage(board.grid, board.hazard_cells)
 
-    nearest_food_location = board.get_nearest_food_location(snake.head)
-    
-    moves: set[str] = {}
-    # If the head is to the left of the food, move right.
-    if snake.head.x < nearest_food_location.x:
-        moves.add(Move.right)
-    # If the head is to the right of the food, move left.
-    if snake.head.x > nearest_food_location.x:
-        moves.add(Move.left)
-    # If the head is above the food, move down.
-    if snake.head.y > nearest_food_location.y:
-        moves.add(Move.down)
-    # If the head is below the food, move up.
-    if snake.head.y < nearest_food_location.y:
-        moves.add(Move.up)
+    safe_moves = POSSIBLE_MOVES - get_deadly_moves(board, snake) - get_hazard_moves(board, snake, damage)
+    roomy_moves = safe_moves & get_roomy_moves(board, snake, rules)
 
-    # Return the list of possible moves that will get the snake to the food.
-    return moves
+    return random.choice(sorted(roomy_moves or safe_moves or POSSIBLE_MOVES))
 
-def choose_move(data: dict) -> str:
+def choose_move(data: dict, session=None, timings: RequestTimings = None) -> str:
     '''
     data: Dictionary of all Game Board data as received from the Battlesnake Engine.
     For a full example of 'data', see https://docs.battlesnake.com/references/api/sample-move-request
 
+    session: The GameSession for the game, if there is one. Its Board is already up to date with this turn.
+
+    timings: If given, the time spent in each phase of picking the move is lapped on it.
+
     return: A String, the single move to make. One of "up", "down", "left" or "right".
 
     Use the information in 'data' to decide your next move. The 'data' variable can be interacted
@@ -72,41 +198,144 @@ def choose_move(data: dict) -> str:
     for each move of the game.
     '''
 
-    board = Board(data['board'])
-    snake = Snake(data['you'])
+    if timings is None:
+        timings = RequestTimings()
+    # The deadline runs from when the request came in, so the time it waited for a thread or for its game counts against it.
+    started = timings.started
+
+    if session is not None:
+        board = session.board
+    else:
+        board = Board(data['board'], is_wrapped(data['game']))
+    snake = Snake(data['you'], board.grid)
+    # The hazard damage of every cell is worked out once, for the checks below and the search to look up.
+    rules = Ruleset.from_game(data['game'])
+    damage = rules.get_damage(board.grid, board.hazard_cells)
+    timings.lap('model')
 
     possible_moves = POSSIBLE_MOVES
-    deadly_moves = get_deadly_moves(board, snake)
+    deadly_moves = get_deadly_moves(board, snake) | get_hazard_moves(board, snake, damage)
     available_moves = possible_moves - deadly_moves
+    timings.lap('safety')
 
-    # TODO: Using information from 'data', don't let your Battlesnake pick a move that would collide with another Battlesnake.
-
-    # Get the distance to the nearest piece of food.
-    # Then add 5% margin of error to the distance.
+    # Get the distance to the nearest piece of food, walking around the snakes in the way.
+    # If no food can be reached there is nothing to go for.
     nearest_food_distance = board.get_nearest_food_distance(snake.head)
-    #nearest_food_distance = nearest_food_distance + (nearest_food_distance * 0.05)
 
     recommended_moves: set[str] = available_moves
-    # The snake loses 1 health with each move.
-    # Therefore, if the health is less than or equal to the nearest food - start moving to it.
-    if snake.health <= nearest_food_distance:
+    # The snake loses 1 health with each move, and more in a hazard.
+    # Therefore, if the moves it has left are less than or equal to the nearest food - start moving to it.
+    if nearest_food_distance is not None and get_turns_left(snake, damage) <= nearest_food_distance:
         # Make your Battlesnake move towards a piece of food on the board.
         goto_food_moves = get_food_moves(board, snake)
         recommended_moves = recommended_moves & goto_food_moves
+
+        # If every path to food is deadly, stay alive instead.
+        if len(recommended_moves) == 0:
+            recommended_moves = available_moves
     else:
         # Avoid food at all costs until necessary.
-        avoid_food_moves = snake.get_food_directions(board.get_food())
+        avoid_food_moves = snake.get_food_directions(board.food_mask)
         recommended_moves = recommended_moves - avoid_food_moves
 
         # Make sure that there are still moves available.
         # If not, add back the avoided food moves so that the snake doesn't kill itself.
         if len(recommended_moves) == 0:
             recommended_moves = available_moves
+    timings.lap('food')
+
+    # Don't walk into a pocket that is too small to fit the snake, if there is anywhere roomier to go.
+    roomy_moves = get_roomy_moves(board, snake, rules)
+    if len(recommended_moves & roomy_moves) > 0:
+        recommended_moves = recommended_moves & roomy_moves
+    timings.lap('safety')
+
+    # Look ahead at the moves the other snakes could make, and pick the move that does best against them.
+    # The recommended moves are tried first, so they win whenever the search scores moves the same.
+    position = Position.from_board(board, data['turn'], rules, damage)
+    me = position.get_snake(snake.id)
+    result = None
 
-    move = random.choice(list(recommended_moves))
+    # The moves the opponents made since last turn show how they like to play.
+    predictors = None
+    if OPPONENT_MODEL:
+        if session is not None:
+            previous = session.position
+            if previous is not None and previous.turn == position.turn - 1 and previous.grid is position.grid:
+                server_opponents.model.observe(previous, position, data['board']['snakes'], snake.id)
+            session.position = position
+        predictors = server_opponents.model.get_predictors(data['board']['snakes'], snake.id)
+
+    if me is not None:
+        network_latency = session.get_network_latency(data) if session is not None else None
+        deadline = get_deadline(data, network_latency, started)
+        legal_moves = position.get_moves(me)
+        moves = [x for x in MOVES if x in recommended_moves and x in legal_moves]
+        moves += [x for x in legal_moves if x not in moves]
+
+        strategy = get_strategy(data['game'])
+
+        prepared = get_prepared_move(data['game'], position, snake.id, moves)
+        if prepared is not None:
+            strategy, result = prepared
+        elif strategy == 'mcts':
+            result = server_mcts.find_best_move(position, snake.id, deadline, moves)
+        else:
+            table = None
+            if session is not None:
+                table = session.get_table()
+                table.new_turn()
+            result = server_search.find_best_move(position, snake.id, deadline, moves, table, predictors)
+    timings.lap('search')
+
+    if result is not None:
+        move, score, effort = result
+        logger.info('move', game=data['game']['id'], turn=data['turn'], move=move, score=round(score, 2), strategy=strategy, effort=effort)
+    else:
+        # Nothing is safe, so any recommended move is as good as another.
+        move = random.choice(list(recommended_moves or POSSIBLE_MOVES))
+        logger.info('move', game=data['game']['id'], turn=data['turn'], move=move, picked_from=sorted(recommended_moves))
 
-    # TODO: Explore new strategies for picking a move that are better than random.
+    # Only a sample of moves are logged in detail, and the rest don't build the record.
+    if logger.sampled():
+        logger.debug(
+            'move_detail', game=data['game']['id'], turn=data['turn'], health=snake.health, length=snake.length,
+            available=sorted(available_moves), recommended=sorted(recommended_moves),
+            phases={k: round(v * 1000, 3) for k, v in timings.phases.items()},
+        )
 
-    print(f"{data['game']['id']} MOVE {data['turn']}: {move} picked from all valid options in {recommended_moves}")
+    if session is not None:
+        session.move_time = (time.perf_counter() - started) * 1000
+        session.decision = (strategy, score, effort) if result is not None else None
+
+        # The next turn is searched from where this one left off, once the move has been answered.
+        # The next request should come within a timeout or so, and the ponder is stopped when it does.
+        if PONDER and result is not None and strategy == 'search':
+            session.ponder = Ponder(position, snake.id, move, table, data['game'].get('timeout', 500) / 1000, predictors)
 
     return move
+
+def warm_up(sizes: tuple = STANDARD_SIZES):
+    '''
+    Use this function once when the server boots, so the first move of a game is as fast as the rest.
+
+    The grid and Zobrist tables of every standard board size are built, and a move is picked on each of them,
+    which loads everything that picking a move imports lazily. The moves are searched for as short a time as possible.
+    '''
+
+    import server_simulator
+
+    rng = random.Random(0)
+    game = {'id': 'warm-up', 'ruleset': {'name': 'standard', 'version': 'warm-up'}, 'timeout': 0}
+    for width, height in sizes:
+        get_keys(get_grid(width, height))
+        # Wrapped games are played on the same sizes, with tables of their own.
+        get_keys(get_grid(width, height, True))
+
+        position = server_simulator.get_start_position(width, height, ['warm-up-0', 'warm-up-1'], rng)
+        data = server_simulator.get_move_request(game, position, 'warm-up-0')
+        # Read through the fast path of the codec, whatever the size, so it is ready for the large boards.
+        data = server_codec.parse_move_request(server_codec.dumps(data), min_size=0)
+
+        with logger.muted():
+            choose_move(data)
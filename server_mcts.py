@@ -0,0 +1,239 @@
+import math
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor, wait
+
+from server_rules import Position, advance, get_default_move
+
+"""
+This file picks moves with Monte Carlo Tree Search, as an alternative to the search in server_search.py.
+
+Every snake picks its own move at each node of the tree with UCT, looking only at its own results, and the
+moves are played together (decoupled UCT). Positions below the tree are played out with random safe moves.
+
+Several trees are grown at once on a process pool, one per core, and their root visits are added together
+to pick the move (root parallelization). The pool is started when the server boots, see start_pool().
+"""
+
+# How much UCT favours moves that haven't been tried much.
+EXPLORATION = 1.4
+
+# How many turns a playout runs for before the position is scored.
+PLAYOUT_DEPTH = 20
+
+# How long, in seconds, is kept back for sending work to the pool and getting the results back.
+POOL_OVERHEAD = 0.01
+
+_pool: ProcessPoolExecutor = None
+_workers: int = 0
+
+class Node:
+    __slots__ = ('position', 'moves', 'visits', 'values', 'children', 'total')
+
+    def __init__(self, position: Position, root_moves: dict = None):
+        self.position = position
+
+        # The moves each snake can pick from, safe moves first.
+        self.moves: dict = {}
+        for snake in position.snakes:
+            moves = root_moves.get(snake.id) if root_moves else None
+            if not moves:
+                moves = position.get_moves(snake) or [get_default_move(position, snake)]
+            self.moves[snake.id] = moves
+
+        self.visits: dict = {k: [0] * len(v) for k, v in self.moves.items()}
+        self.values: dict = {k: [0.0] * len(v) for k, v in self.moves.items()}
+        self.children: dict = {}
+        self.total = 0
+
+    def select(self, rng: random.Random) -> tuple:
+        '''
+        Use this function to let every snake pick the move it wants to try next.
+
+        return: A tuple with the index of the move each snake picked, in the order of self.moves.
+        '''
+
+        log_total = math.log(self.total + 1)
+        picks = []
+        for id, moves in self.moves.items():
+            visits = self.visits[id]
+            values = self.values[id]
+
+            untried = [i for i, x in enumerate(visits) if x == 0]
+            if untried:
+                picks.append(rng.choice(untried))
+                continue
+
+            best = 0
+            best_score = -1.0
+            for i in range(len(moves)):
+                score = values[i] / visits[i] + EXPLORATION * math.sqrt(log_total / visits[i])
+                if score > best_score:
+                    best = i
+                    best_score = score
+            picks.append(best)
+
+        return tuple(picks)
+
+def get_rewards(position: Position, ids: tuple, solo: bool) -> dict:
+    '''
+    Use this function to score a playout for every snake that started it.
+
+    return: A dictionary of snake id to a reward between 0 and 1.
+    '''
+
+    alive = {x.id: x for x in position.snakes}
+    longest = max((x.length for x in position.snakes), default=1)
+
+    rewards = {}
+    for id in ids:
+        snake = alive.get(id)
+        if snake is None:
+            rewards[id] = 0.0
+        elif not solo and len(alive) == 1:
+            rewards[id] = 1.0
+        else:
+            # Staying alive is most of it, being the longest snake left is a little extra.
+            rewards[id] = 0.5 + 0.2 * snake.length / longest
+
+    return rewards
+
+def playout(position: Position, rng: random.Random) -> Position:
+    '''
+    Use this function to play a position out with random safe moves.
+
+    return: The Position after PLAYOUT_DEPTH turns, or once one snake or less is left.
+    '''
+
+    for _ in range(PLAYOUT_DEPTH):
+        if len(position.snakes) <= 1:
+            break
+
+        moves = {}
+        for snake in position.snakes:
+            safe = position.get_moves(snake)
+            if safe:
+                moves[snake.id] = rng.choice(safe)
+
+        position = advance(position, moves)
+
+    return position
+
+def grow_tree(position: Position, you: str, moves: list, deadline: float, seed: int = None) -> dict:
+    '''
+    Use this function to grow one search tree until the deadline.
+
+    moves: The moves our snake is allowed to pick at the root.
+    deadline: The time.perf_counter() to stop at. It is the same clock in every process, so a tree that
+    waited for a worker to come free only grows for the time that is left.
+
+    return: A dictionary of each of our root moves to a tuple of its visits and its total reward, empty if the deadline has passed.
+    '''
+
+    if time.perf_counter() >= deadline:
+        return {}
+
+    rng = random.Random(seed)
+    ids = tuple(x.id for x in position.snakes)
+    solo = len(ids) <= 1
+
+    root = Node(position, {you: moves})
+    while time.perf_counter() < deadline:
+        path = []
+        node = root
+        while True:
+            picks = node.select(rng)
+            path.append((node, picks))
+
+            child = node.children.get(picks)
+            if child is None:
+                joint = {id: node.moves[id][i] for id, i in zip(node.moves, picks)}
+                child = Node(advance(node.position, joint))
+                node.children[picks] = child
+                break
+
+            node = child
+            if len(node.position.snakes) <= (0 if solo else 1):
+                break
+
+        rewards = get_rewards(playout(child.position, rng), ids, solo)
+
+        for node, picks in path:
+            node.total += 1
+            for id, i in zip(node.moves, picks):
+                node.visits[id][i] += 1
+                node.values[id][i] += rewards.get(id, 0.0)
+
+    return {move: (root.visits[you][i], root.values[you][i]) for i, move in enumerate(root.moves[you])}
+
+def start_pool(workers: int = None):
+    '''
+    Use this function once when the server boots, to start the processes that grow the trees.
+
+    workers: How many processes to start, defaults to one per core.
+    '''
+
+    global _pool, _workers
+
+    if _pool is not None:
+        return
+
+    _workers = workers or os.cpu_count() or 1
+    _pool = ProcessPoolExecutor(max_workers=_workers)
+
+    # Make the workers start now, rather than on the first move of the first game.
+    wait([_pool.submit(time.sleep, 0) for _ in range(_workers)])
+
+def stop_pool():
+    '''
+    Use this function to shut the pool down.
+    '''
+
+    global _pool, _workers
+
+    if _pool is not None:
+        _pool.shutdown(cancel_futures=True)
+    _pool = None
+    _workers = 0
+
+def find_best_move(position: Position, you: str, deadline: float, moves: list) -> tuple:
+    '''
+    Use this function to pick the best of 'moves' for our snake before the deadline.
+
+    If the pool has been started one tree is grown on every worker, otherwise a single tree is grown here.
+
+    return: A tuple of the most visited move, its average reward and the number of playouts, or None if nothing was played out.
+    '''
+
+    if not moves or position.get_snake(you) is None:
+        return None
+
+    totals = {move: [0, 0.0] for move in moves}
+
+    if _pool is None:
+        results = [grow_tree(position, you, moves, deadline)]
+    else:
+        futures = [
+            _pool.submit(grow_tree, position, you, moves, deadline - POOL_OVERHEAD, random.getrandbits(32))
+            for _ in range(_workers)
+        ]
+        # A worker that is late is left out, rather than making the move late.
+        done, late = wait(futures, timeout=max(deadline - time.perf_counter(), 0))
+        # Trees still queued behind other games would only hold the workers up for the next move.
+        for future in late:
+            future.cancel()
+        results = [x.result() for x in done if x.exception() is None]
+
+    for result in results:
+        for move, (visits, value) in result.items():
+            totals[move][0] += visits
+            totals[move][1] += value
+
+    # Ties go to the move that was preferred.
+    move = max(moves, key=lambda x: totals[x][0])
+    visits, value = totals[move]
+    if visits == 0:
+        return None
+
+    return (move, value / visits, sum(x[0] for x in totals.values()))
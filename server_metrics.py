@@ -0,0 +1,193 @@
+import bisect
+import threading
+import time
+
+"""
+This file times every /move request and keeps the timings in histograms, for /metrics to serve in the
+Prometheus text format.
+
+A request is split into phases: decoding the JSON, building the models, the safety checks, the food logic,
+the search and encoding the response. Each phase, and the whole request, is broken down by board size
+and snake count, and the whole request is also measured against the game's timeout.
+"""
+
+PHASES = ('decode', 'model', 'safety', 'food', 'search', 'encode')
+
+# The upper bounds, in seconds, of the latency buckets.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+# The upper bounds of the buckets for the share of the game's timeout a request used.
+TIMEOUT_BUCKETS = (0.1, 0.25, 0.5, 0.75, 0.9, 1.0)
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: tuple, buckets: tuple):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+
+        # For each set of label values, the count in each bucket (the last one is +Inf), the sum and the count.
+        self.series: dict = {}
+        self.lock = threading.Lock()
+
+    def observe(self, values: tuple, value: float):
+        '''
+        Use this function to add one observation.
+
+        values: The value of each label, in the order of self.labels.
+        '''
+
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(values)
+            if series is None:
+                series = self.series[values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def get_series(self) -> dict:
+        '''
+        Use this function to get a copy of every series, to send to another process.
+
+        return: A dictionary of label values to a list of the bucket counts, the sum and the count.
+        '''
+
+        with self.lock:
+            return {k: [list(v[0]), v[1], v[2]] for k, v in self.series.items()}
+
+    def merge(self, series: dict):
+        '''
+        Use this function to add the series of another histogram with the same buckets into this one.
+        '''
+
+        with self.lock:
+            for values, (counts, total, count) in series.items():
+                mine = self.series.get(values)
+                if mine is None:
+                    mine = self.series[values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                for i, bucket in enumerate(counts):
+                    mine[0][i] += bucket
+                mine[1] += total
+                mine[2] += count
+
+    def render(self) -> list:
+        '''
+        Use this function to write the histogram out in the Prometheus text format.
+
+        return: A list of lines.
+        '''
+
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        series = sorted(self.get_series().items())
+
+        for values, (counts, total, count) in series:
+            labels = ','.join(f'{k}="{v}"' for k, v in zip(self.labels, values))
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{labels}}} {total}')
+            lines.append(f'{self.name}_count{{{labels}}} {count}')
+
+        return lines
+
+class RequestTimings:
+    def __init__(self, started: float = None):
+        '''
+        started: The time.perf_counter() at which the request came in, defaults to now.
+        '''
+
+        self.started = time.perf_counter() if started is None else started
+        self.last = self.started
+        self.phases: dict = {}
+
+    def lap(self, phase: str):
+        '''
+        Use this function at the end of each phase, to charge the time since the last lap to 'phase'.
+
+        A phase can be lapped more than once, the times are added together.
+        '''
+
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self.last
+        self.last = now
+
+    def get_total(self) -> float:
+        '''
+        return: The seconds from the start of the request to the last lap.
+        '''
+
+        return self.last - self.started
+
+phase_seconds = Histogram(
+    'battlesnake_move_phase_seconds',
+    'Time spent in each phase of a /move request.',
+    ('phase', 'board', 'snakes'),
+    LATENCY_BUCKETS,
+)
+
+move_seconds = Histogram(
+    'battlesnake_move_seconds',
+    'Time spent answering a /move request.',
+    ('board', 'snakes'),
+    LATENCY_BUCKETS,
+)
+
+timeout_ratio = Histogram(
+    'battlesnake_move_timeout_ratio',
+    "Share of the game's move timeout used answering a /move request.",
+    ('board', 'snakes'),
+    TIMEOUT_BUCKETS,
+)
+
+HISTOGRAMS = (phase_seconds, move_seconds, timeout_ratio)
+
+def record(data: dict, timings: RequestTimings):
+    '''
+    Use this function once a /move request has been answered, to add its timings to the histograms.
+    '''
+
+    board = f"{data['board']['width']}x{data['board']['height']}"
+    snakes = str(len(data['board']['snakes']))
+
+    for phase, seconds in timings.phases.items():
+        phase_seconds.observe((phase, board, snakes), seconds)
+
+    total = timings.get_total()
+    move_seconds.observe((board, snakes), total)
+
+    timeout = data['game'].get('timeout')
+    if timeout:
+        timeout_ratio.observe((board, snakes), total * 1000 / timeout)
+
+def get_series() -> dict:
+    '''
+    Use this function to get a copy of every histogram of this process, to send to another process.
+
+    return: A dictionary of histogram name to its series, see Histogram.get_series().
+    '''
+
+    return {x.name: x.get_series() for x in HISTOGRAMS}
+
+def render(processes: list = None) -> str:
+    '''
+    Use this function to get every histogram for /metrics.
+
+    processes: If given, the get_series() of other processes, which are added together instead of using this process's histograms.
+
+    return: The metrics in the Prometheus text format.
+    '''
+
+    histograms = HISTOGRAMS
+    if processes is not None:
+        histograms = tuple(Histogram(x.name, x.help, x.labels, x.buckets) for x in HISTOGRAMS)
+        for series in processes:
+            for histogram in histograms:
+                histogram.merge(series.get(histogram.name, {}))
+
+    lines = []
+    for histogram in histograms:
+        lines.extend(histogram.render())
+
+    return '\n'.join(lines) + '\n'
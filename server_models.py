@@ -1,6 +1,9 @@
-from typing import List
+import heapq
+from functools import lru_cache
+from typing import TYPE_CHECKING, Iterable, Iterator, List
 
-from scipy.spatial.distance import cdist
+if TYPE_CHECKING:
+    import numpy as np
 
 class Move:
     up = 'up'
@@ -8,6 +11,24 @@ class Move:
     left = 'left'
     right = 'right'
 
+# The order that moves are generated in by the board engine.
+MOVES = (Move.up, Move.down, Move.left, Move.right)
+
+# The position of each move in MOVES.
+MOVE_INDEX = {x: i for i, x in enumerate(MOVES)}
+
+# The rulesets played on a board whose edges wrap around to the other side.
+WRAPPED_RULESETS = {'wrapped', 'wrapped_constrictor'}
+
+def is_wrapped(game: dict) -> bool:
+    '''
+    Use this function to check if a game is played on a wrapped board, from the game of a request.
+
+    return: True if moving off an edge comes back on at the other side.
+    '''
+
+    return (game.get('ruleset') or {}).get('name') in WRAPPED_RULESETS
+
 class Coord:
     def __init__(self, data):
         if isinstance(data, dict):
@@ -19,10 +40,22 @@ class Coord:
         else:
             raise Exception('data must be dict or tuple')
 
-        self.up = (self.x, self.y + 1)
-        self.down = (self.x, self.y - 1)
-        self.left = (self.x - 1, self.y)
-        self.right = (self.x + 1, self.y)
+    # The neighbors are only worked out when asked for, most Coords never need them.
+    @property
+    def up(self) -> tuple:
+        return (self.x, self.y + 1)
+
+    @property
+    def down(self) -> tuple:
+        return (self.x, self.y - 1)
+
+    @property
+    def left(self) -> tuple:
+        return (self.x - 1, self.y)
+
+    @property
+    def right(self) -> tuple:
+        return (self.x + 1, self.y)
 
     def get_xy(self) -> tuple:
         '''
@@ -33,16 +66,689 @@ class Coord:
 
         return (self.x, self.y)
 
+class Grid:
+    '''
+    The geometry of a board of a given size, used to encode the board as integer bitmasks.
+
+    Cell `i` is the coordinate (i % width, i // width) and is stored as bit `i` of a mask.
+    Grids are cached per size, use get_grid() rather than building one directly.
+
+    On a wrapped grid every edge leads round to the opposite one. Only the tables and the bitmask shifts
+    know, so everything that walks the board with them wraps without checking.
+    '''
+
+    def __init__(self, width: int, height: int, wrapped: bool = False):
+        self.width = width
+        self.height = height
+        self.wrapped = wrapped
+        self.size = width * height
+        self.full = (1 << self.size) - 1
+
+        left_column = 0
+        for y in range(height):
+            left_column |= 1 << (y * width)
+
+        self.left_column = left_column
+        self.right_column = left_column << (width - 1)
+        self.bottom_row = (1 << width) - 1
+        self.top_row = self.bottom_row << (width * (height - 1))
+        # How far a row is shifted to wrap it from the top to the bottom.
+        self._wrap_rows = width * (height - 1)
+
+        # The cells next to each cell, used by searches that walk the board one cell at a time.
+        self.neighbors: tuple = tuple(
+            tuple(self.cells(self.expand(1 << cell))) for cell in range(self.size)
+        )
+
+        # For each cell, the cell each move leads to in the order of MOVES, or -1 if it falls off the board.
+        self.steps: tuple = tuple(
+            tuple(self._step(cell, move) for move in MOVES) for cell in range(self.size)
+        )
+        # For each cell, the move to each of its neighbors, in the order of MOVES.
+        self.directions: tuple = tuple(
+            {x: move for x, move in zip(steps, MOVES) if x >= 0} for steps in self.steps
+        )
+        # For each cell, the moves that fall off the board, none on a wrapped grid.
+        self.edges: tuple = tuple(
+            frozenset(move for x, move in zip(steps, MOVES) if x < 0) for steps in self.steps
+        )
+
+    def __reduce__(self):
+        # Grids are shared per size, so only the size is sent to other processes.
+        return (get_grid, (self.width, self.height, self.wrapped))
+
+    def index(self, x: int, y: int) -> int:
+        '''
+        Use this function to get the cell index of an x,y coordinate.
+
+        return: The cell index.
+        '''
+
+        return y * self.width + x
+
+    def xy(self, cell: int) -> tuple:
+        '''
+        Use this function to get the x,y coordinate of a cell index.
+
+        return: An x,y coordinate tuple.
+        '''
+
+        return (cell % self.width, cell // self.width)
+
+    def contains(self, x: int, y: int) -> bool:
+        '''
+        Use this function to check if an x,y coordinate is on the board.
+
+        return: True if the coordinate is on the board.
+        '''
+
+        return 0 <= x < self.width and 0 <= y < self.height
+
+    def mask(self, cells: Iterable[int]) -> int:
+        '''
+        Use this function to build a bitmask out of cell indexes.
+
+        return: The bitmask with a bit set for every cell.
+        '''
+
+        mask = 0
+        for cell in cells:
+            mask |= 1 << cell
+
+        return mask
+
+    def cells(self, mask: int) -> Iterator[int]:
+        '''
+        Use this function to iterate over the cell indexes set in a bitmask, lowest first.
+
+        return: An iterator of cell indexes.
+        '''
+
+        while mask:
+            low = mask & -mask
+            yield low.bit_length() - 1
+            mask ^= low
+
+    def shift(self, mask: int, move: str) -> int:
+        '''
+        Use this function to move every cell of a bitmask one step in a direction.
+
+        Cells that would fall off the board are dropped, or come back on at the other side of a wrapped board.
+
+        return: The shifted bitmask.
+        '''
+
+        wrapped = self.wrapped
+        if move == Move.up:
+            return ((mask & ~self.top_row) << self.width) | ((mask & self.top_row) >> self._wrap_rows if wrapped else 0)
+        if move == Move.down:
+            return ((mask & ~self.bottom_row) >> self.width) | ((mask & self.bottom_row) << self._wrap_rows if wrapped else 0)
+        if move == Move.left:
+            return ((mask & ~self.left_column) >> 1) | ((mask & self.left_column) << (self.width - 1) if wrapped else 0)
+        if move == Move.right:
+            return ((mask & ~self.right_column) << 1) | ((mask & self.right_column) >> (self.width - 1) if wrapped else 0)
+
+        raise Exception(f'unknown move {move}')
+
+    def step(self, cell: int, move: str) -> int:
+        '''
+        Use this function to get the cell one step from a cell in a direction.
+
+        return: The cell index, or -1 if the step would fall off the board.
+        '''
+
+        index = MOVE_INDEX.get(move)
+        if index is None:
+            raise Exception(f'unknown move {move}')
+
+        return self.steps[cell][index]
+
+    def _step(self, cell: int, move: str) -> int:
+        '''
+        Use this function to work out the cell one step from a cell in a direction, for the step table.
+
+        return: The cell index, or -1 if the step would fall off the board.
+        '''
+
+        x, y = cell % self.width, cell // self.width
+        if move == Move.up:
+            y += 1
+        elif move == Move.down:
+            y -= 1
+        elif move == Move.left:
+            x -= 1
+        elif move == Move.right:
+            x += 1
+        else:
+            raise Exception(f'unknown move {move}')
+
+        if self.wrapped:
+            return self.index(x % self.width, y % self.height)
+        if not self.contains(x, y):
+            return -1
+
+        return self.index(x, y)
+
+    def expand(self, mask: int) -> int:
+        '''
+        Use this function to get every cell next to any cell of a bitmask.
+
+        return: The bitmask of all neighboring cells.
+        '''
+
+        spread = (
+            ((mask & ~self.top_row) << self.width)
+            | ((mask & ~self.bottom_row) >> self.width)
+            | ((mask & ~self.left_column) >> 1)
+            | ((mask & ~self.right_column) << 1)
+        )
+        if self.wrapped:
+            spread |= (
+                ((mask & self.top_row) >> self._wrap_rows)
+                | ((mask & self.bottom_row) << self._wrap_rows)
+                | ((mask & self.left_column) << (self.width - 1))
+                | ((mask & self.right_column) >> (self.width - 1))
+            )
+
+        return spread
+
+    def get_offset(self, cell: int, target: int) -> tuple:
+        '''
+        Use this function to get the shortest way from a cell to another, the short way round on a wrapped grid.
+
+        return: A tuple of the steps in x and in y, negative for left and down.
+        '''
+
+        dx = target % self.width - cell % self.width
+        dy = target // self.width - cell // self.width
+        if self.wrapped:
+            dx = (dx + self.width // 2) % self.width - self.width // 2
+            dy = (dy + self.height // 2) % self.height - self.height // 2
+
+        return (dx, dy)
+
+@lru_cache(maxsize=None)
+def get_grid(width: int, height: int, wrapped: bool = False) -> Grid:
+    '''
+    Use this function to get the shared Grid for a board size.
+
+    wrapped: True for the board of a wrapped game, see is_wrapped().
+
+    return: The Grid for the given width and height.
+    '''
+
+    # get_grid(7, 7) and get_grid(7, 7, False) are cached apart, so the Grid itself is cached once more.
+    return _new_grid(width, height, bool(wrapped))
+
+@lru_cache(maxsize=None)
+def _new_grid(width: int, height: int, wrapped: bool) -> Grid:
+    return Grid(width, height, wrapped)
+
+def get_reachable_area(grid: Grid, start: int, bodies: Iterable[tuple], elapsed: int = 0, limit: int = None, constrictor: bool = False) -> int:
+    '''
+    Use this function to count the cells a head could reach from 'start', walking around the snakes on the board.
+
+    Body segments are only in the way until they have moved off: a segment N places from the end of its snake
+    is gone after N + 1 turns, so a cell can be reached once it is free by the time the head gets there.
+    The fill grows the whole reached region one turn at a time as a bitmask, so it never touches a single cell.
+    A head can only wait for a body to move off for as many turns as it has cells to move around in.
+
+    bodies: The cells of every snake from head to tail, including the snake the head belongs to.
+    elapsed: How many turns the bodies have already moved on by, 1 when 'start' is the cell a move is going into.
+    limit: Stop counting once this many cells have been reached.
+    constrictor: True if every snake grows every turn, so no body ever moves off.
+
+    return: The number of cells that can be reached, not counting 'start'.
+    '''
+
+    # The bodies are in the way until the turn their cells are released on.
+    releases = [0]
+    blocked = 0
+    for body in bodies:
+        length = len(body)
+        seen = 0
+        for i, cell in enumerate(body):
+            bit = 1 << cell
+            # A stacked tail is only released when its first segment moves off.
+            if seen & bit:
+                continue
+            seen |= bit
+
+            if constrictor:
+                blocked |= bit
+                continue
+            turn = length - i - elapsed
+            if turn <= 0:
+                continue
+            blocked |= bit
+            while len(releases) <= turn:
+                releases.append(0)
+            releases[turn] |= bit
+
+    reached = 1 << start
+    blocked &= ~reached
+    last = len(releases) - 1
+    expand = grid.expand
+    turn = 0
+    while True:
+        turn += 1
+        if turn <= last:
+            blocked &= ~releases[turn]
+
+        grown = reached | (expand(reached) & ~blocked)
+        # Waiting for a body to move off only works while there is room to keep moving in.
+        if grown == reached and (turn >= last or turn > bin(reached).count('1') - 1):
+            break
+        reached = grown
+
+        if limit is not None and bin(reached).count('1') > limit:
+            break
+
+    area = bin(reached).count('1') - 1
+    if limit is not None:
+        return min(area, limit)
+
+    return area
+
+# NumPy is only imported by the functions that use it, so a move that doesn't need it never waits for it to load.
+
+def mask_to_array(grid: Grid, mask: int) -> 'np.ndarray':
+    '''
+    Use this function to turn a bitmask into a height by width array, indexed [y, x].
+
+    return: A boolean NumPy array.
+    '''
+
+    import numpy as np
+
+    data = np.frombuffer(mask.to_bytes((grid.size + 7) // 8, 'little'), dtype=np.uint8)
+    bits = np.unpackbits(data, bitorder='little')[:grid.size]
+
+    return bits.reshape(grid.height, grid.width).astype(bool)
+
+def expand_array(cells: 'np.ndarray', wrapped: bool = False) -> 'np.ndarray':
+    '''
+    Use this function to get every cell next to any cell of the boolean arrays in the last two dimensions.
+
+    wrapped: True if the edges of the arrays lead round to the opposite ones.
+
+    return: A boolean array the same shape as 'cells'.
+    '''
+
+    import numpy as np
+
+    spread = np.zeros_like(cells)
+    spread[..., 1:, :] |= cells[..., :-1, :]
+    spread[..., :-1, :] |= cells[..., 1:, :]
+    spread[..., :, 1:] |= cells[..., :, :-1]
+    spread[..., :, :-1] |= cells[..., :, 1:]
+    if wrapped:
+        spread[..., 0, :] |= cells[..., -1, :]
+        spread[..., -1, :] |= cells[..., 0, :]
+        spread[..., :, 0] |= cells[..., :, -1]
+        spread[..., :, -1] |= cells[..., :, 0]
+
+    return spread
+
+def get_voronoi(heads: 'np.ndarray', lengths: 'np.ndarray', blocked: 'np.ndarray', food: 'np.ndarray', wrapped: bool = False) -> tuple:
+    '''
+    Use this function to split the board into the cells each snake can get to before any other snake.
+
+    Every head searches outwards at the same time. A cell that two heads reach on the same turn goes to the
+    longer snake, since it would win the collision, and to nobody if they are the same length.
+    Everything is done on whole arrays, and any leading dimensions are treated as a batch of positions.
+
+    This is for looking at positions and games after the fact. At around half a millisecond a position it costs
+    many times a whole search evaluation, so neither choose_move nor the search calls it.
+
+    heads: (..., snakes, height, width) booleans, the head of each snake.
+    lengths: (..., snakes) the length of each snake, 0 for a snake that isn't there.
+    blocked: (..., height, width) booleans, the cells that can't be walked through.
+    food: (..., height, width) booleans, the cells with food.
+    wrapped: True if the board is wrapped.
+
+    return: A tuple of two (..., snakes) arrays, the number of cells and the number of food each snake owns.
+    '''
+
+    import numpy as np
+
+    heads = heads & (lengths > 0)[..., None, None]
+    lengths = lengths.astype(np.int16)[..., None, None]
+
+    owned = heads.copy()
+    claimed = blocked | heads.any(axis=-3)
+    frontier = heads
+    while frontier.any():
+        reached = expand_array(frontier, wrapped) & ~claimed[..., None, :, :]
+        reaching = reached.sum(axis=-3, dtype=np.uint8, keepdims=True)
+
+        # Only the longest snake to reach a cell gets it, and nobody gets it if that is a tie.
+        frontier = reached & (reaching == 1)
+        if (reaching > 1).any():
+            strength = reached * lengths
+            winners = reached & (strength == strength.max(axis=-3, keepdims=True))
+            frontier |= winners & (reaching > 1) & (winners.sum(axis=-3, dtype=np.uint8, keepdims=True) == 1)
+
+        owned |= frontier
+        claimed |= reaching[..., 0, :, :] > 0
+
+    cells = owned.sum(axis=(-2, -1))
+    eaten = (owned & food[..., None, :, :]).sum(axis=(-2, -1))
+
+    return cells, eaten
+
+def get_territory(grid: Grid, bodies: Iterable[tuple], food: int) -> tuple:
+    '''
+    Use this function to work out the territory of every snake in one position, see get_voronoi().
+
+    bodies: The cells of every snake from head to tail.
+    food: The bitmask of food cells.
+
+    return: A tuple of two lists, the number of cells and the number of food each snake owns, in the order of 'bodies'.
+    '''
+
+    import numpy as np
+
+    bodies = list(bodies)
+    if len(bodies) == 0:
+        return [], []
+
+    heads = np.zeros((len(bodies), grid.height, grid.width), dtype=bool)
+    lengths = np.array([len(x) for x in bodies])
+    blocked = 0
+    for i, body in enumerate(bodies):
+        x, y = grid.xy(body[0])
+        heads[i, y, x] = True
+        # The tail moves out of the way, unless it is stacked.
+        end = len(body) if len(body) > 1 and body[-1] == body[-2] else len(body) - 1
+        for cell in body[1:end]:
+            blocked |= 1 << cell
+
+    cells, eaten = get_voronoi(heads, lengths, mask_to_array(grid, blocked), mask_to_array(grid, food), grid.wrapped)
+
+    return cells.tolist(), eaten.tolist()
+
+def _get_extent(data: dict) -> tuple:
+    '''
+    Use this function to size a grid that fits every point of a snake, for snakes built without a board.
+
+    return: A width,height tuple.
+    '''
+
+    points = [data['head'], *data['body']]
+
+    return (max(p['x'] for p in points) + 1, max(p['y'] for p in points) + 1)
+
+def _read_food(grid: Grid, data: dict) -> tuple:
+    '''
+    Use this function to get the food cells of a board, from either a decoded request or one from server_codec.
+
+    return: A tuple of cell indexes.
+    '''
+
+    if 'food_cells' in data:
+        return data['food_cells']
+
+    return tuple(grid.index(p['x'], p['y']) for p in data['food'])
+
+def _read_hazards(grid: Grid, data: dict) -> tuple:
+    '''
+    Use this function to get the hazard cells of a board, from either a decoded request or one from server_codec.
+
+    return: A tuple of cell indexes.
+    '''
+
+    if 'hazard_cells' in data:
+        return data['hazard_cells']
+
+    return tuple(grid.index(p['x'], p['y']) for p in data.get('hazards', ()))
+
+class DistanceField:
+    '''
+    The distance from every cell to the nearest of a set of source cells, walking around blocked cells.
+
+    Built with a single breadth first search from all of the sources at once, so every lookup after that is O(1).
+    Blocked cells are given a distance when they are next to a reachable cell, but the search never walks through them.
+    This way a snake's head, which is always blocked, still gets a distance.
+    '''
+
+    def __init__(self, grid: Grid, sources: Iterable[int], blocked: int = 0):
+        self.grid = grid
+        self.blocked = blocked
+
+        # The number of steps to the nearest source, or -1 if no source can be reached.
+        self.distance: list = [-1] * grid.size
+        # The next cell on the way to the nearest source.
+        self.parent: list = [-1] * grid.size
+        # The source that the cell leads to.
+        self.source: list = [-1] * grid.size
+
+        distance = self.distance
+        parent = self.parent
+        source = self.source
+        neighbors = grid.neighbors
+
+        frontier = []
+        for cell in sources:
+            if distance[cell] == -1:
+                distance[cell] = 0
+                source[cell] = cell
+                if not (blocked >> cell) & 1:
+                    frontier.append(cell)
+
+        depth = 0
+        while frontier:
+            depth += 1
+            next_frontier = []
+            for cell in frontier:
+                origin = source[cell]
+                for neighbor in neighbors[cell]:
+                    if distance[neighbor] != -1:
+                        continue
+                    distance[neighbor] = depth
+                    parent[neighbor] = cell
+                    source[neighbor] = origin
+                    if not (blocked >> neighbor) & 1:
+                        next_frontier.append(neighbor)
+            frontier = next_frontier
+
+    def update(self, added: Iterable[int], removed: Iterable[int], blocked: int):
+        '''
+        Use this function to move the field on to the next turn without searching the whole board again.
+
+        added: Cells that have become sources, like new food.
+        removed: Cells that are no longer sources, like eaten food.
+        blocked: The new bitmask of blocked cells.
+
+        Only the cells whose shortest path went through a removed source or a newly blocked cell are searched again,
+        everything else keeps the distance it already had.
+        '''
+
+        distance = self.distance
+        parent = self.parent
+        source = self.source
+        neighbors = self.grid.neighbors
+
+        newly_blocked = blocked & ~self.blocked
+        unblocked = self.blocked & ~blocked
+        self.blocked = blocked
+
+        # Throw away every cell that was reached through a removed source or a cell that can no longer be walked through.
+        invalid = []
+        stack = []
+        for cell in removed:
+            if source[cell] == cell:
+                stack.append(cell)
+        for cell in self.grid.cells(newly_blocked):
+            stack.extend(x for x in neighbors[cell] if parent[x] == cell)
+        while stack:
+            cell = stack.pop()
+            if distance[cell] == -1:
+                continue
+            invalid.append(cell)
+            stack.extend(x for x in neighbors[cell] if parent[x] == cell)
+            distance[cell] = -1
+            parent[cell] = -1
+            source[cell] = -1
+
+        # Search again from the edge of what is left, the new sources, and any cell that can be walked through again.
+        queue = []
+        for cell in invalid:
+            for neighbor in neighbors[cell]:
+                if distance[neighbor] != -1 and not (blocked >> neighbor) & 1:
+                    queue.append((distance[neighbor], neighbor))
+        for cell in self.grid.cells(unblocked):
+            if distance[cell] != -1:
+                queue.append((distance[cell], cell))
+        for cell in added:
+            if distance[cell] != 0:
+                distance[cell] = 0
+                parent[cell] = -1
+                source[cell] = cell
+                queue.append((0, cell))
+
+        heapq.heapify(queue)
+        while queue:
+            depth, cell = heapq.heappop(queue)
+            if depth != distance[cell] or (blocked >> cell) & 1:
+                continue
+            origin = source[cell]
+            for neighbor in neighbors[cell]:
+                if distance[neighbor] == -1 or depth + 1 < distance[neighbor]:
+                    distance[neighbor] = depth + 1
+                    parent[neighbor] = cell
+                    source[neighbor] = origin
+                    heapq.heappush(queue, (depth + 1, neighbor))
+
+    def get_distance(self, cell: int) -> int:
+        '''
+        Use this function to get the number of steps from a cell to the nearest source.
+
+        return: The distance, or None if no source can be reached.
+        '''
+
+        distance = self.distance[cell]
+        if distance < 0:
+            return None
+
+        return distance
+
+    def get_source(self, cell: int) -> int:
+        '''
+        Use this function to get the nearest source to a cell.
+
+        return: The cell index of the source, or None if no source can be reached.
+        '''
+
+        source = self.source[cell]
+        if source < 0:
+            return None
+
+        return source
+
+    def get_moves(self, cell: int) -> set[str]:
+        '''
+        Use this function to get every move from a cell that is a first step on a shortest path to a source.
+
+        return: Set representing the moves that get closer to a source.
+        '''
+
+        distance = self.distance[cell]
+        if distance <= 0:
+            return set()
+
+        return {move for step, move in self.grid.directions[cell].items() if self.distance[step] == distance - 1}
+
 class Board:
-    def __init__(self, data):
+    def __init__(self, data, wrapped: bool = False):
+        '''
+        wrapped: True for the board of a wrapped game, see is_wrapped().
+        '''
+
         self.height = data['height']
         self.width = data['width']
-        self.food: tuple = tuple(Coord(x) for x in data['food'])
+        self.grid: Grid = get_grid(self.width, self.height, wrapped)
+
+        grid = self.grid
+        self.food_cells: tuple = _read_food(grid, data)
+        self.food_mask: int = data.get('food_mask') or grid.mask(self.food_cells)
+        self.hazard_cells: tuple = _read_hazards(grid, data)
+        self.hazard_mask: int = data.get('hazard_mask') or grid.mask(self.hazard_cells)
+
+        self.snakes: tuple = tuple(Snake(x, grid) for x in data.get('snakes', ()))
+        self.occupied_mask: int = 0
+        for snake in self.snakes:
+            self.occupied_mask |= snake.body_mask
+
+        self._food_field: DistanceField = None
+
+        # There are no edges to fall off a wrapped board.
+        self._top_edge = None if wrapped else self.height - 1
+        self._bottom_edge = None if wrapped else 0
+        self._left_edge = None if wrapped else 0
+        self._right_edge = None if wrapped else self.width - 1
+
+    @property
+    def food(self) -> tuple:
+        '''
+        The food on the board as Coords, only built when asked for.
+        '''
+
+        return tuple(Coord(self.grid.xy(x)) for x in self.food_cells)
+
+    def update(self, data) -> bool:
+        '''
+        Use this function to move the board on to the next turn by applying only what changed since the last one.
+
+        Heads advance, tails retract, eliminated snakes are removed and food is eaten or spawned.
+        The occupancy mask and the food field are updated in place instead of being rebuilt.
+
+        return: False if the new turn doesn't follow on from this one and the board has to be built again.
+        '''
+
+        if data['height'] != self.height or data['width'] != self.width:
+            return False
+
+        grid = self.grid
+        by_id = {x.id: x for x in self.snakes}
+        snakes = []
+        freed = 0
+        heads = 0
+        for x in data.get('snakes', ()):
+            snake = by_id.pop(x['id'], None)
+            if snake is None:
+                return False
+            change = snake.advance(x)
+            if change is None:
+                return False
+            snakes.append(snake)
+            tail, head = change
+            if tail is not None:
+                freed |= 1 << tail
+            heads |= 1 << head
+
+        # Whatever is left was eliminated and no longer takes up any space.
+        for snake in by_id.values():
+            freed |= snake.body_mask
+
+        occupied = (self.occupied_mask & ~freed) | heads
+        self.snakes = tuple(snakes)
+        self.occupied_mask = occupied
 
-        self._top_edge = self.height - 1
-        self._bottom_edge = 0
-        self._left_edge = 0
-        self._right_edge = self.width - 1
+        food_cells = _read_food(grid, data)
+        food_mask = data.get('food_mask') or grid.mask(food_cells)
+        eaten = self.food_mask & ~food_mask
+        spawned = food_mask & ~self.food_mask
+        self.food_cells = food_cells
+        self.food_mask = food_mask
+
+        self.hazard_cells = _read_hazards(grid, data)
+        self.hazard_mask = data.get('hazard_mask') or grid.mask(self.hazard_cells)
+
+        if self._food_field is not None:
+            self._food_field.update(grid.cells(spawned), grid.cells(eaten), occupied)
+
+        return True
 
     def check_top_edge(self, head: Coord) -> str:
         '''
@@ -84,6 +790,33 @@ class Board:
         if head.x == self._right_edge:
             return Move.right
 
+    def is_occupied(self, cell: int) -> bool:
+        '''
+        Use this function to check if any snake's body is in a cell.
+
+        return: True if the cell holds part of a snake.
+        '''
+
+        return (self.occupied_mask >> cell) & 1 == 1
+
+    def has_food(self, cell: int) -> bool:
+        '''
+        Use this function to check if there is food in a cell.
+
+        return: True if the cell holds food.
+        '''
+
+        return (self.food_mask >> cell) & 1 == 1
+
+    def has_hazard(self, cell: int) -> bool:
+        '''
+        Use this function to check if there is a hazard in a cell.
+
+        return: True if the cell is a hazard.
+        '''
+
+        return (self.hazard_mask >> cell) & 1 == 1
+
     def get_food(self) -> List[tuple]:
         '''
         Use this function to get the location of all of the food on the board.
@@ -91,26 +824,33 @@ class Board:
         return: A list of tuples that contains all of the food on the board.
         '''
 
-        return [x.get_xy() for x in self.food]
+        return [self.grid.xy(x) for x in self.food_cells]
 
-    def get_nearest_food_distance(self, head: Coord) -> float:
+    def get_food_field(self) -> DistanceField:
         '''
-        Use this function to get the nearest food to the snakes head.
+        Use this function to get the distance from every cell to the nearest food, walking around snakes.
+
+        The field is built the first time it is asked for and then reused for the rest of the turn.
 
-        return: The rough distance to the food.
+        return: The DistanceField for the food on the board.
         '''
 
-        head = head.get_xy()
-        food = self.get_food()
+        if self._food_field is None:
+            self._food_field = DistanceField(self.grid, self.food_cells, self.occupied_mask)
 
-        # Check that there is food.
-        if len(food) <= 0:
-            return None
+        return self._food_field
+
+    def get_nearest_food_distance(self, head: Coord) -> int:
+        '''
+        Use this function to get the nearest food to the snakes head.
+
+        return: The number of moves to the food, or None if no food can be reached.
+        '''
 
-        distances = cdist([head], food, metric='cityblock')
-        nearest = distances.min()
+        if not self.grid.contains(head.x, head.y):
+            return None
 
-        return nearest
+        return self.get_food_field().get_distance(self.grid.index(head.x, head.y))
 
     def get_nearest_food_location(self, head: Coord) -> Coord:
         '''
@@ -119,25 +859,148 @@ class Board:
         return: The Coord representing where the nearest piece of food is.
         '''
 
-        head = head.get_xy()
-        food = self.get_food()
+        if not self.grid.contains(head.x, head.y):
+            return None
 
-        # Check that there is food.
-        if len(food) <= 0:
+        nearest = self.get_food_field().get_source(self.grid.index(head.x, head.y))
+        if nearest is None:
             return None
 
-        distances = cdist([head], food, metric='cityblock')
-        nearest_index = distances.argmin()
-        nearest = food[nearest_index]
+        return Coord(self.grid.xy(nearest))
+
+    def get_nearest_food_moves(self, head: Coord) -> set[str]:
+        '''
+        Use this function to get the moves that start the snake down a shortest path to the nearest food.
+
+        return: Set representing the first steps towards the nearest food.
+        '''
+
+        if not self.grid.contains(head.x, head.y):
+            return set()
+
+        return self.get_food_field().get_moves(self.grid.index(head.x, head.y))
+
+    def get_territory(self) -> dict:
+        '''
+        Use this function to find the cells and food that each snake can get to first, see get_voronoi().
+
+        return: A dictionary of snake id to a tuple of the number of cells and the number of food it owns.
+        '''
+
+        cells, eaten = get_territory(self.grid, (x.body_cells for x in self.snakes), self.food_mask)
+
+        return {x.id: (c, f) for x, c, f in zip(self.snakes, cells, eaten)}
+
+    def get_move_areas(self, snake: 'Snake', limit: int = None, constrictor: bool = False) -> dict:
+        '''
+        Use this function to find how much room the snake would have after each of its moves.
+
+        Every snake is assumed to move, so tails that will have moved off by the time we get there count as room.
+
+        limit: Stop counting once this many cells have been reached.
+        constrictor: True if every snake grows every turn, so no tail ever moves off.
 
-        return Coord(nearest)
+        return: A dictionary of every move that stays on the board and out of a body, to the number of cells it can reach.
+        '''
+
+        grid = self.grid
+        bodies = [x.body_cells for x in self.snakes]
+        if not any(x.id == snake.id for x in self.snakes):
+            bodies.append(snake.body_cells)
+
+        # Only the cells that are still there after one turn are in the way of the first step.
+        moving = 0
+        for body in bodies:
+            length = len(body)
+            for i, cell in enumerate(body):
+                if constrictor or length - i - 1 > 0:
+                    moving |= 1 << cell
+
+        areas = {}
+        for step, move in grid.directions[snake.head_cell].items():
+            if (moving >> step) & 1:
+                continue
+            areas[move] = get_reachable_area(grid, step, bodies, elapsed=1, limit=limit, constrictor=constrictor)
+
+        return areas
 
 class Snake:
-    def __init__(self, data):
-        self.head: Coord = Coord(data['head'])
-        self.body: tuple = tuple(Coord(x) for x in data['body'])
-        
+    def __init__(self, data, grid: Grid = None):
+        if grid is None:
+            grid = get_grid(*_get_extent(data))
+        self.grid: Grid = grid
+
+        self.id: str = data.get('id')
+        self.name: str = data.get('name')
+
+        # A request decoded by server_codec has its coordinates as cell indexes already.
+        if 'body_cells' in data:
+            self.head_cell: int = data['head_cell']
+            self.head: Coord = Coord(grid.xy(self.head_cell))
+            self.body_cells: tuple = data['body_cells']
+            self.body_mask: int = data['body_mask']
+        else:
+            self.head: Coord = Coord(data['head'])
+            self.head_cell: int = grid.index(self.head.x, self.head.y)
+            self.body_cells: tuple = tuple(grid.index(p['x'], p['y']) for p in data['body'])
+            self.body_mask: int = grid.mask(self.body_cells)
+
         self.health: int = data['health']
+        self.length: int = data.get('length', len(self.body_cells))
+
+    def advance(self, data) -> tuple:
+        '''
+        Use this function to move the snake on to the next turn from its new head and length.
+
+        The rest of the body follows on from the old body, so it doesn't have to be read again.
+
+        return: A tuple of the tail cell that was freed (or None) and the new head cell, or None if the new turn doesn't follow on from this one.
+        '''
+
+        grid = self.grid
+        if 'body_cells' in data:
+            head_cell = data['head_cell']
+            tail_cell = data['body_cells'][-1]
+            length = data.get('length', len(data['body_cells']))
+        else:
+            head = data['head']
+            tail = data['body'][-1]
+            head_cell = grid.index(head['x'], head['y'])
+            tail_cell = grid.index(tail['x'], tail['y'])
+            length = data.get('length', len(data['body']))
+
+        old = self.body_cells
+        if len(old) == 0 or length < len(old) or head_cell not in grid.neighbors[old[0]]:
+            return None
+
+        body = (head_cell,) + old[:-1]
+        # A snake that ate grows by stacking its last segment.
+        body += (body[-1],) * (length - len(old))
+
+        if tail_cell != body[-1]:
+            return None
+
+        freed = None
+        if old[-1] != body[-1]:
+            freed = old[-1]
+            self.body_mask &= ~(1 << freed)
+        self.body_mask |= 1 << head_cell
+
+        self.head = Coord(grid.xy(head_cell))
+        self.head_cell = head_cell
+        self.body_cells = body
+        self.health = data['health']
+        self.length = length
+
+        return (freed, head_cell)
+
+    @property
+    def body(self) -> tuple:
+        '''
+        The snake's body as Coords, only built when asked for.
+        '''
+
+        return tuple(Coord(self.grid.xy(x)) for x in self.body_cells)
 
     def get_neck(self) -> Coord:
         '''
@@ -146,7 +1009,7 @@ class Snake:
         return: The Coord of the neck.
         '''
 
-        return self.body[1]
+        return Coord(self.grid.xy(self.body_cells[1]))
 
     def get_neck_direction(self):
         '''
@@ -155,16 +1018,10 @@ class Snake:
         return: The direction of the neck relative to the head.
         '''
 
-        neck = self.get_neck().get_xy()
+        if len(self.body_cells) < 2:
+            return None
 
-        if neck == self.head.up:
-            return Move.up
-        if neck == self.head.down:
-            return Move.down
-        if neck == self.head.left:
-            return Move.left
-        if neck == self.head.right:
-            return Move.right
+        return self.grid.directions[self.head_cell].get(self.body_cells[1])
 
     def get_body(self) -> List[tuple]:
         '''
@@ -173,8 +1030,8 @@ class Snake:
         return: A list of tuples that contains all of the points of the snakes body.
         '''
 
-        return [x.get_xy() for x in self.body]
-    
+        return [self.grid.xy(x) for x in self.body_cells]
+
     def get_body_directions(self) -> set[str]:
         '''
         Use this function to rule out the possibility of running into any of the snake's body parts.
@@ -182,35 +1039,27 @@ class Snake:
         return: A list of moves that would kill the snake by eating itself.
         '''
 
-        body = self.get_body()
-        
-        moves: set[str] = set()
-        if self.head.up in body:
-            moves.add(Move.up)
-        if self.head.down in body:
-            moves.add(Move.down)
-        if self.head.left in body:
-            moves.add(Move.left)
-        if self.head.right in body:
-            moves.add(Move.right)
-
-        return moves
+        return self._get_directions(self.body_mask)
 
-    def get_food_directions(self, food: set[Coord]) -> set[str]:
+    def get_food_directions(self, food) -> set[str]:
         '''
         Use this function to rule out the possibility of eating unintentionally.
 
+        food: Either a bitmask of food cells or a collection of x,y tuples.
+
         return: Set representing all moves where the snake would get food.
         '''
-    
-        moves: set[str] = set()
-        if self.head.up in food:
-            moves.add(Move.up)
-        if self.head.down in food:
-            moves.add(Move.down)
-        if self.head.left in food:
-            moves.add(Move.left)
-        if self.head.right in food:
-            moves.add(Move.right)
-
-        return moves
\ No newline at end of file
+
+        if not isinstance(food, int):
+            food = self.grid.mask(self.grid.index(x, y) for x, y in food if self.grid.contains(x, y))
+
+        return self._get_directions(food)
+
+    def _get_directions(self, mask: int) -> set[str]:
+        '''
+        Use this function to find the moves that would put the head onto a cell of a bitmask.
+
+        return: Set representing all moves that land on the bitmask.
+        '''
+
+        return {move for cell, move in self.grid.directions[self.head_cell].items() if (mask >> cell) & 1}
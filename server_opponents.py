@@ -0,0 +1,334 @@
+import contextlib
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from server_codec import dumps, loads
+from server_models import MOVE_INDEX, MOVES, Move
+from server_rules import Position, SnakeState
+
+"""
+This file learns how each opponent picks its moves, so the search only looks at the moves it is likely to make.
+
+Every turn, the move each opponent made is recorded against what that move did: whether it went straight
+on, towards the nearest food, towards the middle of the board and towards our head. From
+those counts the model predicts how likely each of an opponent's moves is, and the search leaves out the
+unlikely ones, as long as they couldn't reach our head.
+
+Opponents are recorded under their snake id for the game, under their name and customizations, and
+under their author when the engine sends one, so what was learned in one game is used in the next.
+The most specific record with enough moves in it is the one that is used. Only so many records are
+kept, the ones used least recently are dropped first, and if OPPONENT_STATS is set to a file they are
+saved to it as games end, and read back when the server starts.
+"""
+
+# What a move can do, each one a bit of the move's features.
+STRAIGHT = 1
+TOWARDS_FOOD = 2
+TOWARDS_CENTER = 4
+TOWARDS_US = 8
+FEATURES = 16
+
+# How each move steps through x and y.
+_DIRECTIONS = {Move.up: (0, 1), Move.down: (0, -1), Move.left: (-1, 0), Move.right: (1, 0)}
+
+# How many moves an opponent has to have been seen making before its record is trusted.
+MIN_OBSERVATIONS = 20
+
+# Moves less likely than this are left out of the search, unless they could reach our head.
+PRUNE_PROBABILITY = 0.1
+
+# The most records that are kept.
+MAX_RECORDS = 4096
+
+# The least number of seconds between saves.
+SAVE_INTERVAL = 60
+
+class MoveStats:
+    '''
+    How often an opponent picked a move with each set of features, out of how often it could have.
+    '''
+
+    __slots__ = ('chosen', 'offered', 'observations', '_weights')
+
+    def __init__(self, chosen: list = None, offered: list = None, observations: int = 0):
+        self.chosen: list = chosen or [0] * FEATURES
+        self.offered: list = offered or [0] * FEATURES
+        self.observations = observations
+        self._weights: list = None
+
+    def record(self, features: dict, move: str):
+        '''
+        Use this function to add a move the opponent made.
+
+        features: The features of every move the opponent could have made, keyed by move.
+        '''
+
+        for x in features.values():
+            self.offered[x] += 1
+        self.chosen[features[move]] += 1
+        self.observations += 1
+        self._weights = None
+
+    def get_weights(self) -> list:
+        '''
+        Use this function to get how often a move with each set of features is picked, worked out once per record.
+
+        return: A list of the share of moves picked, indexed by features.
+        '''
+
+        weights = self._weights
+        if weights is None:
+            # Features that haven't been seen yet are given even odds.
+            weights = self._weights = [(c + 1) / (o + 2) for c, o in zip(self.chosen, self.offered)]
+
+        return weights
+
+    def predict(self, features: dict) -> dict:
+        '''
+        Use this function to get how likely the opponent is to make each of its moves.
+
+        features: The features of every move the opponent can make, keyed by move.
+
+        return: The probability of each move.
+        '''
+
+        weights = self.get_weights()
+        total = sum(weights[x] for x in features.values())
+
+        return {k: weights[x] / total for k, x in features.items()}
+
+    def prune(self, position: Position, snake: SnakeState, moves: list, you: SnakeState) -> list:
+        '''
+        Use this function to leave out the moves the opponent is unlikely to make.
+
+        you: Our snake. Moves onto the cells next to our head are always kept.
+
+        return: The moves that are kept, in the order they were given.
+        '''
+
+        weights = self.get_weights()
+        features = get_features(position, snake, moves, you)
+        scores = [weights[features[x]] for x in moves]
+        cutoff = PRUNE_PROBABILITY * sum(scores)
+
+        threatened = position.grid.neighbors[you.head]
+        steps = position.grid.steps[snake.head]
+        kept = [x for x, score in zip(moves, scores) if score >= cutoff or steps[MOVE_INDEX[x]] in threatened]
+        if not kept:
+            kept = [moves[scores.index(max(scores))]]
+
+        return kept
+
+def get_features(position: Position, snake: SnakeState, moves: list, you: SnakeState = None) -> dict:
+    '''
+    Use this function to work out what each of a snake's moves would do.
+
+    Each target is a single cell, and a move goes towards it when it steps the way the target is, the short way round on a wrapped board.
+
+    you: Our snake, if the snake is an opponent.
+
+    return: The features of each move, as bits, keyed by move.
+    '''
+
+    grid = position.grid
+    head = snake.head
+
+    straight = None
+    body = snake.body
+    if len(body) > 1 and body[1] != head:
+        straight = grid.directions[body[1]].get(head)
+
+    targets = []
+    # A wrapped board has no middle.
+    if not grid.wrapped:
+        x, y = grid.xy(head)
+        targets.append((TOWARDS_CENTER, (grid.width - 1) / 2 - x, (grid.height - 1) / 2 - y))
+
+    # The nearest food as the crow flies.
+    nearest = None
+    for cell in grid.cells(position.food):
+        offset = grid.get_offset(head, cell)
+        if nearest is None or abs(offset[0]) + abs(offset[1]) < abs(nearest[0]) + abs(nearest[1]):
+            nearest = offset
+    if nearest is not None:
+        targets.append((TOWARDS_FOOD, *nearest))
+    if you is not None and you is not snake:
+        targets.append((TOWARDS_US, *grid.get_offset(head, you.head)))
+
+    features = {}
+    for move in moves:
+        dx, dy = _DIRECTIONS[move]
+        bits = STRAIGHT if move == straight else 0
+        for bit, tx, ty in targets:
+            if (dx and tx * dx > 0) or (dy and ty * dy > 0):
+                bits |= bit
+        features[move] = bits
+
+    return features
+
+def get_identities(snake: dict) -> list:
+    '''
+    Use this function to get the keys an opponent is recorded under, the most specific first.
+
+    return: A list of keys.
+    '''
+
+    customizations = snake.get('customizations') or {}
+    identities = [
+        f"id:{snake.get('id')}",
+        f"snake:{snake.get('name')}|{customizations.get('color')}|{customizations.get('head')}|{customizations.get('tail')}",
+    ]
+    if snake.get('author'):
+        identities.append(f"author:{snake['author']}")
+
+    return identities
+
+class OpponentModel:
+    def __init__(self, max_records: int = MAX_RECORDS, path: str = None):
+        '''
+        max_records: The most records that are kept, the ones used least recently are dropped first.
+        path: The file the records are saved to and read from, if any.
+        '''
+
+        self.max_records = max_records
+        self.path = path
+        self._records: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        # Held while saving, apart from the lock on the records so moves aren't held up by the file being written.
+        self._saving = threading.Lock()
+        self._last_save = 0.0
+
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def get(self, key: str) -> MoveStats:
+        '''
+        Use this function to get a record, which counts as using it.
+
+        return: The MoveStats, or None if there isn't one.
+        '''
+
+        with self._lock:
+            stats = self._records.get(key)
+            if stats is not None:
+                self._records.move_to_end(key)
+
+        return stats
+
+    def _get_or_add(self, key: str) -> MoveStats:
+        stats = self._records.get(key)
+        if stats is None:
+            stats = self._records[key] = MoveStats()
+            while len(self._records) > self.max_records:
+                self._records.popitem(last=False)
+        else:
+            self._records.move_to_end(key)
+
+        return stats
+
+    def observe(self, before: Position, after: Position, snakes: list, you: str):
+        '''
+        Use this function every turn to record the moves the opponents made since the last one.
+
+        before, after: The Positions of the last turn and this one.
+        snakes: The snakes of this turn's move request.
+        '''
+
+        grid = before.grid
+        for data in snakes:
+            if data['id'] == you:
+                continue
+            old = before.get_snake(data['id'])
+            new = after.get_snake(data['id'])
+            if old is None or new is None:
+                continue
+            move = grid.directions[old.head].get(new.head)
+            if move is None:
+                continue
+
+            features = get_features(before, old, before.get_moves(old) or list(MOVES), before.get_snake(you))
+            if move not in features:
+                continue
+            with self._lock:
+                for key in get_identities(data):
+                    self._get_or_add(key).record(features, move)
+
+    def get_predictors(self, snakes: list, you: str) -> dict:
+        '''
+        Use this function to get the record to predict each opponent with.
+
+        return: The MoveStats of every opponent that has been seen enough, keyed by snake id.
+        '''
+
+        predictors = {}
+        for data in snakes:
+            if data['id'] == you:
+                continue
+            for key in get_identities(data):
+                stats = self.get(key)
+                if stats is not None and stats.observations >= MIN_OBSERVATIONS:
+                    predictors[data['id']] = stats
+                    break
+
+        return predictors
+
+    def save(self, path: str = None, force: bool = False) -> bool:
+        '''
+        Use this function to save the records that outlast a game, at most once every SAVE_INTERVAL seconds.
+
+        force: Save even if the last save was recent.
+
+        return: True if the records were saved.
+        '''
+
+        path = path or self.path
+        if path is None:
+            return False
+
+        # Games can end at the same time, and they save one after the other.
+        with self._saving:
+            now = time.monotonic()
+            if not force and now - self._last_save < SAVE_INTERVAL:
+                return False
+            self._last_save = now
+
+            # Snake ids are only ever seen in one game, so they aren't worth keeping.
+            with self._lock:
+                records = {k: [list(v.chosen), list(v.offered), v.observations] for k, v in self._records.items() if not k.startswith('id:')}
+
+            # Written to the side and moved into place, so a crash never leaves half a file.
+            handle, partial = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=os.path.basename(path), suffix='.partial')
+            try:
+                with os.fdopen(handle, 'wb') as f:
+                    f.write(dumps(records))
+                os.replace(partial, path)
+            except BaseException:
+                with contextlib.suppress(OSError):
+                    os.remove(partial)
+                raise
+
+        return True
+
+    def load(self, path: str):
+        '''
+        Use this function to read saved records, in the order they were last used.
+        '''
+
+        with open(path, 'rb') as f:
+            records = loads(f.read())
+
+        with self._lock:
+            for key, (chosen, offered, observations) in records.items():
+                self._records[key] = MoveStats(chosen, offered, observations)
+                self._records.move_to_end(key)
+            while len(self._records) > self.max_records:
+                self._records.popitem(last=False)
+
+# Shared by every game the process plays.
+model = OpponentModel(path=os.environ.get('OPPONENT_STATS') or None)
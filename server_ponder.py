@@ -0,0 +1,106 @@
+import contextlib
+import threading
+import time
+
+from server_rules import Position
+from server_search import Search
+from server_table import TranspositionTable
+
+"""
+This file keeps searching a game in the background once its move has been answered, while we wait for the next one.
+
+The search is started from the position we answered, with only the move we picked, so every reply the
+opponents could make is searched and each position we could find ourselves in next turn is kept in the
+game's transposition table. When the next /move comes in its position is one of those, and the search
+picks up from the table instead of starting from nothing.
+
+Pondering only uses time nothing else wants: every ponder in the process is stopped as soon as a move
+starts being picked, and none is started while another move is still being picked.
+"""
+
+# The most seconds a game is pondered for, in case its next move never comes.
+MAX_PONDER_TIME = 2.0
+
+_lock = threading.Lock()
+# How many moves are being picked in this process right now.
+_picking = 0
+# Every Ponder that is running.
+_running: set = set()
+
+class Ponder:
+    def __init__(self, position: Position, you: str, move: str, table: TranspositionTable, duration: float = MAX_PONDER_TIME, predictors: dict = None):
+        '''
+        position: The position we have just answered.
+        move: The move we answered with.
+        table: The game's TranspositionTable, which the ponder fills for the next turn.
+        duration: The most seconds to ponder for.
+        predictors: The MoveStats of the opponents, the same as the search used.
+        '''
+
+        self.move = move
+        self.duration = min(duration, MAX_PONDER_TIME)
+        self.search = Search(position, you, 0, table, predictors)
+        self.result: tuple = None
+        self.thread: threading.Thread = None
+
+    def start(self) -> bool:
+        '''
+        Use this function to start pondering in the background, if no move is being picked.
+
+        return: True if the ponder was started.
+        '''
+
+        with _lock:
+            if _picking or self.thread is not None:
+                return False
+            self.search.deadline = time.perf_counter() + self.duration
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            _running.add(self)
+            # Started under the lock, so stop_all() never finds a thread it can't join yet.
+            self.thread.start()
+
+        return True
+
+    def _run(self):
+        try:
+            self.result = self.search.run([self.move])
+        finally:
+            with _lock:
+                _running.discard(self)
+
+    def stop(self):
+        '''
+        Use this function to stop pondering, it returns once the table is no longer being written to.
+        '''
+
+        # The search checks its deadline at every node, so moving it up stops the search straight away.
+        self.search.deadline = 0
+        if self.thread is not None:
+            self.thread.join()
+
+def stop_all():
+    '''
+    Use this function to stop every ponder in the process.
+    '''
+
+    with _lock:
+        running = list(_running)
+    for ponder in running:
+        ponder.stop()
+
+@contextlib.contextmanager
+def picking():
+    '''
+    Use this function around picking a move, so nothing is pondered while it runs.
+    '''
+
+    global _picking
+
+    with _lock:
+        _picking += 1
+    try:
+        stop_all()
+        yield
+    finally:
+        with _lock:
+            _picking -= 1
@@ -0,0 +1,579 @@
+import argparse
+import atexit
+import bisect
+import contextlib
+import json
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+from array import array
+from collections import deque
+
+from server_codec import dumps, loads
+from server_log import logger
+from server_models import MOVES, Board, get_grid, is_wrapped
+from server_rules import Position, Ruleset, SnakeState
+
+"""
+This file records every game we play into a small binary log, one file per game, for replays and tuning.
+
+A move request is mostly the same as the one before it, so only what changed is written: the move each
+snake made, how much it grew and its health, the food that appeared and went, the hazards when they
+move, the snakes that were eliminated, and the move we picked with its score and how long it took.
+A turn of a 2 snake game takes about 35 bytes with our move, where its JSON takes 800 or so. Whenever a turn
+doesn't follow on from the last one, say a request was missed, the whole position is written instead.
+
+Recording is done on a background thread, the request only queues what it was sent. Set GAME_RECORDS
+to the folder to record into, nothing is recorded without it. Each game has to be played by one process,
+as it is with server_dispatch.py.
+
+GameRecord reads a recording back. The file is memory mapped and only the record headers are read up
+front, positions are rebuilt from the nearest full position when they are asked for. To replay the
+recordings with server_bench.py, or turn them into JSON lines:
+
+    python server_bench.py records/
+    python server_recorder.py records/ --jsonl moves.jsonl
+"""
+
+MAGIC = b'SNKREC01'
+EXTENSION = '.snkrec'
+
+# Every record is its type and the length of what follows.
+RECORD = struct.Struct('<BH')
+
+# The types of record.
+HEADER = 1      # JSON: the game, our snake id, and the size of the board. Written each time the file is opened, and the slots start again.
+SNAKES = 2      # JSON: the ids of snakes seen for the first time, given the next slots in order.
+KEYFRAME = 3    # A whole position.
+TURN = 4        # What changed since the last turn.
+HAZARDS = 5     # Every hazard cell, when they have changed.
+DECISION = 6    # The move we picked.
+END = 7         # The game is over.
+
+# Turn, food count, hazard count and snake count, then the cells of each. Then each snake is its slot, health and length, then its cells.
+_KEYFRAME = struct.Struct('<HHHB')
+_KEYFRAME_SNAKE = struct.Struct('<BBH')
+
+# Turn, snake count, food added and food removed counts. Then each snake is its slot, its move with what it grew by
+# shifted up 2 bits, and its health. Then the cells of the food. A snake that isn't there was eliminated.
+_TURN = struct.Struct('<HBBB')
+_TURN_SNAKE = struct.Struct('<BBB')
+
+# Turn and hazard count, then the cells.
+_HAZARDS = struct.Struct('<HH')
+
+# Turn, move, strategy, effort, score and the milliseconds it took.
+_DECISION = struct.Struct('<HBBIff')
+
+# Where each move came from, 255 for anywhere else.
+STRATEGIES = ('search', 'mcts', 'book', 'tablebase')
+
+# How many requests can wait to be recorded. Any more are dropped, and the game starts again from a keyframe.
+MAX_PENDING = 4096
+
+# The seconds a game goes without a request before its file is closed.
+IDLE_TIMEOUT = 300
+
+class GameWriter:
+    def __init__(self, path: str, data: dict):
+        '''
+        path: The file to append the game to.
+        data: The first request of the game that was seen.
+        '''
+
+        self.path = path
+        self.wrapped = is_wrapped(data['game'])
+        self.file = open(path, 'ab')
+        self.last_write = time.monotonic()
+
+        # Everything written is buffered until the batch is flushed.
+        self.buffer = bytearray()
+        if self.file.tell() == 0:
+            self.buffer += MAGIC
+
+        self.slots: dict = {}
+        # What was recorded last, by slot, to work the next turn out from.
+        self.turn: int = None
+        self.bodies: dict = {}
+        self.food: int = 0
+        self.hazards: tuple = ()
+
+        board = data['board']
+        self.write(HEADER, dumps({'game': data['game'], 'you': (data.get('you') or {}).get('id'), 'width': board['width'], 'height': board['height']}))
+
+    def write(self, kind: int, payload: bytes):
+        self.buffer += RECORD.pack(kind, len(payload))
+        self.buffer += payload
+
+    def flush(self):
+        if self.buffer:
+            size = self.file.tell()
+            try:
+                self.file.write(self.buffer)
+                self.file.flush()
+            except (OSError, ValueError):
+                # Whatever got written is cut off again, so the records after it still line up, and what was
+                # buffered is lost. The next turn is written as a keyframe.
+                self.buffer = bytearray()
+                self.turn = None
+                with contextlib.suppress(OSError, ValueError):
+                    self.file.truncate(size)
+                raise
+            self.buffer = bytearray()
+            self.last_write = time.monotonic()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.file.close()
+
+    def observe(self, data: dict):
+        '''
+        Use this function to record the position of a request, as a turn if it follows on from the last one.
+        '''
+
+        turn = data['turn']
+        if turn == self.turn:
+            return
+        board = Board(data['board'], self.wrapped)
+        grid = board.grid
+
+        added = [x.id for x in board.snakes if x.id not in self.slots]
+        if added:
+            for id in added:
+                self.slots[id] = len(self.slots)
+            self.write(SNAKES, dumps(added))
+
+        bodies = {self.slots[x.id]: (tuple(x.body_cells), x.health) for x in board.snakes}
+        hazards = tuple(board.hazard_cells)
+
+        changes = None
+        if self.turn is not None and turn == self.turn + 1:
+            changes = []
+            for slot, (body, health) in bodies.items():
+                before = self.bodies.get(slot)
+                move = grid.directions[before[0]].get(body[0]) if before else None
+                grown = len(body) - len(before) if before else -1
+                if move is None or not 0 <= grown <= 3:
+                    changes = None
+                    break
+                moved = (body[0],) + before[:-1]
+                if moved + (moved[-1],) * grown != body:
+                    changes = None
+                    break
+                changes.append((slot, MOVES.index(move) | grown << 2, health))
+
+        if changes is None:
+            food = tuple(board.food_cells)
+            payload = bytearray(_KEYFRAME.pack(turn, len(food), len(hazards), len(bodies)))
+            payload += array('H', food).tobytes() + array('H', hazards).tobytes()
+            for slot, (body, health) in bodies.items():
+                payload += _KEYFRAME_SNAKE.pack(slot, health, len(body)) + array('H', body).tobytes()
+            self.write(KEYFRAME, bytes(payload))
+        else:
+            added = tuple(grid.cells(board.food_mask & ~self.food))
+            removed = tuple(grid.cells(self.food & ~board.food_mask))
+            payload = bytearray(_TURN.pack(turn, len(changes), len(added), len(removed)))
+            for change in changes:
+                payload += _TURN_SNAKE.pack(*change)
+            payload += array('H', added + removed).tobytes()
+            self.write(TURN, bytes(payload))
+            if hazards != self.hazards:
+                self.write(HAZARDS, _HAZARDS.pack(turn, len(hazards)) + array('H', hazards).tobytes())
+
+        self.turn = turn
+        self.bodies = {slot: body for slot, (body, health) in bodies.items()}
+        self.food = board.food_mask
+        self.hazards = hazards
+
+    def decide(self, turn: int, move: str, decision: tuple, milliseconds: float):
+        '''
+        Use this function to record the move we picked.
+
+        decision: A tuple of the strategy, score and effort of the move, or None if it was picked at random.
+        '''
+
+        strategy, score, effort = decision or (None, 0.0, 0)
+        code = STRATEGIES.index(strategy) if strategy in STRATEGIES else 255
+        self.write(DECISION, _DECISION.pack(turn, MOVES.index(move), code, max(0, min(int(effort), 2 ** 32 - 1)), score, milliseconds))
+
+class Recorder:
+    def __init__(self, folder: str = None, max_pending: int = MAX_PENDING):
+        '''
+        folder: Where the games are recorded, or None to record nothing.
+        '''
+
+        self.folder = folder
+        self.max_pending = max_pending
+        self.dropped = 0
+
+        self._pending = deque()
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._thread: threading.Thread = None
+        self._games: dict = {}
+
+    def _queue(self, item: tuple):
+        if self.folder is None:
+            return
+        if len(self._pending) >= self.max_pending:
+            self.dropped += 1
+            return
+
+        self._pending.append(item)
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    os.makedirs(self.folder, exist_ok=True)
+                    self._thread = threading.Thread(target=self._run, daemon=True)
+                    self._thread.start()
+        self._wake.set()
+
+    def start(self, data: dict):
+        '''
+        Use this function on /start.
+        '''
+
+        self._queue(('start', data))
+
+    def move(self, data: dict, move: str, decision: tuple, milliseconds: float):
+        '''
+        Use this function once we have picked our move for a request.
+
+        decision: A tuple of the strategy, score and effort of the move, or None.
+        milliseconds: How long the move took to pick.
+        '''
+
+        self._queue(('move', data, move, decision, milliseconds))
+
+    def end(self, data: dict):
+        '''
+        Use this function on /end.
+        '''
+
+        self._queue(('end', data))
+
+    def get_path(self, game_id: str) -> str:
+        '''
+        Use this function to get the file a game is recorded to.
+
+        return: The path.
+        '''
+
+        return os.path.join(self.folder, re.sub(r'[^A-Za-z0-9_.-]', '_', game_id) + EXTENSION)
+
+    def _run(self):
+        while True:
+            # Woken up now and then even with nothing to record, so idle games are closed.
+            self._wake.wait(IDLE_TIMEOUT)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                # Logged rather than ending the thread, so the next games are still recorded.
+                logger.error('record_failed', error=repr(e))
+
+    def flush(self):
+        '''
+        Use this function to record everything that is waiting, it returns once it is written.
+        '''
+
+        with self._lock:
+            touched = set()
+            while self._pending:
+                item = self._pending.popleft()
+                kind, data = item[0], item[1]
+                game_id = data['game']['id']
+                try:
+                    writer = self._games.get(game_id)
+                    if writer is None:
+                        writer = self._games[game_id] = GameWriter(self.get_path(game_id), data)
+                    writer.observe(data)
+                    if kind == 'move':
+                        writer.decide(data['turn'], *item[2:])
+                    elif kind == 'end':
+                        writer.write(END, struct.pack('<H', data['turn']))
+                        self._close_writer(game_id, self._games.pop(game_id))
+                        continue
+                    touched.add(game_id)
+                except Exception as e:
+                    logger.error('record_failed', game=game_id, error=repr(e))
+
+            for game_id in touched:
+                writer = self._games.get(game_id)
+                if writer is not None:
+                    self._flush_writer(game_id, writer)
+
+            # Games that never sent /end.
+            now = time.monotonic()
+            for game_id, writer in list(self._games.items()):
+                if now - writer.last_write > IDLE_TIMEOUT:
+                    self._close_writer(game_id, self._games.pop(game_id))
+
+    def _flush_writer(self, game_id: str, writer: GameWriter):
+        try:
+            writer.flush()
+        except (OSError, ValueError) as e:
+            logger.error('record_failed', game=game_id, error=repr(e))
+
+    def _close_writer(self, game_id: str, writer: GameWriter):
+        try:
+            writer.close()
+        except (OSError, ValueError) as e:
+            logger.error('record_failed', game=game_id, error=repr(e))
+
+    def close(self):
+        '''
+        Use this function to record what is waiting and close every game's file, when the process exits.
+        '''
+
+        self.flush()
+        with self._lock:
+            games, self._games = self._games, {}
+        for game_id, writer in games.items():
+            self._close_writer(game_id, writer)
+
+class GameRecord:
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{path} is not a game recording')
+
+        self.game: dict = None
+        self.you: str = None
+        self.grid = None
+        self.rules: Ruleset = None
+
+        # The type, start and length of every record, the turn of every position record, and where the keyframes are.
+        self._records: list = []
+        self._turns: list = []
+        self._positions: list = []
+        # The snake id of each slot, for every position. A writer that opens the file again starts the slots again.
+        self._ids: list = []
+        self._keyframes: list = []
+        self._decisions: dict = {}
+
+        view = self._map
+        offset = len(MAGIC)
+        ids = []
+        while offset + RECORD.size <= len(view):
+            kind, length = RECORD.unpack_from(view, offset)
+            start = offset + RECORD.size
+            if start + length > len(view):
+                # The last record was cut off part way through writing it.
+                break
+            index = len(self._records)
+            self._records.append((kind, start, length))
+            offset = start + length
+
+            if kind == HEADER:
+                ids = []
+                if self.game is None:
+                    header = loads(view[start:start + length])
+                    self.game = header['game']
+                    self.you = header['you']
+                    self.grid = get_grid(header['width'], header['height'], is_wrapped(self.game))
+                    self.rules = Ruleset.from_game(self.game)
+            elif kind == SNAKES:
+                ids.extend(loads(view[start:start + length]))
+            elif kind in (KEYFRAME, TURN):
+                (turn,) = struct.unpack_from('<H', view, start)
+                self._turns.append(turn)
+                self._positions.append(index)
+                self._ids.append(ids)
+                if kind == KEYFRAME:
+                    self._keyframes.append(len(self._positions) - 1)
+            elif kind == DECISION:
+                (turn,) = struct.unpack_from('<H', view, start)
+                self._decisions[turn] = index
+
+    def __len__(self) -> int:
+        return len(self._turns)
+
+    def close(self):
+        self._map.close()
+
+    @property
+    def turns(self) -> list:
+        '''
+        The turn of every position in the recording, in order.
+        '''
+
+        return list(self._turns)
+
+    def get_decision(self, turn: int) -> tuple:
+        '''
+        Use this function to get the move we picked on a turn.
+
+        return: A tuple of the move, the strategy, the effort, the score and the milliseconds it took, or None if we didn't pick one.
+        '''
+
+        index = self._decisions.get(turn)
+        if index is None:
+            return None
+        kind, start, length = self._records[index]
+        _, move, code, effort, score, milliseconds = _DECISION.unpack_from(self._map, start)
+
+        return (MOVES[move], STRATEGIES[code] if code < len(STRATEGIES) else None, effort, score, milliseconds)
+
+    def get_position(self, turn: int) -> Position:
+        '''
+        Use this function to rebuild the position of a turn, from the last keyframe before it.
+
+        return: The Position, or None if the turn wasn't recorded.
+        '''
+
+        found = bisect.bisect_left(self._turns, turn)
+        if found == len(self._turns) or self._turns[found] != turn:
+            return None
+
+        # The turns between the keyframe and this one are played forward.
+        keyframe = self._keyframes[bisect.bisect_right(self._keyframes, found) - 1]
+        state = None
+        for i in range(keyframe, found + 1):
+            state = self._apply(state, i)
+
+        return self._build(state)
+
+    def positions(self):
+        '''
+        Use this function to rebuild every position of the recording, in order, in one pass.
+
+        return: An iterator of Positions.
+        '''
+
+        state = None
+        for i in range(len(self._positions)):
+            state = self._apply(state, i)
+            yield self._build(state)
+
+    def get_move_requests(self):
+        '''
+        Use this function to rebuild the move request of every turn we picked a move on, for replaying.
+
+        return: An iterator of move request dictionaries, as server_simulator.get_move_request() builds them.
+        '''
+
+        import server_simulator
+
+        for position in self.positions():
+            if position.turn in self._decisions and position.get_snake(self.you) is not None:
+                yield server_simulator.get_move_request(self.game, position, self.you)
+
+    def _apply(self, state: dict, position: int) -> dict:
+        '''
+        Use this function to move a state on by one position record, and by the hazard record after it.
+
+        position: The index of the position record, in the order they were recorded.
+
+        return: The new state: the turn, the body and health of each slot, the id of each slot, the food mask and the hazard cells.
+        '''
+
+        view = self._map
+        grid = self.grid
+        index = self._positions[position]
+        kind, start, length = self._records[index]
+
+        if kind == KEYFRAME:
+            turn, food_count, hazard_count, snake_count = _KEYFRAME.unpack_from(view, start)
+            offset = start + _KEYFRAME.size
+            cells = array('H', view[offset:offset + 2 * (food_count + hazard_count)])
+            offset += 2 * (food_count + hazard_count)
+            snakes = {}
+            for _ in range(snake_count):
+                slot, health, body_length = _KEYFRAME_SNAKE.unpack_from(view, offset)
+                offset += _KEYFRAME_SNAKE.size
+                snakes[slot] = (tuple(array('H', view[offset:offset + 2 * body_length])), health)
+                offset += 2 * body_length
+            state = {'turn': turn, 'snakes': snakes, 'ids': self._ids[position], 'food': grid.mask(cells[:food_count]), 'hazards': tuple(cells[food_count:])}
+        else:
+            turn, snake_count, added_count, removed_count = _TURN.unpack_from(view, start)
+            offset = start + _TURN.size
+            snakes = {}
+            for _ in range(snake_count):
+                slot, code, health = _TURN_SNAKE.unpack_from(view, offset)
+                offset += _TURN_SNAKE.size
+                body = state['snakes'][slot][0]
+                moved = (grid.steps[body[0]][code & 3],) + body[:-1]
+                snakes[slot] = (moved + (moved[-1],) * (code >> 2), health)
+            cells = array('H', view[offset:offset + 2 * (added_count + removed_count)])
+            food = (state['food'] | grid.mask(cells[:added_count])) & ~grid.mask(cells[added_count:])
+            state = {'turn': turn, 'snakes': snakes, 'ids': state['ids'], 'food': food, 'hazards': state['hazards']}
+
+        following = index + 1
+        if following < len(self._records) and self._records[following][0] == HAZARDS:
+            _, start, length = self._records[following]
+            turn, count = _HAZARDS.unpack_from(view, start)
+            offset = start + _HAZARDS.size
+            state['hazards'] = tuple(array('H', view[offset:offset + 2 * count]))
+
+        return state
+
+    def _build(self, state: dict) -> Position:
+        snakes = tuple(SnakeState(state['ids'][slot], body, health) for slot, (body, health) in state['snakes'].items())
+        hazards = state['hazards']
+
+        return Position(self.grid, snakes, state['food'], self.grid.mask(hazards), state['turn'], self.rules, self.rules.get_damage(self.grid, hazards))
+
+def get_paths(path: str) -> list:
+    '''
+    Use this function to find the recordings in a folder, or a single recording.
+
+    return: A sorted list of paths.
+    '''
+
+    if os.path.isdir(path):
+        return sorted(os.path.join(path, x) for x in os.listdir(path) if x.endswith(EXTENSION))
+
+    return [path]
+
+def read_requests(path: str, limit: int = None):
+    '''
+    Use this function to stream the move requests we answered out of a recording, or a folder of them.
+
+    return: An iterator of move request dictionaries.
+    '''
+
+    count = 0
+    for file in get_paths(path):
+        record = GameRecord(file)
+        try:
+            for data in record.get_move_requests():
+                if limit is not None and count >= limit:
+                    return
+                count += 1
+                yield data
+        finally:
+            record.close()
+
+# Shared by every game the process plays.
+recorder = Recorder(os.environ.get('GAME_RECORDS') or None)
+atexit.register(recorder.close)
+
+def main():
+    parser = argparse.ArgumentParser(description='Summarize game recordings, or turn them into JSON lines of move requests.')
+    parser.add_argument('path', help='a recording, or a folder of them')
+    parser.add_argument('--jsonl', help='write the move requests we answered to this file')
+    args = parser.parse_args()
+
+    if args.jsonl:
+        with open(args.jsonl, 'w') as f:
+            for data in read_requests(args.path):
+                f.write(json.dumps(data) + '\n')
+
+    for file in get_paths(args.path):
+        record = GameRecord(file)
+        decisions = [record.get_decision(x) for x in record.turns]
+        times = [x[4] for x in decisions if x is not None]
+        record.close()
+        size = os.path.getsize(file)
+        print(f'{os.path.basename(file)}: {len(record)} turns, {size} bytes ({size / max(len(record), 1):.1f} per turn)'
+              + (f', mean move {sum(times) / len(times):.1f}ms' if times else ''))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,338 @@
+from functools import lru_cache
+
+from server_models import MOVES, Board, Grid, Move
+
+"""
+This file is a small, fast copy of the standard Battlesnake rules, used to look ahead at future turns.
+
+Positions are immutable, every call to advance() builds a new one, so a search can branch from any of them.
+See https://docs.battlesnake.com/guides/game/rules for the rules that are being followed.
+
+The variants of the standard rules are followed too, as the Ruleset of the game says: hazards take health
+from a snake whose head is in them, royale hazards close in from the edges every so many turns, and in
+constrictor every snake grows every turn and never gets hungry. Where the hazards are going to be next
+can't be known, one side of the board is picked at random, so the search expects every side to close in.
+"""
+
+MAX_HEALTH = 100
+
+# The health a hazard takes each turn, and the turns between royale shrinks, unless the game says otherwise.
+HAZARD_DAMAGE = 14
+SHRINK_EVERY_N_TURNS = 25
+
+# The rulesets where every snake grows every turn.
+CONSTRICTOR_RULESETS = {'constrictor', 'wrapped_constrictor'}
+
+# Why a snake was eliminated, named the same as in the engine.
+OUT_OF_HEALTH = 'out-of-health'
+WALL_COLLISION = 'wall-collision'
+SELF_COLLISION = 'snake-self-collision'
+SNAKE_COLLISION = 'snake-collision'
+HEAD_COLLISION = 'head-collision'
+
+class SnakeState:
+    __slots__ = ('id', 'body', 'health')
+
+    def __init__(self, id: str, body: tuple, health: int):
+        self.id = id
+        # Cell indexes from head to tail.
+        self.body = body
+        self.health = health
+
+    @property
+    def head(self) -> int:
+        return self.body[0]
+
+    @property
+    def length(self) -> int:
+        return len(self.body)
+
+class Ruleset:
+    __slots__ = ('name', 'hazard_damage', 'shrink_every', 'constrictor')
+
+    def __init__(self, name: str = 'standard', hazard_damage: int = HAZARD_DAMAGE, shrink_every: int = 0, constrictor: bool = False):
+        '''
+        hazard_damage: The health a hazard takes each turn.
+        shrink_every: The turns between royale shrinks, or 0 if the hazards never move.
+        constrictor: True if every snake grows every turn.
+        '''
+
+        self.name = name
+        self.hazard_damage = hazard_damage
+        self.shrink_every = shrink_every
+        self.constrictor = constrictor
+
+    @classmethod
+    def from_game(cls, game: dict) -> 'Ruleset':
+        '''
+        Use this function to get the Ruleset of a game, from the game of a move request.
+
+        return: The Ruleset, with the defaults of the engine for any setting that wasn't sent.
+        '''
+
+        ruleset = game.get('ruleset') or {}
+        name = ruleset.get('name', 'standard')
+        settings = ruleset.get('settings') or {}
+
+        shrink_every = 0
+        if name == 'royale':
+            shrink_every = (settings.get('royale') or {}).get('shrinkEveryNTurns') or SHRINK_EVERY_N_TURNS
+
+        return cls(name, settings.get('hazardDamagePerTurn', HAZARD_DAMAGE), shrink_every, name in CONSTRICTOR_RULESETS)
+
+    def get_damage(self, grid: Grid, hazards) -> tuple:
+        '''
+        Use this function to get the health a snake loses for ending its turn in each cell.
+
+        hazards: The hazard cells, a cell that is listed more than once does damage for each time it is.
+
+        return: A tuple of the damage, indexed by cell.
+        '''
+
+        if not hazards or not self.hazard_damage:
+            return _get_no_damage(grid)
+
+        damage = [0] * grid.size
+        for cell in hazards:
+            damage[cell] += self.hazard_damage
+
+        return tuple(damage)
+
+    def shrinks(self, turn: int) -> bool:
+        '''
+        Use this function to check if the hazards close in at the start of a turn.
+
+        return: True if they do.
+        '''
+
+        return self.shrink_every > 0 and turn > 0 and turn % self.shrink_every == 0
+
+STANDARD = Ruleset()
+
+@lru_cache(maxsize=None)
+def _get_no_damage(grid: Grid) -> tuple:
+    return (0,) * grid.size
+
+@lru_cache(maxsize=4096)
+def get_shrink(grid: Grid, hazards: int) -> int:
+    '''
+    Use this function to get every cell the royale hazards could close in on next.
+
+    The engine picks one side of the safe area at random, so all four of them are returned.
+
+    return: The bitmask of cells.
+    '''
+
+    safe = [grid.xy(x) for x in grid.cells(grid.full & ~hazards)]
+    if not safe:
+        return 0
+
+    left = min(x for x, y in safe)
+    right = max(x for x, y in safe)
+    bottom = min(y for x, y in safe)
+    top = max(y for x, y in safe)
+
+    return grid.mask(grid.index(x, y) for x, y in safe if x in (left, right) or y in (bottom, top))
+
+class Position:
+    __slots__ = ('grid', 'snakes', 'food', 'hazards', 'turn', 'rules', 'damage', '_blocked')
+
+    def __init__(self, grid: Grid, snakes: tuple, food: int, hazards: int = 0, turn: int = 0, rules: Ruleset = STANDARD, damage: tuple = None):
+        '''
+        rules: The Ruleset the game is played by.
+        damage: The health a snake loses for ending its turn in each cell, see Ruleset.get_damage(). Defaults
+        to one hazard in every hazard cell.
+        '''
+
+        self.grid = grid
+        self.snakes = snakes
+        self.food = food
+        self.hazards = hazards
+        self.turn = turn
+        self.rules = rules
+        if damage is None:
+            damage = rules.get_damage(grid, tuple(grid.cells(hazards)))
+        self.damage = damage
+        self._blocked = None
+
+    @classmethod
+    def from_board(cls, board: Board, turn: int = 0, rules: Ruleset = STANDARD, damage: tuple = None) -> 'Position':
+        '''
+        Use this function to get the Position for a Board.
+
+        damage: The damage of the board's hazards, if it has already been worked out.
+
+        return: The Position with every snake that is on the board.
+        '''
+
+        snakes = tuple(SnakeState(x.id, x.body_cells, x.health) for x in board.snakes)
+        if damage is None:
+            damage = rules.get_damage(board.grid, board.hazard_cells)
+
+        return cls(board.grid, snakes, board.food_mask, board.hazard_mask, turn, rules, damage)
+
+    def get_snake(self, id: str) -> SnakeState:
+        '''
+        Use this function to find a snake that is still alive.
+
+        return: The SnakeState, or None if the snake has been eliminated.
+        '''
+
+        for snake in self.snakes:
+            if snake.id == id:
+                return snake
+
+    def get_blocked(self) -> int:
+        '''
+        Use this function to get every cell that a head can't move into next turn.
+
+        A tail moves out of the way unless the snake has just eaten, when its last segment is stacked.
+
+        return: The bitmask of blocked cells.
+        '''
+
+        if self._blocked is None:
+            blocked = 0
+            for snake in self.snakes:
+                body = snake.body
+                end = len(body) - 1
+                if end > 0 and body[end] == body[end - 1]:
+                    end += 1
+                for cell in body[:end]:
+                    blocked |= 1 << cell
+            self._blocked = blocked
+
+        return self._blocked
+
+    def get_moves(self, snake: SnakeState) -> list:
+        '''
+        Use this function to get the moves that don't walk a snake off the board or into a body.
+
+        return: A list of the moves, in the order of MOVES.
+        '''
+
+        blocked = self.get_blocked()
+
+        return [move for move, cell in zip(MOVES, self.grid.steps[snake.head]) if cell >= 0 and not (blocked >> cell) & 1]
+
+def get_default_move(position: Position, snake: SnakeState) -> str:
+    '''
+    Use this function to get a move for a snake that nobody has picked a move for.
+
+    return: The first move that doesn't kill the snake, or up if every move does.
+    '''
+
+    moves = position.get_moves(snake)
+    if moves:
+        return moves[0]
+
+    return Move.up
+
+def _get_collision(snake: SnakeState, others: list) -> tuple:
+    '''
+    Use this function to find out why a snake whose head landed on a body was eliminated.
+
+    return: A tuple of the cause and the id of the snake it ran into.
+    '''
+
+    if snake.head in snake.body[1:]:
+        return (SELF_COLLISION, snake.id)
+
+    for other in others:
+        if other is not snake and snake.head in other.body[1:]:
+            return (SNAKE_COLLISION, other.id)
+
+def advance(position: Position, moves: dict, eliminated: list = None) -> Position:
+    '''
+    Use this function to play one turn of the rules of the position.
+
+    moves: The move for each snake id. Snakes without a move get get_default_move().
+    eliminated: If given, a tuple of snake id, cause and the id of the snake that eliminated it (or None)
+    is added for every snake that is eliminated, in the order the rules eliminate them.
+
+    return: The Position after every snake has moved, eaten and been eliminated.
+    '''
+
+    grid = position.grid
+    food = position.food
+    rules = position.rules
+    damage = position.damage
+    constrictor = rules.constrictor
+
+    moved = []
+    off_board = []
+    for snake in position.snakes:
+        move = moves.get(snake.id)
+        if move is None:
+            move = get_default_move(position, snake)
+
+        head = grid.step(snake.head, move)
+        if head < 0:
+            off_board.append(snake)
+            continue
+
+        body = (head,) + snake.body[:-1]
+        health = snake.health - 1
+
+        if (food >> head) & 1:
+            health = MAX_HEALTH
+            body += (body[-1],)
+        elif damage[head]:
+            # Hazards don't hurt a snake that eats in them.
+            health = max(health - damage[head], 0)
+
+        if constrictor:
+            health = MAX_HEALTH
+            body += (body[-1],)
+
+        moved.append(SnakeState(snake.id, body, health))
+
+    # Food is eaten before anyone is eliminated, so a snake that dies on food still removes it.
+    for snake in moved:
+        food &= ~(1 << snake.head)
+
+    if eliminated is not None:
+        for snake in moved:
+            if snake.health <= 0:
+                eliminated.append((snake.id, OUT_OF_HEALTH, None))
+        for snake in off_board:
+            # Running out of health is checked first, even for a snake that also left the board.
+            eliminated.append((snake.id, OUT_OF_HEALTH if snake.health <= 1 else WALL_COLLISION, None))
+
+    # Out of health.
+    moved = [x for x in moved if x.health > 0]
+
+    bodies = 0
+    for snake in moved:
+        for cell in snake.body[1:]:
+            bodies |= 1 << cell
+
+    survivors = []
+    collided = []
+    for snake in moved:
+        head = snake.head
+        # Collided with its own body or another snake's body.
+        if (bodies >> head) & 1:
+            if eliminated is not None:
+                collided.append((snake.id, *_get_collision(snake, moved)))
+            continue
+        # Lost a head to head collision, equal lengths both lose.
+        winner = next((x for x in moved if x is not snake and x.head == head and x.length >= snake.length), None)
+        if winner is not None:
+            if eliminated is not None:
+                collided.append((snake.id, HEAD_COLLISION, winner.id))
+            continue
+        survivors.append(snake)
+
+    if eliminated is not None:
+        order = (SELF_COLLISION, SNAKE_COLLISION, HEAD_COLLISION)
+        eliminated.extend(sorted(collided, key=lambda x: order.index(x[1])))
+
+    hazards = position.hazards
+    if rules.shrink_every and rules.shrinks(position.turn + 1):
+        shrink = get_shrink(grid, hazards) & ~hazards
+        if shrink:
+            hazards |= shrink
+            damage = tuple(rules.hazard_damage if (shrink >> i) & 1 else x for i, x in enumerate(damage))
+
+    return Position(grid, tuple(survivors), food, hazards, position.turn + 1, rules, damage)
@@ -0,0 +1,281 @@
+import itertools
+import time
+
+from server_models import MOVES, get_reachable_area
+from server_rules import Position, SnakeState, advance, get_default_move
+from server_table import TranspositionTable
+
+"""
+This file looks ahead at future turns to pick the move that keeps the snake alive the longest.
+
+The search is paranoid: every nearby opponent is assumed to pick whichever of its moves is worst for us,
+and all of the snakes move at the same time, just like they do in the game.
+It deepens one turn at a time until the deadline, and always answers with the best move of the last depth it finished.
+"""
+
+WIN = 1_000_000
+LOSS = -1_000_000
+
+# Only this many opponents, the closest ones, are searched. The others make their default move.
+MAX_OPPONENTS = 2
+
+MAX_DEPTH = 64
+
+# How long we assume the network takes before we have measured it, in milliseconds.
+DEFAULT_NETWORK_LATENCY = 150
+# How much of the timeout is kept back for parsing the request and sending the response, in milliseconds.
+SAFETY_MARGIN = 60
+# The least amount of time a search is given, in milliseconds.
+MIN_BUDGET = 5
+
+class SearchTimeout(Exception):
+    pass
+
+def get_deadline(data: dict, network_latency: float = None, started: float = None) -> float:
+    '''
+    Use this function to work out when the search has to stop so the move gets back to the engine in time.
+
+    network_latency: The round trip to the engine in milliseconds, if it has been measured.
+    started: The time.perf_counter() at which the request came in, defaults to now.
+
+    return: The time.perf_counter() value that the search has to finish by.
+    '''
+
+    if started is None:
+        started = time.perf_counter()
+    if network_latency is None:
+        network_latency = DEFAULT_NETWORK_LATENCY
+
+    timeout = data['game'].get('timeout', 500)
+    budget = max(timeout - network_latency - SAFETY_MARGIN, MIN_BUDGET)
+
+    return started + budget / 1000
+
+def evaluate(position: Position, you: str, solo: bool) -> float:
+    '''
+    Use this function to score a position from our point of view.
+
+    solo: True when the game was started without any opponents, so outliving them isn't a win.
+
+    return: The score, higher is better for us.
+    '''
+
+    me = position.get_snake(you)
+    if me is None:
+        return LOSS
+    if not solo and len(position.snakes) == 1:
+        return WIN
+
+    longest = max((x.length for x in position.snakes if x is not me), default=me.length)
+
+    # Room to move is only worth so much, past twice our length there is always a way out.
+    score = get_reachable_area(position.grid, me.head, [x.body for x in position.snakes], limit=2 * me.length + 10, constrictor=position.rules.constrictor)
+    score += 5 * (me.length - longest)
+    # Getting hungry is only a problem once there isn't much health left, and a hazard takes more of it next turn.
+    score -= max(0, 25 - me.health + position.damage[me.head])
+
+    return score
+
+def _to_table(score: float, ply: int) -> float:
+    '''
+    Use this function to make a decided score relative to the node it is stored at, instead of the root.
+    '''
+
+    if score <= LOSS + MAX_DEPTH:
+        return score - ply
+    if score >= WIN - MAX_DEPTH:
+        return score + ply
+    return score
+
+def _from_table(score: float, ply: int) -> float:
+    '''
+    Use this function to make a decided score from the table relative to the root again.
+    '''
+
+    if score <= LOSS + MAX_DEPTH:
+        return score + ply
+    if score >= WIN - MAX_DEPTH:
+        return score - ply
+    return score
+
+class Search:
+    def __init__(self, position: Position, you: str, deadline: float, table: TranspositionTable = None, predictors: dict = None):
+        '''
+        predictors: The MoveStats of the opponents that have been seen enough, keyed by snake id, so their unlikely moves can be left out.
+        '''
+
+        self.root = position
+        self.you = you
+        self.deadline = deadline
+        self.table = table
+        self.predictors = predictors or {}
+        self.solo = len(position.snakes) <= 1
+        self.nodes = 0
+        self.depth = 0
+
+        me = position.get_snake(you)
+        grid = position.grid
+
+        # The opponents closest to our head are the ones that can get in our way, the short way round on a wrapped board.
+        def distance(snake: SnakeState) -> int:
+            dx, dy = grid.get_offset(me.head, snake.head)
+            return abs(dx) + abs(dy)
+
+        opponents = sorted((x for x in position.snakes if x.id != you), key=distance)
+        self.opponents = tuple(x.id for x in opponents[:MAX_OPPONENTS])
+
+    def run(self, moves: list, max_depth: int = MAX_DEPTH) -> tuple:
+        '''
+        Use this function to search deeper and deeper until the deadline.
+
+        moves: The moves to pick from, in order of preference when they score the same.
+
+        return: A tuple of the best move, its score and the depth that was finished, or None if no depth was finished.
+        '''
+
+        best = None
+        order = list(moves)
+
+        # A ponder, or the search of an earlier turn, may have left this position's best move in the table.
+        # Searching it first lets the other moves be cut off sooner, and the rest keep the order they were preferred in.
+        if self.table is not None:
+            entry = self.table.probe(self.table.get_hash(self.root))
+            if entry is not None and MOVES[entry[3]] in order:
+                hint = MOVES[entry[3]]
+                order = [hint] + [x for x in order if x != hint]
+
+        for depth in range(1, max_depth + 1):
+            self.depth = depth
+            try:
+                scores = self._search_root(order, depth)
+            except SearchTimeout:
+                break
+
+            # A stable sort keeps the preferred order between moves that score the same.
+            order.sort(key=lambda x: -scores[x])
+            best = (order[0], scores[order[0]], depth)
+
+            # Nothing more can be learned once the outcome is decided.
+            if scores[order[0]] >= WIN - MAX_DEPTH or all(scores[x] <= LOSS + MAX_DEPTH for x in order):
+                break
+
+        return best
+
+    def _check_time(self):
+        self.nodes += 1
+        if time.perf_counter() >= self.deadline:
+            raise SearchTimeout()
+
+    def _search_root(self, moves: list, depth: int) -> dict:
+        scores = {}
+        alpha = LOSS - 1
+        for move in moves:
+            score = self._search_opponents(self.root, move, depth, alpha, WIN + 1)
+            scores[move] = score
+            alpha = max(alpha, score)
+
+        return scores
+
+    def _search_us(self, position: Position, depth: int, alpha: float, beta: float) -> float:
+        self._check_time()
+
+        me = position.get_snake(self.you)
+        if depth == 0 or me is None or (not self.solo and len(position.snakes) == 1):
+            score = evaluate(position, self.you, self.solo)
+            # Dying later and winning sooner are better, so decided games are nudged by how far away they are.
+            ply = self.depth - depth
+            if score <= LOSS:
+                return score + ply
+            if score >= WIN:
+                return score - ply
+            return score
+
+        moves = position.get_moves(me) or [MOVES[0]]
+        ply = self.depth - depth
+
+        table = self.table
+        if table is not None:
+            key = table.get_hash(position)
+            entry = table.probe(key)
+            if entry is not None:
+                score, stored_depth, flag, index = entry
+                if stored_depth >= depth:
+                    score = _from_table(score, ply)
+                    if flag == TranspositionTable.EXACT:
+                        return score
+                    if flag == TranspositionTable.LOWER and score >= beta:
+                        return score
+                    if flag == TranspositionTable.UPPER and score <= alpha:
+                        return score
+                # Try the best move from last time first, it is the most likely to cut the search short.
+                hint = MOVES[index]
+                if hint in moves and moves[0] != hint:
+                    moves = [hint] + [x for x in moves if x != hint]
+            original_alpha = alpha
+
+        best = LOSS - 1
+        best_move = moves[0]
+        for move in moves:
+            score = self._search_opponents(position, move, depth, alpha, beta)
+            if score > best:
+                best = score
+                best_move = move
+            if best > alpha:
+                alpha = best
+            if alpha >= beta:
+                break
+
+        if table is not None:
+            if best <= original_alpha:
+                flag = TranspositionTable.UPPER
+            elif best >= beta:
+                flag = TranspositionTable.LOWER
+            else:
+                flag = TranspositionTable.EXACT
+            table.store(key, _to_table(best, ply), depth, flag, MOVES.index(best_move))
+
+        return best
+
+    def _search_opponents(self, position: Position, move: str, depth: int, alpha: float, beta: float) -> float:
+        self._check_time()
+
+        opponents = [x for x in (position.get_snake(i) for i in self.opponents) if x is not None]
+        choices = [position.get_moves(x) or [get_default_move(position, x)] for x in opponents]
+
+        # The moves an opponent is unlikely to make are left out, unless they could reach our head.
+        if self.predictors:
+            me = position.get_snake(self.you)
+            for i, opponent in enumerate(opponents):
+                stats = self.predictors.get(opponent.id)
+                if stats is not None and len(choices[i]) > 1:
+                    choices[i] = stats.prune(position, opponent, choices[i], me)
+
+        worst = WIN + 1
+        for replies in itertools.product(*choices):
+            moves = {x.id: reply for x, reply in zip(opponents, replies)}
+            moves[self.you] = move
+
+            score = self._search_us(advance(position, moves), depth - 1, alpha, beta)
+            if score < worst:
+                worst = score
+            if worst < beta:
+                beta = worst
+            if alpha >= beta:
+                break
+
+        return worst
+
+def find_best_move(position: Position, you: str, deadline: float, moves: list, table: TranspositionTable = None, predictors: dict = None) -> tuple:
+    '''
+    Use this function to pick the best of 'moves' for our snake before the deadline.
+
+    table: The game's TranspositionTable, so the search can reuse what it worked out on earlier turns.
+    predictors: The MoveStats of the opponents, keyed by snake id, see server_opponents.py.
+
+    return: A tuple of the best move, its score and the depth that was finished, or None if no depth was finished.
+    '''
+
+    if not moves:
+        return None
+
+    return Search(position, you, deadline, table, predictors).run(moves)
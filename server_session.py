@@ -0,0 +1,211 @@
+import threading
+import time
+
+from server_models import Board, is_wrapped
+from server_ponder import Ponder
+from server_rules import Position
+from server_table import TranspositionTable
+
+"""
+This file keeps the state of every game we are playing between requests.
+
+A session is created on /start, moved on to the next turn on every /move and freed on /end.
+Games that never send /end are evicted once they have been idle for longer than the TTL.
+"""
+
+class GameSession:
+    def __init__(self, data: dict, table_memory: int = 8 * 1024 * 1024):
+        self.id: str = data['game']['id']
+        self.game: dict = data['game']
+        self.turn: int = data['turn']
+        self.board: Board = Board(data['board'], is_wrapped(data['game']))
+        self.last_seen: float = time.monotonic()
+
+        # How long, in milliseconds, we spent picking our last move.
+        self.move_time: float = None
+        # The strategy, score and effort of our last move, or None if it was picked at random.
+        self.decision: tuple = None
+
+        # The Position of the last turn we picked a move for, to see what the opponents did since.
+        self.position: Position = None
+
+        # The search results of this game, kept from one turn to the next. Only allocated once a move is searched.
+        self.table_memory = table_memory
+        self._table: TranspositionTable = None
+
+        # The background search for the next turn, set up once a move is picked and started after it is answered.
+        self.ponder: Ponder = None
+
+        # Serializes the moves of a single game, in case the engine retries a request while we are still answering it.
+        self.lock = threading.Lock()
+
+    def update(self, data: dict) -> Board:
+        '''
+        Use this function to move the session on to the turn in 'data'.
+
+        Only the changes since the last turn are applied to the board. If a turn was missed, or the board
+        doesn't line up with what we saw last, the board is built again from scratch.
+
+        return: The Board for the new turn.
+        '''
+
+        self.last_seen = time.monotonic()
+
+        turn = data['turn']
+        if turn == self.turn:
+            return self.board
+
+        if turn != self.turn + 1 or not self.board.update(data['board']):
+            self.board = Board(data['board'], is_wrapped(data['game']))
+        self.turn = turn
+
+        return self.board
+
+    def get_table(self) -> TranspositionTable:
+        '''
+        Use this function to get the game's transposition table.
+
+        return: The TranspositionTable, created the first time it is asked for.
+        '''
+
+        if self._table is None:
+            self._table = TranspositionTable(self.table_memory)
+
+        return self._table
+
+    def start_ponder(self) -> bool:
+        '''
+        Use this function once our move has been answered, to ponder the next turn until it comes in.
+
+        return: True if a ponder was started.
+        '''
+
+        if self.ponder is None:
+            return False
+
+        return self.ponder.start()
+
+    def stop_ponder(self):
+        '''
+        Use this function to stop pondering, before the game's transposition table is used for anything else.
+        '''
+
+        ponder, self.ponder = self.ponder, None
+        if ponder is not None:
+            ponder.stop()
+
+    def get_network_latency(self, data: dict) -> float:
+        '''
+        Use this function to estimate how much of the engine's timeout is lost on the way to and from us.
+
+        The engine reports the latency of our last move, which is the network round trip plus the time we spent on it.
+
+        return: The round trip in milliseconds, or None if it hasn't been measured yet.
+        '''
+
+        latency = data['you'].get('latency')
+        if self.move_time is None or not latency:
+            return None
+
+        return max(float(latency) - self.move_time, 0)
+
+class SessionStore:
+    def __init__(self, ttl: float = 300.0, table_memory: int = 8 * 1024 * 1024):
+        '''
+        ttl: How many seconds a game can go without a request before it is evicted.
+        table_memory: The most bytes each game's transposition table is allowed to use.
+        '''
+
+        self.ttl = ttl
+        self.table_memory = table_memory
+        self._sessions: dict = {}
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def __contains__(self, game_id: str) -> bool:
+        return game_id in self._sessions
+
+    def start(self, data: dict) -> GameSession:
+        '''
+        Use this function to open a session when a game starts.
+
+        return: The new GameSession.
+        '''
+
+        session = GameSession(data, self.table_memory)
+        with self._lock:
+            self._sessions[session.id] = session
+        self.evict()
+
+        return session
+
+    def get(self, data: dict) -> GameSession:
+        '''
+        Use this function to get the session for the game in 'data', moved on to its turn.
+
+        If we never saw the game start, for example after a restart, a session is opened for it.
+
+        return: The GameSession for the game.
+        '''
+
+        game_id = data['game']['id']
+        with self._lock:
+            session = self._sessions.get(game_id)
+            if session is None:
+                session = self._sessions[game_id] = GameSession(data, self.table_memory)
+        self.evict()
+
+        return session
+
+    def end(self, data: dict) -> GameSession:
+        '''
+        Use this function to free the session when a game ends.
+
+        return: The GameSession that was freed, or None if there wasn't one.
+        '''
+
+        with self._lock:
+            session = self._sessions.pop(data['game']['id'], None)
+        if session is not None:
+            session.stop_ponder()
+
+        return session
+
+    def start_ponder(self, game_id: str) -> bool:
+        '''
+        Use this function once a move has been sent, to ponder the game's next turn until it comes in.
+
+        return: True if a ponder was started.
+        '''
+
+        with self._lock:
+            session = self._sessions.get(game_id)
+        if session is None:
+            return False
+
+        return session.start_ponder()
+
+    def evict(self, now: float = None) -> int:
+        '''
+        Use this function to free every session that has been idle for longer than the TTL.
+
+        The sessions are only swept once per TTL, so calling this on every request is cheap.
+
+        return: The number of sessions that were freed.
+        '''
+
+        if now is None:
+            now = time.monotonic()
+        if now - self._last_sweep < self.ttl:
+            return 0
+
+        with self._lock:
+            self._last_sweep = now
+            expired = [k for k, v in self._sessions.items() if now - v.last_seen > self.ttl]
+            for game_id in expired:
+                self._sessions.pop(game_id).stop_ponder()
+
+        return len(expired)
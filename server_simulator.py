@@ -0,0 +1,282 @@
+import argparse
+import json
+import random
+import statistics
+import time
+
+from server_log import logger
+from server_models import MOVES, get_grid
+from server_rules import MAX_HEALTH, Position, SnakeState, advance
+
+"""
+This file plays whole games of the standard rules in process, without the engine or HTTP.
+
+Each snake is played by a strategy: any callable that takes a move request, the same dictionary the
+engine sends to /move, and returns a move. server_logic.choose_move is a strategy, and so are the simple
+ones in this file. The start positions and food spawns are seeded, so with deterministic strategies
+the same seed always plays the same game.
+
+To pit choose_move against the random strategy, run:
+
+    python server_simulator.py --games 20
+
+Add --record moves.jsonl to save every move request choose_move was sent, for server_bench.py to replay.
+"""
+
+# The standard settings for spawning food.
+MINIMUM_FOOD = 1
+FOOD_SPAWN_CHANCE = 15
+
+START_LENGTH = 3
+
+class GameResult:
+    def __init__(self, game_id: str, turns: int, winner: str, eliminations: list, move_times: dict):
+        self.id = game_id
+        self.turns = turns
+        # The last snake standing, or None if the last snakes were eliminated together.
+        self.winner = winner
+        # A tuple of turn, snake id, cause and eliminated by, for each snake in the order it was eliminated.
+        self.eliminations = eliminations
+        # The seconds each snake's strategy took for each of its moves.
+        self.move_times = move_times
+
+def get_start_position(width: int, height: int, ids: list, rng: random.Random) -> Position:
+    '''
+    Use this function to set a board up the way the engine does for a standard game.
+
+    Snakes start stacked on the fixed start points, corners first, with a piece of food diagonally next to
+    each of them and one in the middle of the board.
+
+    return: The Position for turn 0.
+    '''
+
+    grid = get_grid(width, height)
+    low, middle, high_x, high_y = 1, (width - 1) // 2, width - 2, height - 2
+    corners = [(low, low), (low, high_y), (high_x, low), (high_x, high_y)]
+    cardinals = [(low, (height - 1) // 2), (middle, low), (middle, high_y), (high_x, (height - 1) // 2)]
+    rng.shuffle(corners)
+    rng.shuffle(cardinals)
+    points = corners + cardinals
+    if len(ids) > len(points):
+        raise Exception(f'a {width}x{height} board only fits {len(points)} snakes')
+
+    snakes = []
+    for id, (x, y) in zip(ids, points):
+        cell = grid.index(x, y)
+        snakes.append(SnakeState(id, (cell,) * START_LENGTH, MAX_HEALTH))
+
+    occupied = grid.mask(x.head for x in snakes)
+    center_x, center_y = (width - 1) // 2, (height - 1) // 2
+    food = 0
+    for x, y in points[:len(ids)]:
+        # Only the diagonals that point away from the middle, so the food isn't contested.
+        options = []
+        for dx, dy in ((-1, -1), (-1, 1), (1, -1), (1, 1)):
+            fx, fy = x + dx, y + dy
+            if not grid.contains(fx, fy):
+                continue
+            if abs(fx - center_x) + abs(fy - center_y) <= abs(x - center_x) + abs(y - center_y):
+                continue
+            cell = grid.index(fx, fy)
+            if not (occupied | food) >> cell & 1:
+                options.append(cell)
+        if options:
+            food |= 1 << rng.choice(options)
+
+    center = grid.index(center_x, center_y)
+    if not (occupied >> center) & 1:
+        food |= 1 << center
+
+    return Position(grid, tuple(snakes), food)
+
+def spawn_food(position: Position, rng: random.Random, minimum: int = MINIMUM_FOOD, chance: int = FOOD_SPAWN_CHANCE) -> int:
+    '''
+    Use this function to spawn food the way the standard rules do.
+
+    Food is topped up to the minimum, otherwise one piece is spawned 'chance' percent of the time.
+    Food never spawns on a body, on other food, or where a head could move next turn.
+
+    return: The new bitmask of food.
+    '''
+
+    grid = position.grid
+    count = bin(position.food).count('1')
+
+    spawn = minimum - count
+    if spawn <= 0:
+        spawn = 1 if rng.randrange(100) < chance else 0
+    if spawn <= 0:
+        return position.food
+
+    taken = position.food
+    for snake in position.snakes:
+        for cell in snake.body:
+            taken |= 1 << cell
+        taken |= grid.expand(1 << snake.head)
+
+    free = [x for x in range(grid.size) if not (taken >> x) & 1]
+    food = position.food
+    for cell in rng.sample(free, min(spawn, len(free))):
+        food |= 1 << cell
+
+    return food
+
+def get_move_request(game: dict, position: Position, you: str) -> dict:
+    '''
+    Use this function to build the move request the engine would send to one snake.
+
+    return: The move request dictionary.
+    '''
+
+    grid = position.grid
+
+    def point(cell: int) -> dict:
+        return {'x': cell % grid.width, 'y': cell // grid.width}
+
+    snakes = []
+    you_data = None
+    for snake in position.snakes:
+        body = [point(x) for x in snake.body]
+        data = {
+            'id': snake.id,
+            'name': snake.id,
+            'health': snake.health,
+            'body': body,
+            'latency': '0',
+            'head': body[0],
+            'length': len(body),
+            'shout': '',
+            'squad': '',
+        }
+        snakes.append(data)
+        if snake.id == you:
+            you_data = data
+
+    return {
+        'game': game,
+        'turn': position.turn,
+        'board': {
+            'height': grid.height,
+            'width': grid.width,
+            'food': [point(x) for x in grid.cells(position.food)],
+            'hazards': [point(x) for x in grid.cells(position.hazards)],
+            'snakes': snakes,
+        },
+        'you': you_data,
+    }
+
+def play_game(strategies: dict, width: int = 11, height: int = 11, seed: int = None, timeout: int = 500, max_turns: int = 10000) -> GameResult:
+    '''
+    Use this function to play one game to the end.
+
+    strategies: The strategy that plays each snake, keyed by snake id.
+    timeout: The timeout, in milliseconds, that the strategies are told about.
+    max_turns: Stop the game after this many turns, with no winner.
+
+    return: The GameResult.
+    '''
+
+    rng = random.Random(seed)
+    ids = list(strategies)
+    game = {
+        'id': f'simulated-{seed}',
+        'ruleset': {'name': 'standard', 'version': 'simulator'},
+        'timeout': timeout,
+    }
+
+    position = get_start_position(width, height, ids, rng)
+    eliminations = []
+    move_times = {x: [] for x in ids}
+    solo = len(ids) == 1
+
+    while position.snakes and (solo or len(position.snakes) > 1) and position.turn < max_turns:
+        moves = {}
+        for snake in position.snakes:
+            data = get_move_request(game, position, snake.id)
+            started = time.perf_counter()
+            moves[snake.id] = strategies[snake.id](data)
+            move_times[snake.id].append(time.perf_counter() - started)
+
+        eliminated = []
+        position = advance(position, moves, eliminated)
+        eliminations.extend((position.turn, *x) for x in eliminated)
+
+        food = spawn_food(position, rng)
+        if food != position.food:
+            position = Position(position.grid, position.snakes, food, position.hazards, position.turn, position.rules, position.damage)
+
+    winner = None
+    if not solo and len(position.snakes) == 1:
+        winner = position.snakes[0].id
+
+    return GameResult(game['id'], position.turn, winner, eliminations, move_times)
+
+def random_strategy(data: dict) -> str:
+    '''
+    A strategy that picks any move that doesn't walk off the board or into a body.
+    '''
+
+    you = data['you']
+    width = data['board']['width']
+    height = data['board']['height']
+    taken = {(p['x'], p['y']) for x in data['board']['snakes'] for p in x['body'][:-1]}
+
+    head = you['head']
+    steps = {
+        MOVES[0]: (head['x'], head['y'] + 1),
+        MOVES[1]: (head['x'], head['y'] - 1),
+        MOVES[2]: (head['x'] - 1, head['y']),
+        MOVES[3]: (head['x'] + 1, head['y']),
+    }
+    moves = [m for m, (x, y) in steps.items() if 0 <= x < width and 0 <= y < height and (x, y) not in taken]
+
+    return random.choice(moves or list(MOVES))
+
+def main():
+    import server_logic
+
+    parser = argparse.ArgumentParser(description='Play games between strategies without the engine.')
+    parser.add_argument('--games', type=int, default=10)
+    parser.add_argument('--width', type=int, default=11)
+    parser.add_argument('--height', type=int, default=11)
+    parser.add_argument('--opponents', type=int, default=1, help='how many random snakes to play against')
+    parser.add_argument('--timeout', type=int, default=500, help='the timeout, in milliseconds, choose_move is told about')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--record', help='save the move requests choose_move is sent to this JSON lines file')
+    args = parser.parse_args()
+
+    recording = open(args.record, 'w') if args.record else None
+
+    def choose_move(data: dict) -> str:
+        if recording is not None:
+            recording.write(json.dumps(data) + '\n')
+        return server_logic.choose_move(data)
+
+    strategies = {'choose_move': choose_move}
+    for i in range(args.opponents):
+        strategies[f'random-{i}'] = random_strategy
+
+    wins = 0
+    turns = []
+    times = []
+    started = time.perf_counter()
+    for game in range(args.games):
+        # choose_move logs every move, which isn't worth seeing here.
+        with logger.muted():
+            result = play_game(strategies, args.width, args.height, seed=args.seed + game, timeout=args.timeout)
+        wins += result.winner == 'choose_move'
+        turns.append(result.turns)
+        times.extend(result.move_times['choose_move'])
+    elapsed = time.perf_counter() - started
+
+    if recording is not None:
+        recording.close()
+
+    times.sort()
+    print(f'{args.games} games in {elapsed:.1f}s, choose_move won {wins}')
+    print(f'turns: mean {statistics.mean(turns):.1f}, max {max(turns)}')
+    if times:
+        print(f'choose_move: p50 {times[len(times) // 2] * 1000:.1f}ms, max {times[-1] * 1000:.1f}ms')
+
+if __name__ == '__main__':
+    main()
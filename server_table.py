@@ -0,0 +1,208 @@
+import random
+from array import array
+from functools import lru_cache
+
+from server_models import Grid
+from server_rules import Position
+
+"""
+This file remembers what the search has already worked out, so the same position isn't searched twice.
+
+Positions are hashed with Zobrist keys: a random 64 bit key for every thing that can be on every cell,
+hazards included, XORed together. The transposition table is a fixed size array indexed by that hash,
+so it never grows past the memory it was given. It lives in the game's session, so what was searched on one turn is
+still there on the next.
+"""
+
+# Health is bucketed so that positions that only differ by a little health share their entries.
+HEALTH_BUCKET = 10
+
+# The seed is fixed so that hashes are the same in every process, and can be saved to disk.
+SEED = 0x5EED5A4E
+# The hazard keys have a seed of their own, so the keys made before them, that the opening book was saved with, stay the same.
+HAZARD_SEED = 0x4A2A4D5
+
+class SnakeKeys:
+    def __init__(self, rng: random.Random, size: int):
+        self.body: tuple = tuple(rng.getrandbits(64) for _ in range(size))
+        self.head: tuple = tuple(rng.getrandbits(64) for _ in range(size))
+        self.tail: tuple = tuple(rng.getrandbits(64) for _ in range(size))
+        self.length: tuple = tuple(rng.getrandbits(64) for _ in range(size + 2))
+        self.health: tuple = tuple(rng.getrandbits(64) for _ in range(100 // HEALTH_BUCKET + 1))
+
+class ZobristKeys:
+    '''
+    The Zobrist keys for a board size. Every snake slot gets its own keys, generated the first time it is used.
+    '''
+
+    def __init__(self, grid: Grid):
+        self.grid = grid
+        self._rng = random.Random(SEED + grid.width * 1000 + grid.height)
+        self.food: tuple = tuple(self._rng.getrandbits(64) for _ in range(grid.size))
+        hazard_rng = random.Random(HAZARD_SEED + grid.width * 1000 + grid.height)
+        self.hazard: tuple = tuple(hazard_rng.getrandbits(64) for _ in range(grid.size))
+        self._snakes: list = []
+
+    def get_snake(self, slot: int) -> SnakeKeys:
+        '''
+        Use this function to get the keys for a snake slot.
+
+        return: The SnakeKeys for the slot.
+        '''
+
+        while slot >= len(self._snakes):
+            self._snakes.append(SnakeKeys(self._rng, self.grid.size))
+
+        return self._snakes[slot]
+
+@lru_cache(maxsize=None)
+def get_keys(grid: Grid) -> ZobristKeys:
+    '''
+    Use this function to get the shared Zobrist keys for a board size.
+
+    return: The ZobristKeys for the grid.
+    '''
+
+    return ZobristKeys(grid)
+
+@lru_cache(maxsize=4096)
+def get_hazard_hash(grid: Grid, hazards: int) -> int:
+    '''
+    Use this function to hash the hazard cells of a position, which only change when they close in.
+
+    return: The Zobrist keys of every hazard cell XORed together.
+    '''
+
+    keys = get_keys(grid).hazard
+
+    h = 0
+    for cell in grid.cells(hazards):
+        h ^= keys[cell]
+
+    return h
+
+def get_hash(position: Position, slots: dict) -> int:
+    '''
+    Use this function to hash a position.
+
+    slots: The slot of each snake id. Snakes that aren't in it yet are given the next free slot.
+
+    return: The 64 bit Zobrist hash.
+    '''
+
+    keys = get_keys(position.grid)
+    grid = position.grid
+
+    h = 0
+    for snake in position.snakes:
+        slot = slots.get(snake.id)
+        if slot is None:
+            slot = slots[snake.id] = len(slots)
+        snake_keys = keys.get_snake(slot)
+
+        # Stacked segments only ever sit at the tail, and are covered by the length key.
+        body = snake_keys.body
+        previous = -1
+        for cell in snake.body:
+            if cell != previous:
+                h ^= body[cell]
+                previous = cell
+
+        h ^= snake_keys.head[snake.body[0]]
+        h ^= snake_keys.tail[snake.body[-1]]
+        h ^= snake_keys.length[min(len(snake.body), grid.size + 1)]
+        h ^= snake_keys.health[max(snake.health, 0) // HEALTH_BUCKET]
+
+    food = keys.food
+    for cell in grid.cells(position.food):
+        h ^= food[cell]
+
+    if position.hazards:
+        h ^= get_hazard_hash(grid, position.hazards)
+
+    return h
+
+class TranspositionTable:
+    '''
+    A fixed size table of search results, indexed by Zobrist hash.
+
+    When two positions land in the same slot, the result that was searched deeper is kept, unless the
+    one that is there was stored on an earlier turn.
+    '''
+
+    EXACT = 0
+    LOWER = 1
+    UPPER = 2
+
+    # The bytes used by one entry: key, score, depth, flag, move and generation.
+    ENTRY_SIZE = 8 + 4 + 1 + 1 + 1 + 2
+
+    def __init__(self, memory: int = 8 * 1024 * 1024):
+        '''
+        memory: The most bytes the table is allowed to use.
+        '''
+
+        size = 1
+        while size * 2 * self.ENTRY_SIZE <= memory:
+            size *= 2
+
+        self.size = size
+        self._mask = size - 1
+        self._keys = array('Q', bytes(8 * size))
+        self._scores = array('i', bytes(4 * size))
+        self._depths = array('b', bytes(size))
+        self._flags = array('B', bytes(size))
+        self._moves = array('B', bytes(size))
+        self._generations = array('H', bytes(2 * size))
+
+        # Generation 0 marks an empty slot.
+        self.generation = 1
+        self.slots: dict = {}
+
+    def get_hash(self, position: Position) -> int:
+        '''
+        Use this function to hash a position with the snake slots of this game.
+
+        return: The 64 bit Zobrist hash.
+        '''
+
+        return get_hash(position, self.slots)
+
+    def new_turn(self):
+        '''
+        Use this function at the start of every turn, so entries from earlier turns are replaced first.
+        '''
+
+        self.generation = self.generation % 0xFFFF + 1
+
+    def probe(self, key: int) -> tuple:
+        '''
+        Use this function to look up a position.
+
+        return: A tuple of score, depth, flag and move, or None if the position isn't in the table.
+        '''
+
+        index = key & self._mask
+        if self._generations[index] == 0 or self._keys[index] != key:
+            return None
+
+        return (self._scores[index], self._depths[index], self._flags[index], self._moves[index])
+
+    def store(self, key: int, score: int, depth: int, flag: int, move: int):
+        '''
+        Use this function to save the result of searching a position.
+
+        move: The index in MOVES of the best move that was found.
+        '''
+
+        index = key & self._mask
+        generation = self._generations[index]
+        if generation == self.generation and self._keys[index] != key and self._depths[index] > depth:
+            return
+
+        self._keys[index] = key
+        self._scores[index] = int(score)
+        self._depths[index] = min(depth, 127)
+        self._flags[index] = flag
+        self._moves[index] = move
+        self._generations[index] = self.generation
@@ -0,0 +1,381 @@
+import argparse
+import mmap
+import os
+import struct
+import time
+from array import array
+from functools import lru_cache
+
+from server_models import MOVES, Grid, get_grid
+from server_rules import Position
+from server_search import LOSS, WIN
+
+"""
+This file solves 1v1 endgames on small boards exactly, ahead of time, and answers them without searching.
+
+With two short snakes and no food in reach, a 7x7 board has few enough positions to solve every one of
+them. The tablebase is built with retrograde analysis: starting from the positions where a snake is
+eliminated, every position that can force one of them is worked out, one turn further back at a time.
+Moves are simultaneous, and like the search the opponent is assumed to pick its move knowing ours.
+
+    python server_tablebase.py --width 7 --height 7 --max-length 4 --output tablebase.bin
+
+Every position is stored as a win, a loss or a draw for the first snake, with how many turns the win or
+loss takes. A draw is anything neither snake can force, including both being eliminated together.
+The snakes don't eat in the tablebase, so its answer is only used when no food is within reach of
+either head before the end, and both snakes have the health to get there.
+
+The file is a header, then one table for each pair of lengths with two bytes, the result and the
+distance, for every pair of bodies. The bodies of a length are numbered in a fixed order, so the
+tables are memory mapped and indexed straight into.
+"""
+
+MAGIC = b'SNKTB001'
+
+# The magic, the board size and the longest snake in the tablebase.
+HEADER = struct.Struct('<8sBBB5x')
+
+DRAW = 0
+WIN_RESULT = 1
+LOSS_RESULT = 2
+
+# Snakes start at this length and never get shorter.
+MIN_LENGTH = 3
+
+# The rulesets the tablebase was solved with.
+TABLEBASE_RULESETS = {'standard', 'duel'}
+
+# Where the tablebase is looked for, unless TABLEBASE says otherwise.
+TABLEBASE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tablebase.bin')
+
+class Bodies:
+    '''
+    Every body a snake of one length can have on a board, numbered, with what each move does to it.
+    '''
+
+    def __init__(self, grid: Grid, length: int):
+        bodies = [(x,) for x in range(grid.size)]
+        for _ in range(length - 1):
+            bodies = [x + (y,) for x in bodies for y in _get_neighbors(grid, x[-1]) if y not in x]
+
+        self.bodies: list = bodies
+        self.index: dict = {x: i for i, x in enumerate(bodies)}
+
+        # For each body, the cells that are still body after it moves, whichever way it moves.
+        self.fronts: list = [grid.mask(x[:-1]) for x in bodies]
+
+        # For each body and move, the cell the head moves to, or -1 off the board, and the number of the
+        # body it becomes, or -1 if it runs into itself.
+        self.heads = array('i')
+        self.moved = array('i')
+        for body in bodies:
+            for move in MOVES:
+                head = grid.step(body[0], move)
+                self.heads.append(head)
+                self.moved.append(self.index.get((head,) + body[:-1], -1) if head >= 0 else -1)
+
+    def __len__(self) -> int:
+        return len(self.bodies)
+
+def _get_neighbors(grid: Grid, cell: int) -> list:
+    return [x for x in (grid.step(cell, move) for move in MOVES) if x >= 0]
+
+@lru_cache(maxsize=None)
+def get_bodies(grid: Grid, length: int) -> Bodies:
+    '''
+    Use this function to get the shared Bodies of a length on a board.
+
+    return: The Bodies.
+    '''
+
+    return Bodies(grid, length)
+
+def play(us: Bodies, them: Bodies, i: int, j: int, a: int, b: int) -> tuple:
+    '''
+    Use this function to play one turn of the standard rules, without food, between body 'i' of 'us' and body 'j' of 'them'.
+
+    a, b: The index in MOVES of each snake's move.
+
+    return: A tuple of whether each snake was eliminated, and the number of the position after the turn if neither was.
+    '''
+
+    length_us = len(us.bodies[0])
+    length_them = len(them.bodies[0])
+    head_us = us.heads[i * 4 + a]
+    head_them = them.heads[j * 4 + b]
+
+    # Bodies are only run into by snakes that didn't leave the board.
+    bodies = 0
+    if head_us >= 0:
+        bodies |= us.fronts[i]
+    if head_them >= 0:
+        bodies |= them.fronts[j]
+
+    dead_us = head_us < 0 or (bodies >> head_us) & 1 or (head_us == head_them and length_them >= length_us)
+    dead_them = head_them < 0 or (bodies >> head_them) & 1 or (head_us == head_them and length_us >= length_them)
+    if dead_us or dead_them:
+        return (bool(dead_us), bool(dead_them), -1)
+
+    return (False, False, us.moved[i * 4 + a] * len(them) + them.moved[j * 4 + b])
+
+def solve(grid: Grid, length_us: int, length_them: int) -> tuple:
+    '''
+    Use this function to solve every position between a snake of 'length_us' and one of 'length_them'.
+
+    return: A tuple of two bytearrays, the result of each position for us and the turns it takes.
+    '''
+
+    us = get_bodies(grid, length_us)
+    them = get_bodies(grid, length_them)
+    count = len(us) * len(them)
+
+    results = bytearray(count)
+    distances = bytearray(count)
+
+    # For each of our moves in each position, how many replies don't lose to it yet, and whether one beats it.
+    waiting = bytearray(count * 4)
+    beaten = bytearray(count * 4)
+    # For each position, how many of our moves have been beaten.
+    beaten_moves = bytearray(count)
+
+    # Every turn that leads to another position, as the move in the position it leads from, grouped by the position it leads to.
+    sources = array('i')
+    targets = array('i')
+
+    resolved = []
+    for i in range(len(us)):
+        body_us = grid.mask(us.bodies[i])
+        for j in range(len(them)):
+            if body_us & grid.mask(them.bodies[j]):
+                continue
+            position = i * len(them) + j
+            for a in range(4):
+                key = position * 4 + a
+                for b in range(4):
+                    dead_us, dead_them, after = play(us, them, i, j, a, b)
+                    if after >= 0:
+                        sources.append(key)
+                        targets.append(after)
+                    # Every reply but one that eliminates only them has still to be won against.
+                    if not dead_them or dead_us:
+                        waiting[key] += 1
+                    if dead_us and not dead_them and not beaten[key]:
+                        beaten[key] = 1
+                        beaten_moves[position] += 1
+                if waiting[key] == 0 and results[position] == DRAW:
+                    results[position] = WIN_RESULT
+                    distances[position] = 1
+                    resolved.append(position)
+            if beaten_moves[position] == 4 and results[position] == DRAW:
+                results[position] = LOSS_RESULT
+                distances[position] = 1
+                resolved.append(position)
+
+    # The turns into each position, gathered the way a sparse matrix keeps its rows.
+    starts = array('i', bytes(4 * (count + 1)))
+    for target in targets:
+        starts[target + 1] += 1
+    for position in range(count):
+        starts[position + 1] += starts[position]
+    order = array('i', bytes(4 * len(targets)))
+    filled = array('i', starts[:-1])
+    for source, target in zip(sources, targets):
+        order[filled[target]] = source
+        filled[target] += 1
+
+    # Positions are resolved in order of distance, so the first way found to lose a move is the quickest,
+    # and the last reply to be won against decides how long a win takes.
+    for position in resolved:
+        result = results[position]
+        distance = min(distances[position] + 1, 255)
+        for k in range(starts[position], starts[position + 1]):
+            key = order[k]
+            before = key >> 2
+            if results[before] != DRAW:
+                continue
+            if result == WIN_RESULT:
+                waiting[key] -= 1
+                if waiting[key] == 0:
+                    results[before] = WIN_RESULT
+                    distances[before] = distance
+                    resolved.append(before)
+            elif not beaten[key]:
+                beaten[key] = 1
+                beaten_moves[before] += 1
+                if beaten_moves[before] == 4:
+                    results[before] = LOSS_RESULT
+                    distances[before] = distance
+                    resolved.append(before)
+
+    return results, distances
+
+def write_tablebase(path: str, width: int, height: int, max_length: int, log=None):
+    '''
+    Use this function to solve and save the tablebase of a board, for every pair of lengths up to 'max_length'.
+
+    log: If given, called with a message as each pair of lengths is solved.
+    '''
+
+    grid = get_grid(width, height)
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, width, height, max_length))
+        for length_us in range(MIN_LENGTH, max_length + 1):
+            for length_them in range(MIN_LENGTH, max_length + 1):
+                started = time.perf_counter()
+                results, distances = solve(grid, length_us, length_them)
+                table = bytearray(2 * len(results))
+                table[0::2] = results
+                table[1::2] = distances
+                f.write(table)
+                if log is not None:
+                    wins = results.count(WIN_RESULT)
+                    losses = results.count(LOSS_RESULT)
+                    log(f'{length_us} against {length_them}: {len(results)} positions, {wins} won, {losses} lost in {time.perf_counter() - started:.1f}s')
+
+class Tablebase:
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.width, self.height, self.max_length = HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a tablebase')
+        self.grid = get_grid(self.width, self.height)
+
+        # Where the table of each pair of lengths starts.
+        self._offsets = {}
+        offset = HEADER.size
+        for length_us in range(MIN_LENGTH, self.max_length + 1):
+            for length_them in range(MIN_LENGTH, self.max_length + 1):
+                self._offsets[(length_us, length_them)] = offset
+                offset += 2 * len(get_bodies(self.grid, length_us)) * len(get_bodies(self.grid, length_them))
+
+    def lookup(self, body_us: tuple, body_them: tuple) -> tuple:
+        '''
+        Use this function to look a pair of bodies up.
+
+        return: A tuple of the result for us and its distance, or None if the bodies aren't in the tablebase.
+        '''
+
+        offset = self._offsets.get((len(body_us), len(body_them)))
+        if offset is None:
+            return None
+        us = get_bodies(self.grid, len(body_us))
+        them = get_bodies(self.grid, len(body_them))
+        i = us.index.get(body_us)
+        j = them.index.get(body_them)
+        if i is None or j is None:
+            return None
+
+        offset += 2 * (i * len(them) + j)
+
+        return (self._map[offset], self._map[offset + 1])
+
+    def probe(self, position: Position, you: str) -> tuple:
+        '''
+        Use this function to get the perfect move in a 1v1 position, if the tablebase covers it.
+
+        The position is covered when both bodies are in the tablebase, the game is decided, both snakes have
+        the health to see it through and no food can be eaten before it is over.
+
+        return: A tuple of the move, its score and the turns until the game is decided, or None if the position isn't covered.
+        '''
+
+        # The snakes were solved without hazards, or growing every turn.
+        if position.grid is not self.grid or len(position.snakes) != 2 or position.hazards or position.rules.constrictor:
+            return None
+        me = position.get_snake(you)
+        other = next((x for x in position.snakes if x.id != you), None)
+        if me is None or other is None:
+            return None
+
+        found = self.lookup(me.body, other.body)
+        if found is None or found[0] == DRAW:
+            return None
+        result, distance = found
+
+        # A snake that runs out of health, or eats, before the end isn't playing the game that was solved.
+        if me.health <= distance or other.health <= distance:
+            return None
+        grid = self.grid
+        reach = (1 << me.head) | (1 << other.head)
+        for _ in range(distance):
+            reach |= grid.expand(reach)
+        if reach & position.food:
+            return None
+
+        us = get_bodies(grid, me.length)
+        them = get_bodies(grid, other.length)
+        i = us.index[me.body]
+        j = them.index[other.body]
+        table = self._offsets[(me.length, other.length)]
+
+        # The move that wins quickest, or loses slowest, is the one whose replies all agree with the table.
+        best = None
+        for a in range(4):
+            outcomes = []
+            for b in range(4):
+                dead_us, dead_them, after = play(us, them, i, j, a, b)
+                if dead_us and dead_them:
+                    outcomes.append((DRAW, 1))
+                elif dead_us or dead_them:
+                    outcomes.append((LOSS_RESULT if dead_us else WIN_RESULT, 1))
+                else:
+                    outcomes.append((self._map[table + 2 * after], self._map[table + 2 * after + 1] + 1))
+            if result == WIN_RESULT and all(x == WIN_RESULT for x, _ in outcomes):
+                turns = max(x for _, x in outcomes)
+                if best is None or turns < best[1]:
+                    best = (a, turns)
+            elif result == LOSS_RESULT:
+                turns = min((x for outcome, x in outcomes if outcome == LOSS_RESULT), default=None)
+                if turns is not None and (best is None or turns > best[1]):
+                    best = (a, turns)
+
+        if best is None:
+            return None
+        move = MOVES[best[0]]
+
+        return (move, WIN - distance if result == WIN_RESULT else LOSS + distance, distance)
+
+@lru_cache(maxsize=None)
+def open_tablebase(path: str) -> Tablebase:
+    '''
+    Use this function to open the tablebase at 'path' once, and share it.
+
+    return: The Tablebase, or None if there isn't one.
+    '''
+
+    if not os.path.exists(path):
+        return None
+
+    return Tablebase(path)
+
+def get_tablebase(game: dict, grid: Grid) -> Tablebase:
+    '''
+    Use this function to get the tablebase for a game.
+
+    return: The Tablebase, or None if there isn't one for the board or the game isn't played by the rules it was solved with.
+    '''
+
+    if (game.get('ruleset') or {}).get('name', 'standard') not in TABLEBASE_RULESETS:
+        return None
+
+    tablebase = open_tablebase(os.environ.get('TABLEBASE', TABLEBASE_PATH))
+    if tablebase is None or tablebase.grid is not grid:
+        return None
+
+    return tablebase
+
+def main():
+    parser = argparse.ArgumentParser(description='Solve the 1v1 endgames of a small board into a tablebase.')
+    parser.add_argument('--output', default=TABLEBASE_PATH, help='where to save the tablebase')
+    parser.add_argument('--width', type=int, default=7)
+    parser.add_argument('--height', type=int, default=7)
+    parser.add_argument('--max-length', type=int, default=4, help='the longest snake to solve for')
+    args = parser.parse_args()
+
+    write_tablebase(args.output, args.width, args.height, args.max_length, log=print)
+    print(f'Saved the tablebase to {args.output}')
+
+if __name__ == '__main__':
+    main()
@@ -10,10 +10,39 @@ in the folder where this file exists:
     python tests.py -v
 """
 
+import asyncio
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 
-from server_models import Coord, Move, Board, Snake
-from server_logic import choose_move
+import numpy as np
+
+import server_bench
+import server_book
+import server_codec
+import server_dispatch
+import server_log
+import server_mcts
+import server_metrics
+import server_opponents
+import server_ponder
+import server_recorder
+import server_simulator
+import server_tablebase
+
+from server_models import MOVES, Coord, Move, Board, Snake, get_grid, get_reachable_area, get_territory, get_voronoi, is_wrapped
+from server_logic import choose_move, get_deadly_moves, get_roomy_moves, warm_up
+from server_rules import HEAD_COLLISION, OUT_OF_HEALTH, WALL_COLLISION, Position, Ruleset, SnakeState, advance
+from server_search import Search, find_best_move, get_deadline
+from server_session import SessionStore
+from server_table import TranspositionTable
 
 class AvoidNeckTest(unittest.TestCase):
     def test_neck_at_starting_position(self):
@@ -566,7 +595,1520 @@ class FoodTest(unittest.TestCase):
         # Assert
         self.assertEqual(coord.get_xy(), Coord({'x': 5, 'y': 5}).get_xy())
 
-class ChooseMoveTest(unittest.TestCase):
+    def test_nearest_food_walks_around_snakes(self):
+        # Arrange
+        board = Board({
+            'height': 5,
+            'width': 5,
+            'food': [{'x': 2, 'y': 4}],
+            'snakes': [{
+                'id': 'wall',
+                'head': {'x': 0, 'y': 3},
+                'body': [{'x': 0, 'y': 3}, {'x': 1, 'y': 3}, {'x': 2, 'y': 3}, {'x': 3, 'y': 3}],
+                'health': 95
+            }]
+        })
+        head = Coord({'x': 2, 'y': 2})
+
+        # Act
+        distance = board.get_nearest_food_distance(head)
+        moves = board.get_nearest_food_moves(head)
+
+        # Assert
+        self.assertEqual(distance, 6)
+        self.assertEqual(moves, {Move.right})
+
+    def test_nearest_food_unreachable(self):
+        # Arrange
+        board = Board({
+            'height': 3,
+            'width': 3,
+            'food': [{'x': 0, 'y': 2}],
+            'snakes': [{
+                'id': 'wall',
+                'head': {'x': 0, 'y': 1},
+                'body': [{'x': 0, 'y': 1}, {'x': 1, 'y': 1}, {'x': 1, 'y': 2}],
+                'health': 95
+            }]
+        })
+
+        # Act
+        distance = board.get_nearest_food_distance(Coord({'x': 2, 'y': 0}))
+        coord = board.get_nearest_food_location(Coord({'x': 2, 'y': 0}))
+
+        # Assert
+        self.assertEqual(distance, None)
+        self.assertEqual(coord, None)
+
+class GridTest(unittest.TestCase):
+    def test_shift_drops_cells_off_the_board(self):
+        # Arrange
+        grid = get_grid(3, 3)
+        corner = 1 << grid.index(2, 2)
+
+        # Act
+        moves = {move: grid.shift(corner, move) for move in (Move.up, Move.down, Move.left, Move.right)}
+
+        # Assert
+        self.assertEqual(moves[Move.up], 0)
+        self.assertEqual(moves[Move.right], 0)
+        self.assertEqual(moves[Move.down], 1 << grid.index(2, 1))
+        self.assertEqual(moves[Move.left], 1 << grid.index(1, 2))
+
+    def test_lookup_tables_match_shift(self):
+        # Arrange
+        grid = get_grid(4, 3)
+
+        for cell in range(grid.size):
+            # Act
+            shifted = {move: grid.shift(1 << cell, move) for move in MOVES}
+
+            # Assert
+            self.assertEqual(grid.directions[cell], {x.bit_length() - 1: move for move, x in shifted.items() if x})
+            self.assertEqual(grid.edges[cell], {move for move, x in shifted.items() if not x})
+            self.assertEqual(set(grid.directions[cell]), set(grid.neighbors[cell]))
+            for move in MOVES:
+                self.assertEqual(grid.step(cell, move), shifted[move].bit_length() - 1)
+
+    def test_wrapped_grid_leads_round_the_edges(self):
+        # Arrange
+        grid = get_grid(5, 4, True)
+
+        for cell in range(grid.size):
+            # Act
+            shifted = {move: grid.shift(1 << cell, move) for move in MOVES}
+            x, y = grid.xy(cell)
+
+            # Assert
+            self.assertEqual(grid.edges[cell], frozenset())
+            self.assertEqual(grid.expand(1 << cell), grid.mask(grid.neighbors[cell]))
+            self.assertEqual(grid.step(cell, Move.up), grid.index(x, (y + 1) % 4))
+            self.assertEqual(grid.step(cell, Move.left), grid.index((x - 1) % 5, y))
+            for move in MOVES:
+                self.assertEqual(grid.step(cell, move), shifted[move].bit_length() - 1)
+        self.assertEqual(grid.get_offset(grid.index(0, 0), grid.index(4, 3)), (-1, -1))
+        self.assertIsNot(grid, get_grid(5, 4))
+        self.assertIs(get_grid(5, 4), get_grid(5, 4, False))
+
+    def test_expand(self):
+        # Arrange
+        grid = get_grid(3, 3)
+        center = 1 << grid.index(1, 1)
+
+        # Act
+        neighbors = set(grid.cells(grid.expand(center)))
+
+        # Assert
+        self.assertEqual(neighbors, {grid.index(1, 2), grid.index(1, 0), grid.index(0, 1), grid.index(2, 1)})
+
+    def test_board_occupancy(self):
+        # Arrange
+        board = Board({
+            'height': 11,
+            'width': 11,
+            'food': [{'x': 1, 'y': 1}],
+            'hazards': [{'x': 3, 'y': 2}],
+            'snakes': [{
+                'id': 'snake',
+                'head': {'x': 5, 'y': 5},
+                'body': [{'x': 5, 'y': 5}, {'x': 5, 'y': 4}],
+                'health': 95
+            }]
+        })
+        grid = board.grid
+
+        # Act & Assert
+        self.assertTrue(board.is_occupied(grid.index(5, 4)))
+        self.assertFalse(board.is_occupied(grid.index(4, 4)))
+        self.assertTrue(board.has_food(grid.index(1, 1)))
+        self.assertTrue(board.has_hazard(grid.index(3, 2)))
+
+def make_move_request(turn, snakes, food, width=7, height=7, game_id='game'):
+    '''
+    Builds a minimal move request out of lists of x,y tuples, the first snake is 'you'.
+    '''
+
+    def point(xy):
+        return {'x': xy[0], 'y': xy[1]}
+
+    snake_data = [
+        {
+            'id': f'snake-{i}',
+            'name': f'snake-{i}',
+            'health': health,
+            'body': [point(xy) for xy in body],
+            'head': point(body[0]),
+            'length': len(body),
+        }
+        for i, (body, health) in enumerate(snakes)
+    ]
+
+    return {
+        'game': {'id': game_id, 'ruleset': {'name': 'standard', 'version': 'v1.0.0'}, 'timeout': 500},
+        'turn': turn,
+        'board': {
+            'height': height,
+            'width': width,
+            'food': [point(xy) for xy in food],
+            'hazards': [],
+            'snakes': snake_data,
+        },
+        'you': snake_data[0],
+    }
+
+class SessionTest(unittest.TestCase):
+    def test_incremental_update_matches_rebuild(self):
+        # Arrange
+        turns = [
+            make_move_request(0, [([(1, 1), (1, 1), (1, 1)], 100), ([(5, 5), (5, 5), (5, 5)], 100)], [(3, 1), (0, 6)]),
+            make_move_request(1, [([(2, 1), (1, 1), (1, 1)], 99), ([(5, 4), (5, 5), (5, 5)], 99)], [(3, 1), (0, 6)]),
+            make_move_request(2, [([(3, 1), (2, 1), (1, 1), (1, 1)], 100), ([(4, 4), (5, 4), (5, 5)], 98)], [(0, 6)]),
+            make_move_request(3, [([(3, 2), (3, 1), (2, 1), (1, 1)], 99), ([(3, 4), (4, 4), (5, 4)], 97)], [(0, 6), (6, 0)]),
+            make_move_request(4, [([(3, 3), (3, 2), (3, 1), (2, 1)], 98)], [(0, 6), (6, 0)]),
+        ]
+        store = SessionStore()
+        session = store.start(turns[0])
+        session.board.get_food_field()
+
+        for data in turns[1:]:
+            # Act
+            board = session.update(data)
+            expected = Board(data['board'])
+
+            # Assert
+            self.assertEqual(board.occupied_mask, expected.occupied_mask)
+            self.assertEqual(board.food_mask, expected.food_mask)
+            self.assertEqual([x.body_cells for x in board.snakes], [x.body_cells for x in expected.snakes])
+            self.assertEqual(board.get_food_field().distance, expected.get_food_field().distance)
+
+    def test_missed_turn_rebuilds_board(self):
+        # Arrange
+        store = SessionStore()
+        session = store.start(make_move_request(0, [([(1, 1), (1, 1), (1, 1)], 100)], []))
+        data = make_move_request(5, [([(1, 4), (1, 3), (1, 2)], 95)], [])
+
+        # Act
+        board = session.update(data)
+
+        # Assert
+        self.assertEqual(board.snakes[0].body_cells, Board(data['board']).snakes[0].body_cells)
+
+    def test_end_and_eviction(self):
+        # Arrange
+        store = SessionStore(ttl=10)
+        store.start(make_move_request(0, [([(1, 1), (1, 1), (1, 1)], 100)], [], game_id='ended'))
+        idle = store.start(make_move_request(0, [([(1, 1), (1, 1), (1, 1)], 100)], [], game_id='idle'))
+
+        # Act
+        store.end({'game': {'id': 'ended'}})
+        evicted = store.evict(now=idle.last_seen + 60)
+
+        # Assert
+        self.assertEqual(evicted, 1)
+        self.assertEqual(len(store), 0)
+
+class RulesTest(unittest.TestCase):
+    def test_head_to_head_longer_snake_wins(self):
+        # Arrange
+        data = make_move_request(0, [([(2, 3), (1, 3), (0, 3), (0, 2)], 90), ([(4, 3), (5, 3), (6, 3)], 90)], [])
+        position = Position.from_board(Board(data['board']))
+
+        # Act
+        position = advance(position, {'snake-0': Move.right, 'snake-1': Move.left})
+
+        # Assert
+        self.assertEqual([x.id for x in position.snakes], ['snake-0'])
+
+    def test_eating_grows_and_restores_health(self):
+        # Arrange
+        data = make_move_request(0, [([(2, 3), (1, 3), (0, 3)], 10)], [(3, 3)])
+        position = Position.from_board(Board(data['board']))
+
+        # Act
+        position = advance(position, {'snake-0': Move.right})
+        snake = position.snakes[0]
+
+        # Assert
+        self.assertEqual(snake.health, 100)
+        self.assertEqual(snake.length, 4)
+        self.assertEqual(position.food, 0)
+
+    def test_stacked_hazards_do_damage_for_each(self):
+        # Arrange
+        data = make_move_request(0, [([(2, 3), (1, 3), (0, 3)], 90), ([(2, 5), (1, 5), (0, 5)], 20)], [(3, 1)])
+        data['board']['hazards'] = [{'x': 3, 'y': 3}, {'x': 3, 'y': 3}, {'x': 3, 'y': 5}, {'x': 4, 'y': 5}, {'x': 3, 'y': 1}]
+        rules = Ruleset.from_game({'ruleset': {'name': 'standard', 'settings': {'hazardDamagePerTurn': 10}}})
+        position = Position.from_board(Board(data['board']), 0, rules)
+        eliminated = []
+
+        # Act
+        after = advance(position, {'snake-0': Move.right, 'snake-1': Move.right})
+        starved = advance(after, {'snake-0': Move.down, 'snake-1': Move.right}, eliminated)
+        fed = advance(starved, {'snake-0': Move.down})
+
+        # Assert
+        self.assertEqual([x.health for x in after.snakes], [69, 9])
+        self.assertEqual(eliminated, [('snake-1', OUT_OF_HEALTH, None)])
+        # Eating in a hazard makes up for its damage.
+        self.assertEqual(fed.snakes[0].health, 100)
+
+    def test_royale_hazards_close_in(self):
+        # Arrange
+        data = make_move_request(24, [([(3, 3), (3, 2), (3, 1)], 90)], [])
+        rules = Ruleset.from_game({'ruleset': {'name': 'royale', 'settings': {'hazardDamagePerTurn': 14, 'royale': {'shrinkEveryNTurns': 25}}}})
+        position = Position.from_board(Board(data['board']), 24, rules)
+
+        # Act
+        shrunk = advance(position, {'snake-0': Move.up})
+        unchanged = advance(shrunk, {'snake-0': Move.up})
+
+        # Assert
+        self.assertEqual(position.hazards, 0)
+        # Any side could close in, so the whole edge of the board is expected to.
+        self.assertEqual(shrunk.hazards, position.grid.full & ~get_grid(7, 7).mask(get_grid(7, 7).index(x, y) for x in range(1, 6) for y in range(1, 6)))
+        self.assertEqual(shrunk.damage[0], 14)
+        self.assertEqual(shrunk.damage[get_grid(7, 7).index(3, 3)], 0)
+        self.assertEqual(unchanged.hazards, shrunk.hazards)
+
+    def test_constrictor_snakes_grow_every_turn(self):
+        # Arrange
+        data = make_move_request(0, [([(2, 3), (1, 3), (0, 3)], 100)], [])
+        position = Position.from_board(Board(data['board']), 0, Ruleset.from_game({'ruleset': {'name': 'constrictor'}}))
+
+        # Act
+        position = advance(advance(position, {'snake-0': Move.right}), {'snake-0': Move.right})
+        snake = position.snakes[0]
+
+        # Assert
+        self.assertEqual(snake.health, 100)
+        self.assertEqual(snake.length, 5)
+        # The tail never moves out of the way.
+        self.assertEqual(position.get_blocked() >> get_grid(7, 7).index(1, 3) & 1, 1)
+
+class WrappedTest(unittest.TestCase):
+    def make_wrapped_request(self, *args, **kwargs):
+        data = make_move_request(*args, **kwargs)
+        data['game']['ruleset'] = {'name': 'wrapped', 'version': 'v1.0.0'}
+
+        return data
+
+    def test_food_is_found_across_the_edge(self):
+        # Arrange
+        data = self.make_wrapped_request(10, [([(0, 3), (1, 3), (2, 3)], 5)], [(6, 3)])
+        board = Board(data['board'], is_wrapped(data['game']))
+        snake = Snake(data['you'], board.grid)
+
+        # Act
+        distance = board.get_nearest_food_distance(snake.head)
+        deadly = get_deadly_moves(board, snake)
+        move = choose_move(data)
+
+        # Assert
+        self.assertEqual(distance, 1)
+        self.assertEqual(deadly, {Move.right})
+        self.assertEqual(move, Move.left)
+
+    def test_snakes_wrap_in_the_look_ahead(self):
+        # Arrange
+        data = self.make_wrapped_request(10, [([(3, 6), (3, 5), (3, 4)], 90)], [(3, 0)])
+        position = Position.from_board(Board(data['board'], True), 10)
+
+        # Act
+        moves = position.get_moves(position.snakes[0])
+        after = advance(position, {'snake-0': Move.up})
+
+        # Assert
+        self.assertEqual(moves, [Move.up, Move.left, Move.right])
+        self.assertEqual(after.snakes[0].head, position.grid.index(3, 0))
+        self.assertEqual(after.snakes[0].length, 4)
+
+    def test_opponent_across_the_edge_is_searched(self):
+        # Arrange
+        # snake-3 is one step away from our head, across the left edge.
+        data = self.make_wrapped_request(10, [
+            ([(0, 5), (1, 5), (2, 5)], 90),
+            ([(4, 8), (4, 9), (4, 10)], 90),
+            ([(4, 2), (4, 1), (4, 0)], 90),
+            ([(10, 5), (9, 5), (8, 5)], 90),
+        ], [], width=11, height=11)
+        position = Position.from_board(Board(data['board'], True), 10)
+
+        # Act
+        search = Search(position, 'snake-0', 0)
+
+        # Assert
+        self.assertIn('snake-3', search.opponents)
+
+class HazardTest(unittest.TestCase):
+    def test_avoids_hazard_that_would_starve(self):
+        # Arrange
+        data = make_move_request(40, [([(3, 3), (2, 3), (1, 3)], 10)], [(6, 6)])
+        data['game']['ruleset'] = {'name': 'royale', 'settings': {'hazardDamagePerTurn': 14, 'royale': {'shrinkEveryNTurns': 25}}}
+        data['board']['hazards'] = [{'x': 4, 'y': 3}, {'x': 3, 'y': 4}]
+
+        # Act
+        move = choose_move(data)
+
+        # Assert
+        self.assertEqual(move, Move.down)
+
+class SearchTest(unittest.TestCase):
+    def test_avoids_losing_head_to_head(self):
+        # Arrange
+        # The cell to the right could also be taken by a longer snake, which would win the collision.
+        data = make_move_request(0, [
+            ([(2, 3), (1, 3), (0, 3)], 90),
+            ([(4, 3), (5, 3), (6, 3), (6, 2), (6, 1)], 90),
+        ], [])
+        position = Position.from_board(Board(data['board']))
+        deadline = time.perf_counter() + 0.1
+
+        # Act
+        move, score, depth = find_best_move(position, 'snake-0', deadline, [Move.right, Move.up, Move.down])
+
+        # Assert
+        self.assertNotEqual(move, Move.right)
+
+    def test_deadline_holds_on_a_crowded_board(self):
+        # Arrange
+        snakes = [([(x, y), (x, y - 1), (x, y - 2)], 90) for x in range(1, 19, 2) for y in (3, 10, 17)]
+        data = make_move_request(0, snakes, [(0, 0), (18, 18)], width=19, height=19)
+        position = Position.from_board(Board(data['board']))
+        started = time.perf_counter()
+
+        # Act
+        result = find_best_move(position, 'snake-0', started + 0.02, [Move.up, Move.left, Move.right])
+        elapsed = time.perf_counter() - started
+
+        # Assert
+        self.assertIsNotNone(result)
+        self.assertLess(elapsed, 0.04)
+
+    def test_deadline_leaves_room_for_the_network(self):
+        # Arrange
+        data = make_move_request(0, [([(1, 1), (1, 1), (1, 1)], 100)], [])
+
+        # Act
+        deadline = get_deadline(data, network_latency=200, started=0)
+
+        # Assert
+        self.assertLess(deadline, 0.3)
+
+class TranspositionTableTest(unittest.TestCase):
+    def test_hash_follows_the_position(self):
+        # Arrange
+        table = TranspositionTable(1024)
+        data = make_move_request(0, [([(2, 3), (1, 3), (0, 3)], 90)], [(5, 5)])
+        same = make_move_request(7, [([(2, 3), (1, 3), (0, 3)], 91)], [(5, 5)])
+        other = make_move_request(0, [([(2, 3), (1, 3), (0, 3)], 90)], [(5, 4)])
+
+        # Act
+        key = table.get_hash(Position.from_board(Board(data['board'])))
+        same_key = table.get_hash(Position.from_board(Board(same['board'])))
+        other_key = table.get_hash(Position.from_board(Board(other['board'])))
+
+        # Assert
+        self.assertEqual(key, same_key)
+        self.assertNotEqual(key, other_key)
+
+    def test_hash_follows_the_hazards(self):
+        # Arrange
+        table = TranspositionTable(1024)
+        data = make_move_request(0, [([(2, 3), (1, 3), (0, 3)], 90)], [(5, 5)])
+        hazards = make_move_request(0, [([(2, 3), (1, 3), (0, 3)], 90)], [(5, 5)])
+        hazards['board']['hazards'] = [{'x': 0, 'y': 0}, {'x': 1, 'y': 0}]
+        closed_in = make_move_request(0, [([(2, 3), (1, 3), (0, 3)], 90)], [(5, 5)])
+        closed_in['board']['hazards'] = [{'x': 0, 'y': 0}, {'x': 1, 'y': 0}, {'x': 2, 'y': 0}]
+
+        # Act
+        key = table.get_hash(Position.from_board(Board(data['board'])))
+        hazards_key = table.get_hash(Position.from_board(Board(hazards['board'])))
+        closed_in_key = table.get_hash(Position.from_board(Board(closed_in['board'])))
+
+        # Assert
+        self.assertEqual(len({key, hazards_key, closed_in_key}), 3)
+
+    def test_memory_cap(self):
+        # Act
+        table = TranspositionTable(64 * 1024)
+
+        # Assert
+        self.assertLessEqual(table.size * TranspositionTable.ENTRY_SIZE, 64 * 1024)
+        self.assertGreater(table.size * TranspositionTable.ENTRY_SIZE * 2, 64 * 1024)
+
+    def test_root_tries_the_move_left_in_the_table_first(self):
+        # Arrange
+        table = TranspositionTable(64 * 1024)
+        data = make_move_request(3, [([(3, 3), (3, 2), (3, 1)], 90), ([(5, 5), (5, 6), (6, 6)], 90)], [(0, 6)])
+        position = Position.from_board(Board(data['board']), data['turn'])
+        # As a ponder leaves it, with right as the best move.
+        table.store(table.get_hash(position), 0, 4, TranspositionTable.EXACT, MOVES.index(Move.right))
+        search = Search(position, 'snake-0', time.perf_counter() + 1, table)
+        orders = []
+        search_root = search._search_root
+        search._search_root = lambda order, depth: orders.append(list(order)) or search_root(order, depth)
+
+        # Act
+        search.run([Move.up, Move.left, Move.right], max_depth=2)
+
+        # Assert
+        self.assertEqual(orders[0], [Move.right, Move.up, Move.left])
+
+    def test_depth_preferred_replacement(self):
+        # Arrange
+        table = TranspositionTable(1024)
+        deep = 5
+        shallow = 5 + table.size
+
+        # Act
+        table.store(deep, 10, 6, TranspositionTable.EXACT, 0)
+        table.store(shallow, 20, 2, TranspositionTable.EXACT, 1)
+        kept = table.probe(deep)
+        table.new_turn()
+        table.store(shallow, 20, 2, TranspositionTable.EXACT, 1)
+
+        # Assert
+        self.assertEqual(kept, (10, 6, TranspositionTable.EXACT, 0))
+        self.assertEqual(table.probe(deep), None)
+        self.assertEqual(table.probe(shallow), (20, 2, TranspositionTable.EXACT, 1))
+
+class MonteCarloTest(unittest.TestCase):
+    def test_avoids_losing_head_to_head(self):
+        # Arrange
+        data = make_move_request(0, [
+            ([(2, 3), (1, 3), (0, 3)], 90),
+            ([(4, 3), (5, 3), (6, 3), (6, 2), (6, 1)], 90),
+        ], [])
+        position = Position.from_board(Board(data['board']))
+
+        # Act
+        result = server_mcts.grow_tree(position, 'snake-0', [Move.right, Move.up, Move.down], time.perf_counter() + 0.1, seed=1)
+
+        # Assert
+        self.assertLess(result[Move.right][1] / result[Move.right][0], result[Move.up][1] / result[Move.up][0])
+
+    def test_pool_answers_before_the_deadline(self):
+        # Arrange
+        data = make_move_request(0, [([(1, 1), (1, 1), (1, 1)], 100), ([(5, 5), (5, 5), (5, 5)], 100)], [(3, 3)])
+        position = Position.from_board(Board(data['board']))
+        server_mcts.start_pool(2)
+        self.addCleanup(server_mcts.stop_pool)
+        started = time.perf_counter()
+
+        # Act
+        result = server_mcts.find_best_move(position, 'snake-0', started + 0.1, [Move.up, Move.right])
+        elapsed = time.perf_counter() - started
+
+        # Assert
+        self.assertIn(result[0], [Move.up, Move.right])
+        self.assertLess(elapsed, 0.15)
+
+    def test_late_trees_do_not_hold_up_the_next_move(self):
+        # Arrange
+        data = make_move_request(0, [([(1, 1), (1, 1), (1, 1)], 100), ([(5, 5), (5, 5), (5, 5)], 100)], [(3, 3)])
+        position = Position.from_board(Board(data['board']))
+        server_mcts.start_pool(2)
+        self.addCleanup(server_mcts.stop_pool)
+        # Three games at once queue their trees behind each other on two workers.
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            deadline = time.perf_counter() + 0.2
+            list(executor.map(lambda _: server_mcts.find_best_move(position, 'snake-0', deadline, [Move.up, Move.right]), range(3)))
+
+        # Act
+        late = server_mcts.grow_tree(position, 'snake-0', [Move.up, Move.right], time.perf_counter() - 1)
+        result = server_mcts.find_best_move(position, 'snake-0', time.perf_counter() + 0.2, [Move.up, Move.right])
+
+        # Assert
+        self.assertEqual(late, {})
+        self.assertIsNotNone(result)
+
+class ReachableAreaTest(unittest.TestCase):
+    def test_tail_moves_out_of_the_way(self):
+        # Arrange
+        # A snake lies across the middle row with its tail on the left edge.
+        grid = get_grid(5, 5)
+        wall = tuple(grid.index(x, 2) for x in (4, 3, 2, 1, 0))
+
+        # Act
+        area = get_reachable_area(grid, grid.index(2, 1), [wall])
+
+        # Assert
+        self.assertEqual(area, 24)
+
+    def test_head_cannot_wait_in_a_dead_end(self):
+        # Arrange
+        # The only free cell is boxed in by segments that take three turns to move off.
+        grid = get_grid(3, 1)
+        body = (grid.index(1, 0), grid.index(2, 0))
+
+        # Act
+        area = get_reachable_area(grid, grid.index(0, 0), [body + (grid.index(2, 0),) * 2])
+
+        # Assert
+        self.assertEqual(area, 0)
+
+    def test_bodies_stay_in_the_way_in_constrictor(self):
+        # Arrange
+        grid = get_grid(5, 5)
+        wall = tuple(grid.index(x, 2) for x in (4, 3, 2, 1, 0))
+
+        # Act
+        area = get_reachable_area(grid, grid.index(2, 1), [wall], constrictor=True)
+
+        # Assert
+        self.assertEqual(area, 9)
+
+    def make_pocket(self):
+        # Moving down goes into a pocket on the left edge, whose only way out is the other snake's tail.
+        data = make_move_request(0, [
+            ([(0, 3), (0, 4), (0, 5), (0, 6)], 90),
+            ([(2, 2), (1, 2), (1, 1), (1, 0)], 90),
+        ], [])
+        return Board(data['board'])
+
+    def test_roomy_moves_in_constrictor(self):
+        # Arrange
+        board = self.make_pocket()
+        snake = board.snakes[0]
+
+        # Act
+        standard = get_roomy_moves(board, snake)
+        constrictor = get_roomy_moves(board, snake, Ruleset('constrictor', constrictor=True))
+
+        # Assert
+        self.assertEqual(standard, {Move.down, Move.right})
+        self.assertEqual(constrictor, {Move.right})
+
+    def test_move_areas(self):
+        # Arrange
+        # Moving left goes into the top left corner, which is boxed in by the other snake's neck.
+        data = make_move_request(0, [
+            ([(1, 6), (2, 6), (3, 6), (4, 6)], 90),
+            ([(0, 5), (0, 4), (0, 3), (0, 2), (0, 1), (0, 0), (1, 0)], 90),
+        ], [])
+        board = Board(data['board'])
+        snake = board.snakes[0]
+
+        # Act
+        areas = board.get_move_areas(snake)
+
+        # Assert
+        self.assertEqual(set(areas), {Move.left, Move.down})
+        self.assertEqual(areas[Move.left], 0)
+        self.assertGreater(areas[Move.down], 10)
+
+    def test_fast_on_a_large_board(self):
+        # Arrange
+        snakes = []
+        for y in (2, 6, 10, 14):
+            body = [(x, y) for x in range(18, -1, -1)] + [(x, y + 1) for x in range(19)]
+            snakes.append((body, 90))
+        board = Board(make_move_request(0, snakes, [], width=19, height=19)['board'])
+        bodies = [x.body_cells for x in board.snakes]
+        started = time.perf_counter()
+
+        # Act
+        for _ in range(100):
+            get_reachable_area(board.grid, board.grid.index(5, 0), bodies)
+        elapsed = (time.perf_counter() - started) / 100
+
+        # Assert
+        self.assertLess(elapsed, 0.001)
+
+class TerritoryTest(unittest.TestCase):
+    def test_equal_snakes_split_the_board(self):
+        # Arrange
+        data = make_move_request(0, [
+            ([(1, 3), (0, 3), (0, 2)], 90),
+            ([(5, 3), (6, 3), (6, 2)], 90),
+        ], [(0, 0), (6, 6), (3, 3)])
+        board = Board(data['board'])
+
+        # Act
+        territory = board.get_territory()
+
+        # Assert
+        self.assertEqual(territory['snake-0'][0], territory['snake-1'][0])
+        # The food in the middle is the same distance from both heads, so nobody owns it.
+        self.assertEqual(territory['snake-0'][1], 1)
+        self.assertEqual(territory['snake-1'][1], 1)
+
+    def test_longer_snake_wins_ties(self):
+        # Arrange
+        data = make_move_request(0, [
+            ([(1, 3), (0, 3), (0, 2)], 90),
+            ([(5, 3), (6, 3), (6, 2), (6, 1)], 90),
+        ], [(3, 3)])
+        board = Board(data['board'])
+
+        # Act
+        territory = board.get_territory()
+
+        # Assert
+        self.assertGreater(territory['snake-1'][0], territory['snake-0'][0])
+        self.assertEqual(territory['snake-1'][1], 1)
+
+    def test_batch_of_positions(self):
+        # Arrange
+        heads = np.zeros((2, 2, 1, 5), dtype=bool)
+        heads[0, 0, 0, 0] = heads[0, 1, 0, 4] = True
+        heads[1, 0, 0, 0] = heads[1, 1, 0, 1] = True
+        lengths = np.array([[3, 3], [3, 4]])
+        blocked = np.zeros((2, 1, 5), dtype=bool)
+        food = np.zeros((2, 1, 5), dtype=bool)
+
+        # Act
+        cells, eaten = get_voronoi(heads, lengths, blocked, food)
+
+        # Assert
+        self.assertEqual(cells.tolist(), [[2, 2], [1, 4]])
+
+class SimulatorTest(unittest.TestCase):
+    def test_start_position(self):
+        # Act
+        position = server_simulator.get_start_position(11, 11, ['a', 'b', 'c', 'd'], random.Random(1))
+
+        # Assert
+        self.assertEqual(len(position.snakes), 4)
+        self.assertEqual({position.grid.xy(x.head) for x in position.snakes}, {(1, 1), (1, 9), (9, 1), (9, 9)})
+        self.assertTrue(all(len(set(x.body)) == 1 and x.length == 3 for x in position.snakes))
+        self.assertEqual(bin(position.food).count('1'), 5)
+
+    def test_food_is_topped_up(self):
+        # Arrange
+        data = make_move_request(0, [([(1, 1), (1, 2), (1, 3)], 90)], [])
+        position = Position.from_board(Board(data['board']))
+
+        # Act
+        food = server_simulator.spawn_food(position, random.Random(1), minimum=3)
+
+        # Assert
+        self.assertEqual(bin(food).count('1'), 3)
+        self.assertEqual(food & position.get_blocked(), 0)
+
+    def test_elimination_order(self):
+        # Arrange
+        data = make_move_request(0, [
+            ([(2, 3), (1, 3), (0, 3)], 90),
+            ([(4, 3), (5, 3), (6, 3)], 90),
+            ([(6, 6), (5, 6), (4, 6)], 90),
+        ], [])
+        position = Position.from_board(Board(data['board']))
+        eliminated = []
+
+        # Act
+        advance(position, {'snake-0': Move.right, 'snake-1': Move.left, 'snake-2': Move.right}, eliminated)
+
+        # Assert
+        self.assertEqual(eliminated, [
+            ('snake-2', WALL_COLLISION, None),
+            ('snake-0', HEAD_COLLISION, 'snake-1'),
+            ('snake-1', HEAD_COLLISION, 'snake-0'),
+        ])
+
+    def test_plays_a_game_to_the_end(self):
+        # Arrange
+        strategies = {'a': server_simulator.random_strategy, 'b': server_simulator.random_strategy}
+
+        # Act
+        result = server_simulator.play_game(strategies, 7, 7, seed=3)
+
+        # Assert
+        self.assertGreater(result.turns, 0)
+        self.assertGreaterEqual(len(result.eliminations), 1)
+        self.assertGreater(len(result.move_times['a']), 0)
+        if result.winner is not None:
+            self.assertNotIn(result.winner, [x[1] for x in result.eliminations])
+
+class BenchTest(unittest.TestCase):
+    def test_percentiles(self):
+        # Arrange
+        times = [x / 1000 for x in range(1, 101)]
+
+        # Act
+        summary = server_bench.summarize(times)
+
+        # Assert
+        self.assertAlmostEqual(summary['p50'], 51)
+        self.assertAlmostEqual(summary['p99'], 100)
+        self.assertAlmostEqual(summary['max'], 100)
+        self.assertEqual(summary['count'], 100)
+
+    def test_compare_finds_regressions(self):
+        # Arrange
+        before = {'choose_move': {'p50': 10.0, 'p95': 20.0, 'p99': 30.0}}
+        after = {'choose_move': {'p50': 10.5, 'p95': 25.0, 'p99': 30.0}}
+
+        # Act
+        regressions = server_bench.compare(before, after, threshold=0.1)
+
+        # Assert
+        self.assertEqual(len(regressions), 1)
+        self.assertIn('p95', regressions[0])
+
+    def test_replays_a_recording(self):
+        # Arrange
+        requests = [
+            make_move_request(1, [([(1, 1), (1, 2), (1, 3)], 90)], [(5, 5)]),
+            make_move_request(2, [([(1, 0), (1, 1), (1, 2)], 89)], [(5, 5)]),
+        ]
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'moves.jsonl')
+            with open(path, 'w') as f:
+                for data in requests:
+                    f.write(json.dumps(data) + '\n')
+
+            # Act
+            times = server_bench.time_choose_move(path)
+            limited = list(server_bench.read_requests(path, limit=1))
+
+        # Assert
+        self.assertEqual(len(times), 2)
+        self.assertEqual(limited, requests[:1])
+
+    def test_replays_are_timed_without_the_game_timeout(self):
+        # Arrange
+        data = make_move_request(1, [([(1, 1), (1, 2), (1, 3)], 90), ([(5, 5), (5, 4), (5, 3)], 90)], [(3, 3)])
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'moves.jsonl')
+            with open(path, 'w') as f:
+                f.write(json.dumps(data) + '\n')
+
+            # Act
+            times = server_bench.time_choose_move(path)
+
+        # Assert
+        # With the 500ms timeout the search would run for about 290ms.
+        self.assertEqual(data['game']['timeout'], 500)
+        self.assertLess(times[0], 0.1)
+
+    def test_nothing_is_imported_before_the_tree_is_picked(self):
+        # Arrange
+        # With --against, the other revision's modules have to be the first ones imported.
+        script = "import sys, server_bench; print(sorted(x for x in sys.modules if x.startswith('server') and x != 'server_bench'))"
+
+        # Act
+        output = subprocess.run([sys.executable, '-c', script], cwd=os.path.dirname(os.path.abspath(__file__)), check=True, capture_output=True, text=True).stdout
+
+        # Assert
+        self.assertEqual(output.strip(), '[]')
+
+class MetricsTest(unittest.TestCase):
+    def test_histogram_buckets_are_cumulative(self):
+        # Arrange
+        histogram = server_metrics.Histogram('test_seconds', 'Test.', ('board',), (0.01, 0.1))
+
+        # Act
+        for value in (0.005, 0.01, 0.05, 0.5):
+            histogram.observe(('7x7',), value)
+        lines = histogram.render()
+
+        # Assert
+        self.assertIn('test_seconds_bucket{board="7x7",le="0.01"} 2', lines)
+        self.assertIn('test_seconds_bucket{board="7x7",le="0.1"} 3', lines)
+        self.assertIn('test_seconds_bucket{board="7x7",le="+Inf"} 4', lines)
+        self.assertIn('test_seconds_count{board="7x7"} 4', lines)
+
+    def test_choose_move_laps_every_phase(self):
+        # Arrange
+        data = make_move_request(1, [([(1, 1), (1, 2), (1, 3)], 90)], [(5, 5)])
+        timings = server_metrics.RequestTimings()
+
+        # Act
+        choose_move(data, timings=timings)
+
+        # Assert
+        self.assertEqual(set(timings.phases), {'model', 'safety', 'food', 'search'})
+        self.assertAlmostEqual(sum(timings.phases.values()), timings.get_total())
+
+    def test_metrics_endpoint(self):
+        # Arrange
+        import server
+        client = server.app.test_client()
+        data = make_move_request(1, [([(1, 1), (1, 2), (1, 3)], 90)], [(5, 5)], game_id='metrics')
+
+        # Act
+        client.post('/start', json=data)
+        client.post('/move', json=data)
+        response = client.get('/metrics')
+
+        # Assert
+        text = response.get_data(as_text=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('battlesnake_move_phase_seconds_count{phase="decode",board="7x7",snakes="1"}', text)
+        self.assertIn('battlesnake_move_timeout_ratio_bucket{board="7x7",snakes="1",le="1.0"}', text)
+
+class AsgiTest(unittest.TestCase):
+    def call(self, method, path, body=b''):
+        '''
+        Sends one request straight to the ASGI app, and returns the status and body of the response.
+        '''
+
+        import server_asgi
+
+        scope = {
+            'type': 'http', 'method': method, 'path': path, 'root_path': '', 'query_string': b'',
+            'headers': [(b'content-type', b'application/json')], 'http_version': '1.1', 'scheme': 'http',
+            'server': ('test', 80),
+        }
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        async def send(message):
+            messages.append(message)
+
+        asyncio.run(server_asgi.app(scope, receive, send))
+        status = next(x['status'] for x in messages if x['type'] == 'http.response.start')
+        content = b''.join(x.get('body', b'') for x in messages if x['type'] == 'http.response.body')
+
+        return status, content
+
+    def test_move(self):
+        # Arrange
+        data = make_move_request(1, [([(1, 1), (1, 2), (1, 3)], 90)], [(5, 5)], game_id='asgi')
+        body = json.dumps(data).encode()
+
+        # Act
+        self.call('POST', '/start', body)
+        status, content = self.call('POST', '/move', body)
+        self.call('POST', '/end', body)
+
+        # Assert
+        self.assertEqual(status, 200)
+        self.assertIn(json.loads(content)['move'], [Move.up, Move.down, Move.left, Move.right])
+
+    def test_move_is_answered_straight_away_when_every_thread_is_busy(self):
+        # Arrange
+        import server_asgi
+
+        # The snake is in the bottom left corner, so only up and right are safe.
+        data = make_move_request(1, [([(0, 0), (0, 1), (0, 2)], 90)], [(5, 5)], game_id='asgi-busy')
+        data['you']['body'] = data['board']['snakes'][0]['body'] = [{'x': 0, 'y': 0}, {'x': 1, 'y': 0}, {'x': 2, 'y': 0}]
+        self.addCleanup(setattr, server_asgi, 'picking', server_asgi.picking)
+        server_asgi.picking = server_asgi.MOVE_THREADS
+
+        # Act
+        started = time.perf_counter()
+        status, content = self.call('POST', '/move', json.dumps(data).encode())
+        elapsed = time.perf_counter() - started
+
+        # Assert
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(content)['move'], Move.up)
+        self.assertLess(elapsed, 0.1)
+
+    def test_info(self):
+        # Act
+        status, content = self.call('GET', '/')
+
+        # Assert
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(content)['apiversion'], '1')
+
+class CodecTest(unittest.TestCase):
+    def test_compact_matches_the_usual_path(self):
+        # Arrange
+        data = make_move_request(3, [
+            ([(1, 1), (1, 2), (1, 3), (2, 3), (2, 3)], 90),
+            ([(5, 5), (5, 4), (4, 4)], 40),
+        ], [(0, 6), (6, 0)])
+        data['board']['hazards'] = [{'x': 3, 'y': 3}]
+        body = json.dumps(data, separators=(',', ':')).encode()
+
+        # Act
+        compact = server_codec.parse_move_request(body, min_size=0)
+        usual = Board(data['board'])
+        board = Board(compact['board'])
+        snake = Snake(compact['you'], board.grid)
+
+        # Assert
+        self.assertIn('body_cells', compact['you'])
+        self.assertEqual(board.food_cells, usual.food_cells)
+        self.assertEqual(board.hazard_mask, usual.hazard_mask)
+        self.assertEqual([x.body_cells for x in board.snakes], [x.body_cells for x in usual.snakes])
+        self.assertEqual([x.body_mask for x in board.snakes], [x.body_mask for x in usual.snakes])
+        self.assertEqual(snake.head.get_xy(), (1, 1))
+        self.assertEqual(compact['you']['health'], 90)
+
+    def test_unusual_layout_falls_back(self):
+        # Arrange
+        data = make_move_request(3, [([(1, 1), (1, 2), (1, 3)], 90)], [(0, 6)])
+        body = json.dumps(data, indent=2).encode()
+
+        # Act
+        parsed = server_codec.parse_move_request(body, min_size=0)
+
+        # Assert
+        self.assertEqual(parsed, data)
+
+    def test_compact_board_updates(self):
+        # Arrange
+        before = make_move_request(3, [([(1, 1), (1, 2), (1, 3)], 90)], [(1, 0), (6, 6)])
+        after = make_move_request(4, [([(1, 0), (1, 1), (1, 2), (1, 2)], 100)], [(6, 6)])
+        board = Board(before['board'])
+
+        # Act
+        updated = board.update(server_codec.parse_move_request(json.dumps(after, separators=(',', ':')).encode(), min_size=0)['board'])
+
+        # Assert
+        self.assertTrue(updated)
+        self.assertEqual(board.snakes[0].body_cells, Board(after['board']).snakes[0].body_cells)
+        self.assertEqual(board.food_mask, Board(after['board']).food_mask)
+
+class StartupTest(unittest.TestCase):
+    def test_numpy_is_imported_lazily(self):
+        # Act
+        output = subprocess.run(
+            [sys.executable, '-c', "import sys, server_logic; print('numpy' in sys.modules)"],
+            cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True,
+        ).stdout
+
+        # Assert
+        self.assertEqual(output.strip(), 'False')
+
+    def test_warm_up_builds_the_standard_grids(self):
+        # Act
+        warm_up(((7, 7),))
+        hits = get_grid.cache_info().hits
+        get_grid(7, 7)
+
+        # Assert
+        self.assertEqual(get_grid.cache_info().hits, hits + 1)
+
+class DispatchTest(unittest.TestCase):
+    def test_game_id_is_read_from_the_body(self):
+        # Arrange
+        data = make_move_request(1, [([(1, 1), (1, 2), (1, 3)], 90)], [], game_id='abc-123')
+        compact = json.dumps(data, separators=(',', ':')).encode()
+        spaced = json.dumps(data, indent=2).encode()
+
+        # Act
+        ids = [server_dispatch.get_game_id(compact), server_dispatch.get_game_id(spaced)]
+
+        # Assert
+        self.assertEqual(ids, ['abc-123', 'abc-123'])
+
+    def test_games_keep_their_worker(self):
+        # Act
+        first = [server_dispatch.get_worker_index(f'game-{i}', 4) for i in range(20)]
+        second = [server_dispatch.get_worker_index(f'game-{i}', 4) for i in range(20)]
+
+        # Assert
+        self.assertEqual(first, second)
+        self.assertGreater(len(set(first)), 1)
+
+    def test_workers_answer_moves(self):
+        # Arrange
+        dispatcher = server_dispatch.Dispatcher(2)
+        data = make_move_request(1, [([(1, 1), (1, 2), (1, 3)], 90)], [(5, 5)], game_id='dispatch')
+        body = json.dumps(data, separators=(',', ':')).encode()
+
+        async def play():
+            await dispatcher.request('/start', body)
+            answers = [await dispatcher.request('/move', body) for _ in range(2)]
+            return answers, await dispatcher.get_metrics()
+
+        # Act
+        try:
+            answers, metrics = asyncio.run(play())
+        finally:
+            dispatcher.stop()
+
+        # Assert
+        self.assertEqual([x[0] for x in answers], [200, 200])
+        self.assertIn(json.loads(answers[0][1])['move'], [Move.up, Move.down, Move.left, Move.right])
+        self.assertIn('battlesnake_move_seconds_count{board="7x7",snakes="1"} 2', metrics)
+
+    def test_dead_worker_is_started_again_in_the_background(self):
+        # Arrange
+        dispatcher = server_dispatch.Dispatcher(2)
+        data = make_move_request(1, [([(1, 1), (1, 2), (1, 3)], 90)], [(5, 5)], game_id='dispatch')
+        data['game']['timeout'] = 0
+        body = json.dumps(data, separators=(',', ':')).encode()
+        owner = dispatcher.get_worker(body)
+        owner.process.kill()
+        owner.process.join()
+
+        async def play():
+            answer = await dispatcher.request('/move', body)
+            restarting = owner.restarting is not None
+            await owner.restarting
+            return answer, restarting, await dispatcher.request('/move', body)
+
+        # Act
+        try:
+            answer, restarting, after = asyncio.run(play())
+            alive = owner.process.is_alive()
+        finally:
+            dispatcher.stop()
+
+        # Assert
+        # The move was answered by the other worker while the dead one was still booting.
+        self.assertEqual(answer[0], 200)
+        self.assertTrue(restarting)
+        self.assertEqual(after[0], 200)
+        self.assertTrue(alive)
+
+class PonderTest(unittest.TestCase):
+    def make_ponder(self, duration):
+        data = make_move_request(3, [([(2, 3), (2, 2), (2, 1)], 90), ([(8, 7), (8, 8), (8, 9)], 90)], [(5, 5)], width=11, height=11)
+        position = Position.from_board(Board(data['board']), data['turn'])
+        table = TranspositionTable(1024 * 1024)
+
+        return position, table, server_ponder.Ponder(position, 'snake-0', Move.up, table, duration)
+
+    def test_ponder_fills_the_next_turn(self):
+        # Arrange
+        position, table, ponder = self.make_ponder(0.05)
+        them = position.get_snake('snake-1')
+
+        # Act
+        ponder.start()
+        ponder.thread.join()
+
+        # Assert
+        # Whatever the opponent replies, our next position is already in the table.
+        for reply in position.get_moves(them):
+            after = advance(position, {'snake-0': Move.up, 'snake-1': reply})
+            self.assertIsNotNone(table.probe(table.get_hash(after)))
+        self.assertGreater(ponder.result[2], 1)
+
+    def test_picking_a_move_stops_pondering(self):
+        # Arrange
+        position, table, ponder = self.make_ponder(2.0)
+        ponder.start()
+
+        # Act
+        started = time.perf_counter()
+        with server_ponder.picking():
+            elapsed = time.perf_counter() - started
+            _, _, blocked = self.make_ponder(2.0)
+            started_while_picking = blocked.start()
+
+        # Assert
+        self.assertFalse(ponder.thread.is_alive())
+        self.assertLess(elapsed, 0.05)
+        self.assertFalse(started_while_picking)
+
+    def test_ending_the_game_stops_pondering(self):
+        # Arrange
+        store = SessionStore()
+        session = store.start(make_move_request(0, [([(1, 1), (1, 1), (1, 1)], 100)], [], game_id='pondered'))
+        _, _, session.ponder = self.make_ponder(2.0)
+        ponder = session.ponder
+        store.start_ponder('pondered')
+
+        # Act
+        store.end({'game': {'id': 'pondered'}})
+
+        # Assert
+        self.assertFalse(ponder.thread.is_alive())
+
+class BookTest(unittest.TestCase):
+    def test_mirrored_positions_share_a_key(self):
+        # Arrange
+        data = make_move_request(2, [([(1, 2), (1, 1), (1, 0)], 98), ([(5, 4), (5, 5), (5, 6)], 98)], [(3, 3), (0, 6)])
+        mirrored = make_move_request(2, [([(5, 2), (5, 1), (5, 0)], 98), ([(1, 4), (1, 5), (1, 6)], 98)], [(3, 3), (6, 6)])
+        for snake in mirrored['board']['snakes']:
+            snake['id'] = 'other-' + snake['id']
+        position = Position.from_board(Board(data['board']), 2)
+        other = Position.from_board(Board(mirrored['board']), 2)
+
+        # Act
+        key, symmetry = server_book.get_canonical_key(position, 'snake-0')
+        other_key, other_symmetry = server_book.get_canonical_key(other, 'other-snake-0')
+
+        # Assert
+        self.assertEqual(key, other_key)
+        self.assertEqual(other_symmetry.inverse[symmetry.moves[Move.left]], Move.right)
+
+    def test_book_answers_from_the_file(self):
+        # Arrange
+        position = server_simulator.get_start_position(7, 7, ['a', 'b'], random.Random(0))
+        key, symmetry = server_book.get_canonical_key(position, 'a')
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'book.bin')
+            server_book.write_book(path, {key: (symmetry.moves[Move.down], 42, 9)}, 0)
+
+            # Act
+            book = server_book.OpeningBook(path)
+            found = book.probe(position, 'a')
+            # The start is the same for both snakes, turned around, but the next turn isn't in the book.
+            mirrored = book.probe(position, 'b')
+            missing = book.probe(advance(position, {'a': Move.up, 'b': Move.up}), 'a')
+
+        # Assert
+        self.assertEqual(found, (Move.down, 42, 9))
+        self.assertIsNotNone(mirrored)
+        self.assertIsNone(missing)
+
+    def test_choose_move_plays_the_book(self):
+        # Arrange
+        data = make_move_request(0, [([(1, 1), (1, 1), (1, 1)], 100), ([(5, 5), (5, 5), (5, 5)], 100)], [(3, 3)])
+        position = Position.from_board(Board(data['board']), 0)
+        key, symmetry = server_book.get_canonical_key(position, 'snake-0')
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'book.bin')
+            # Left is on the board, but nothing would pick it over the food.
+            server_book.write_book(path, {key: (symmetry.moves[Move.left], 0, 20)}, 0)
+            os.environ['OPENING_BOOK'] = path
+            try:
+                # Act
+                move = choose_move(data)
+            finally:
+                del os.environ['OPENING_BOOK']
+
+        # Assert
+        self.assertEqual(move, Move.left)
+
+class TablebaseTest(unittest.TestCase):
+    def test_turns_match_the_rules(self):
+        # Arrange
+        grid = get_grid(5, 5)
+        us = server_tablebase.get_bodies(grid, 3)
+        them = server_tablebase.get_bodies(grid, 4)
+        rng = random.Random(0)
+        pairs = [(rng.randrange(len(us)), rng.randrange(len(them))) for _ in range(300)]
+        pairs = [(i, j) for i, j in pairs if not set(us.bodies[i]) & set(them.bodies[j])]
+
+        for i, j in pairs:
+            position = Position(grid, (SnakeState('us', us.bodies[i], 90), SnakeState('them', them.bodies[j], 90)), 0)
+            for a in range(4):
+                for b in range(4):
+                    # Act
+                    dead_us, dead_them, after = server_tablebase.play(us, them, i, j, a, b)
+                    expected = advance(position, {'us': MOVES[a], 'them': MOVES[b]})
+
+                    # Assert
+                    self.assertEqual(dead_us, expected.get_snake('us') is None)
+                    self.assertEqual(dead_them, expected.get_snake('them') is None)
+                    if after >= 0:
+                        self.assertEqual(us.bodies[after // len(them)], expected.get_snake('us').body)
+                        self.assertEqual(them.bodies[after % len(them)], expected.get_snake('them').body)
+
+    def test_trapped_opponent_is_won(self):
+        # Arrange
+        # Their only way out of the corner is through our neck.
+        data = make_move_request(30, [([(2, 0), (1, 0), (1, 1)], 90), ([(0, 0), (0, 1), (0, 2)], 90)], [], width=5, height=5)
+        position = Position.from_board(Board(data['board']), 30)
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'tablebase.bin')
+            server_tablebase.write_tablebase(path, 5, 5, 3)
+            tablebase = server_tablebase.Tablebase(path)
+
+            # Act
+            won = tablebase.probe(position, 'snake-0')
+            lost = tablebase.probe(position, 'snake-1')
+
+        # Assert
+        self.assertIn(won[0], [Move.up, Move.right])
+        self.assertEqual(won[1:], (server_tablebase.WIN - 1, 1))
+        self.assertEqual(lost[1:], (server_tablebase.LOSS + 1, 1))
+
+    def test_food_in_reach_is_not_covered(self):
+        # Arrange
+        data = make_move_request(30, [([(2, 0), (1, 0), (1, 1)], 90), ([(0, 0), (0, 1), (0, 2)], 90)], [(3, 0)], width=5, height=5)
+        position = Position.from_board(Board(data['board']), 30)
+        starving = make_move_request(30, [([(2, 0), (1, 0), (1, 1)], 1), ([(0, 0), (0, 1), (0, 2)], 90)], [], width=5, height=5)
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'tablebase.bin')
+            server_tablebase.write_tablebase(path, 5, 5, 3)
+            tablebase = server_tablebase.Tablebase(path)
+
+            # Act
+            near_food = tablebase.probe(position, 'snake-0')
+            hungry = tablebase.probe(Position.from_board(Board(starving['board']), 30), 'snake-0')
+
+        # Assert
+        self.assertIsNone(near_food)
+        self.assertIsNone(hungry)
+
+class OpponentModelTest(unittest.TestCase):
+    def observe_straight(self, model, turns):
+        before = make_move_request(10, [([(0, 0), (0, 1), (0, 2)], 90), ([(3, 3), (3, 2), (3, 1)], 90)], [])
+        after = make_move_request(11, [([(1, 0), (0, 0), (0, 1)], 89), ([(3, 4), (3, 3), (3, 2)], 89)], [])
+        for _ in range(turns):
+            model.observe(Position.from_board(Board(before['board']), 10), Position.from_board(Board(after['board']), 11), after['board']['snakes'], 'snake-0')
+
+        return after
+
+    def test_predicts_after_enough_moves(self):
+        # Arrange
+        model = server_opponents.OpponentModel()
+        self.observe_straight(model, server_opponents.MIN_OBSERVATIONS - 1)
+        early = model.get_predictors(make_move_request(11, [([(1, 0)], 90), ([(3, 4)], 90)], [])['board']['snakes'], 'snake-0')
+
+        # Act
+        after = self.observe_straight(model, 1)
+        predictors = model.get_predictors(after['board']['snakes'], 'snake-0')
+        position = Position.from_board(Board(after['board']), 11)
+        opponent = position.get_snake('snake-1')
+        moves = position.get_moves(opponent)
+        features = server_opponents.get_features(position, opponent, moves, position.get_snake('snake-0'))
+        prediction = predictors['snake-1'].predict(features)
+
+        # Assert
+        self.assertEqual(early, {})
+        self.assertEqual(list(predictors), ['snake-1'])
+        self.assertEqual(max(prediction, key=prediction.get), Move.up)
+        self.assertAlmostEqual(sum(prediction.values()), 1)
+        self.assertEqual(server_opponents.MoveStats().prune(position, opponent, moves, position.get_snake('snake-0')), moves)
+
+    def test_least_recently_used_are_dropped(self):
+        # Arrange
+        model = server_opponents.OpponentModel(max_records=2)
+        self.observe_straight(model, 1)
+
+        # Act
+        model.get('id:snake-1')
+        model._get_or_add('author:someone')
+
+        # Assert
+        self.assertEqual(len(model), 2)
+        self.assertIsNone(model.get('snake:snake-1|None|None|None'))
+        self.assertIsNotNone(model.get('id:snake-1'))
+
+    def test_saved_records_outlast_the_game(self):
+        # Arrange
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'opponents.json')
+            model = server_opponents.OpponentModel(path=path)
+            self.observe_straight(model, server_opponents.MIN_OBSERVATIONS)
+
+            # Act
+            saved = model.save()
+            throttled = model.save()
+            loaded = server_opponents.OpponentModel(path=path)
+
+        # Assert
+        self.assertTrue(saved)
+        self.assertFalse(throttled)
+        self.assertIsNone(loaded.get('id:snake-1'))
+        stats = loaded.get('snake:snake-1|None|None|None')
+        self.assertEqual(stats.observations, server_opponents.MIN_OBSERVATIONS)
+        self.assertEqual(stats.chosen, model.get('id:snake-1').chosen)
+
+    def test_games_ending_together_save_a_whole_file(self):
+        # Arrange
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'opponents.json')
+            model = server_opponents.OpponentModel(path=path)
+            self.observe_straight(model, server_opponents.MIN_OBSERVATIONS)
+
+            # Act
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                saved = list(executor.map(lambda _: model.save(force=True), range(32)))
+            loaded = server_opponents.OpponentModel(path=path)
+            files = os.listdir(folder)
+
+        # Assert
+        self.assertEqual(saved, [True] * 32)
+        self.assertEqual(files, ['opponents.json'])
+        self.assertEqual(loaded.get('snake:snake-1|None|None|None').observations, server_opponents.MIN_OBSERVATIONS)
+
+class LogTest(unittest.TestCase):
+    def test_records_are_written_as_json_lines(self):
+        # Arrange
+        stream = io.StringIO()
+        logger = server_log.Logger(stream)
+
+        # Act
+        logger.info('move', game='abc', turn=3, move=Move.up)
+        with logger.muted():
+            logger.info('move', game='warm-up', turn=0, move=Move.up)
+        logger.close()
+        records = [json.loads(x) for x in stream.getvalue().splitlines()]
+
+        # Assert
+        self.assertEqual(len(records), 1)
+        self.assertEqual({k: records[0][k] for k in ('level', 'event', 'game', 'turn', 'move')}, {'level': 'info', 'event': 'move', 'game': 'abc', 'turn': 3, 'move': Move.up})
+
+    def test_full_queue_drops_and_counts(self):
+        # Arrange
+        stream = io.StringIO()
+        logger = server_log.Logger(stream, queue_size=4, interval=60)
+        # Holding the writer up, like a stdout that is pushing back.
+        logger._writing.acquire()
+
+        # Act
+        queued = [logger.debug('move_detail', turn=i) for i in range(6)]
+        important = logger.info('end', game='abc')
+        logger._writing.release()
+        logger.close()
+        records = [json.loads(x) for x in stream.getvalue().splitlines()]
+
+        # Assert
+        self.assertEqual(queued, [True] * 4 + [False] * 2)
+        self.assertTrue(important)
+        self.assertEqual(logger.dropped['debug'], 2)
+        self.assertEqual([x['event'] for x in records].count('move_detail'), 4)
+        self.assertIn({'dropped_level': 'debug', 'count': 2}, [{k: x.get(k) for k in ('dropped_level', 'count')} for x in records])
+
+    def test_debug_records_are_sampled(self):
+        # Arrange
+        never = server_log.Logger(io.StringIO(), sample=0)
+        always = server_log.Logger(io.StringIO(), sample=1)
+
+        # Act
+        sampled = [(never.sampled(), always.sampled()) for _ in range(20)]
+
+        # Assert
+        self.assertEqual(set(sampled), {(False, True)})
+
+class RecorderTest(unittest.TestCase):
+    game = {'id': 'recorded/1', 'ruleset': {'name': 'standard', 'version': 'v1'}, 'timeout': 500}
+
+    def play(self, recorder: server_recorder.Recorder, turns: int, skip: int = None) -> list:
+        # Plays random safe moves, with the hazards moving on turn 5, and records every turn but the one skipped.
+        rng = random.Random(7)
+        position = server_simulator.get_start_position(11, 11, ['me', 'them'], rng)
+        recorder.start(server_simulator.get_move_request(self.game, position, 'me'))
+        positions = []
+        while len(position.snakes) == 2 and position.turn < turns:
+            if position.turn == 5:
+                position = Position(position.grid, position.snakes, position.food, position.grid.mask([0, 1, 2]), position.turn)
+            if position.turn != skip:
+                recorder.move(server_simulator.get_move_request(self.game, position, 'me'), Move.up, ('search', 0.5, 42), 3.0)
+                positions.append(position)
+            moves = {x.id: rng.choice(position.get_moves(x) or [Move.up]) for x in position.snakes}
+            position = advance(position, moves)
+        recorder.close()
+
+        return positions
+
+    def test_game_is_rebuilt_from_the_recording(self):
+        with tempfile.TemporaryDirectory() as folder:
+            # Arrange
+            recorder = server_recorder.Recorder(folder)
+            positions = self.play(recorder, 30)
+
+            # Act
+            record = server_recorder.GameRecord(recorder.get_path(self.game['id']))
+            rebuilt = list(record.positions())
+            last = record.get_position(positions[-1].turn)
+            decision = record.get_decision(3)
+            record.close()
+
+        # Assert
+        self.assertEqual(len(rebuilt), len(positions))
+        for expected, actual in zip(positions, rebuilt):
+            self.assertEqual((actual.turn, actual.food, actual.hazards), (expected.turn, expected.food, expected.hazards))
+            self.assertEqual([(x.id, x.body, x.health) for x in actual.snakes], [(x.id, x.body, x.health) for x in expected.snakes])
+        self.assertEqual([(x.id, x.body) for x in last.snakes], [(x.id, x.body) for x in positions[-1].snakes])
+        self.assertEqual(decision, (Move.up, 'search', 42, 0.5, 3.0))
+
+    def test_missed_turn_is_recorded_as_a_keyframe(self):
+        with tempfile.TemporaryDirectory() as folder:
+            # Arrange
+            recorder = server_recorder.Recorder(folder)
+            positions = self.play(recorder, 12, skip=8)
+
+            # Act
+            record = server_recorder.GameRecord(recorder.get_path(self.game['id']))
+            kinds = [x[0] for x in record._records]
+            after = record.get_position(9)
+            missing = record.get_position(8)
+            record.close()
+
+        # Assert
+        self.assertEqual(kinds.count(server_recorder.KEYFRAME), 2)
+        self.assertIsNone(missing)
+        self.assertEqual([x.body for x in after.snakes], [x.body for x in positions[8].snakes])
+
+    def test_reopened_recording_keeps_its_snakes(self):
+        with tempfile.TemporaryDirectory() as folder:
+            # Arrange
+            rng = random.Random(7)
+            recorder = server_recorder.Recorder(folder)
+            position = server_simulator.get_start_position(11, 11, ['a', 'b', 'c'], rng)
+            positions = []
+            for turn in range(6):
+                if turn == 3:
+                    # The file is closed, as it is once a game goes idle or the server restarts, and opened again once 'b' is gone.
+                    recorder.close()
+                    recorder = server_recorder.Recorder(folder)
+                    position = Position(position.grid, tuple(x for x in position.snakes if x.id != 'b'), position.food, 0, position.turn)
+                recorder.move(server_simulator.get_move_request(self.game, position, 'a'), Move.up, None, 1.0)
+                positions.append(position)
+                position = advance(position, {x.id: rng.choice(position.get_moves(x)) for x in position.snakes})
+            recorder.close()
+
+            # Act
+            record = server_recorder.GameRecord(recorder.get_path(self.game['id']))
+            rebuilt = list(record.positions())
+            record.close()
+
+        # Assert
+        self.assertEqual([[(x.id, x.body) for x in p.snakes] for p in rebuilt], [[(x.id, x.body) for x in p.snakes] for p in positions])
+
+    def test_write_errors_are_logged(self):
+        with tempfile.TemporaryDirectory() as folder:
+            # Arrange
+            stream = io.StringIO()
+            self.addCleanup(setattr, server_recorder, 'logger', server_recorder.logger)
+            server_recorder.logger = server_log.Logger(stream)
+            rng = random.Random(7)
+            position = server_simulator.get_start_position(11, 11, ['me', 'them'], rng)
+            recorder = server_recorder.Recorder(folder)
+            recorder.move(server_simulator.get_move_request(self.game, position, 'me'), Move.up, None, 1.0)
+            recorder.flush()
+            # The file goes away underneath the writer.
+            recorder._games[self.game['id']].file.close()
+
+            # Act
+            position = advance(position, {x.id: rng.choice(position.get_moves(x)) for x in position.snakes})
+            recorder.move(server_simulator.get_move_request(self.game, position, 'me'), Move.up, None, 1.0)
+            recorder.flush()
+            recorder.close()
+            server_recorder.logger.close()
+
+        # Assert
+        self.assertIn('record_failed', stream.getvalue())
+
+    def test_bench_replays_recordings(self):
+        with tempfile.TemporaryDirectory() as folder:
+            # Arrange
+            recorder = server_recorder.Recorder(folder)
+            positions = self.play(recorder, 10)
+
+            # Act
+            requests = list(server_bench.read_requests(folder))
+            limited = list(server_bench.read_requests(folder, limit=2))
+
+        # Assert
+        self.assertEqual(requests, [server_simulator.get_move_request(self.game, x, 'me') for x in positions])
+        self.assertEqual(len(limited), 2)
+
+class ChooseMoveTest(unittest.TestCase):
+    def test_deadline_counts_the_time_spent_waiting(self):
+        # Arrange
+        data = make_move_request(1, [([(1, 1), (1, 2), (1, 3)], 90), ([(5, 5), (5, 4), (5, 3)], 90)], [(3, 3)])
+        # The request came in most of its search budget ago, and waited for a thread.
+        timings = server_metrics.RequestTimings(time.perf_counter() - 0.28)
+
+        # Act
+        started = time.perf_counter()
+        move = choose_move(data, None, timings)
+        elapsed = time.perf_counter() - started
+
+        # Assert
+        self.assertIn(move, [Move.up, Move.down, Move.left, Move.right])
+        self.assertLess(elapsed, 0.1)
+
+    def test_null_ruleset_is_played_as_standard(self):
+        # Arrange
+        data = make_move_request(0, [([(1, 1), (1, 1), (1, 1)], 100), ([(5, 5), (5, 5), (5, 5)], 100)], [(3, 3)])
+        data['game']['ruleset'] = None
+        data['game']['timeout'] = 0
+
+        # Act
+        move = choose_move(data)
+
+        # Assert
+        self.assertIn(move, [Move.up, Move.down, Move.left, Move.right])
+
     def test_choose_move(self):
         # Arrange
         data = {